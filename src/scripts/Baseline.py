@@ -4,20 +4,18 @@ from __future__ import division, print_function
 
 from tagassess.dao.helpers import FilteredUserItemAnnotations
 from tagassess.dao.pytables.annotations import AnnotReader
-from tagassess.index_creator import create_occurrence_index
+from tagassess.index_creator import IndexCache
 from tagassess.probability_estimates.precomputed import PrecomputedEstimator
 
 import os
 import plac
 import sys
 
-def get_baselines(annot_filter, reader, user_to_tags):
+def get_baselines(annot_filter, reader, user_to_tags, index_cache):
     
-    annotations = annot_filter.annotations(reader.iterate())
-    user_to_item = create_occurrence_index(annotations, 'user', 'item')
-    
-    annotations = annot_filter.annotations(reader.iterate())
-    item_to_tags = create_occurrence_index(annotations, 'item', 'tag')
+    chunks_func = lambda: annot_filter.filter_chunks(reader.iter_chunks())
+    user_to_item = index_cache.occurrence_index('user', 'item', chunks_func)
+    item_to_tags = index_cache.occurrence_index('item', 'tag', chunks_func)
     
     overlap = {}
     for user in user_to_tags:
@@ -30,7 +28,7 @@ def get_baselines(annot_filter, reader, user_to_tags):
                     overlap[user, tag] += 1
     
     idf = {}
-    annotations = annot_filter.annotations(reader.iterate())
+    annotations = annot_filter.iterate(reader)
     for annot in annotations:
         tag = annot['tag']
         if tag not in idf:
@@ -43,7 +41,8 @@ def get_baselines(annot_filter, reader, user_to_tags):
     
     return idf, overlap
 
-def run_exp(user_validation_tags, user_test_tags, est, annot_filter, reader):
+def run_exp(user_validation_tags, user_test_tags, est, annot_filter, reader,
+            index_cache):
     
     user_to_tags = {}
     for user in est.get_valid_users():
@@ -56,7 +55,8 @@ def run_exp(user_validation_tags, user_test_tags, est, annot_filter, reader):
                 
         user_to_tags[user] = tags_to_compute
     
-    idf, overlap = get_baselines(annot_filter, reader, user_to_tags)
+    idf, overlap = get_baselines(annot_filter, reader, user_to_tags, 
+                                 index_cache)
 
     print('#user', 'tag', 'pop', 'idf', 'overlap', 
           'overlap_idf', 'hidden_tag')
@@ -105,9 +105,11 @@ def load_train_test_validation(cross_val_folder):
     db_name = plac.Annotation('H5 database name', type=str),
     cross_val_folder = plac.Annotation('Folder with cross validation files', 
             type=str),
-    probs_folder = plac.Annotation('Probabilities Folder', type=str))
+    probs_folder = plac.Annotation('Probabilities Folder', type=str),
+    cache_folder = plac.Annotation('Folder to cache indexes built from ' +
+            'the database (None = no cache)', type=str, kind='option'))
 
-def main(db_fpath, db_name, cross_val_folder, probs_folder):
+def main(db_fpath, db_name, cross_val_folder, probs_folder, cache_folder=None):
     
     #get cross validation dicts
     user_items_to_filter, user_validation_tags, user_test_tags = \
@@ -117,8 +119,11 @@ def main(db_fpath, db_name, cross_val_folder, probs_folder):
         reader.change_table(db_name)
         
         annot_filter = FilteredUserItemAnnotations(user_items_to_filter)
-        est = PrecomputedEstimator(probs_folder)
-        run_exp(user_validation_tags, user_test_tags, est, annot_filter, reader)
+        index_cache = IndexCache(cache_folder, db_fpath, db_name,
+                os.path.join(cross_val_folder, 'user_item_filter.dat'))
+        est = PrecomputedEstimator(probs_folder, lazy=True)
+        run_exp(user_validation_tags, user_test_tags, est, annot_filter, reader,
+                index_cache)
     
 if __name__ == '__main__':
     sys.exit(plac.call(main))
\ No newline at end of file
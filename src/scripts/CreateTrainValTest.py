@@ -177,7 +177,7 @@ def sanity_check(reader, user_items_to_filter):
     filtered_users = set()
     filtered_items = set()
     filtered_tags = set()
-    for annotation in filtered.annotations(reader.iterate()):
+    for annotation in filtered.iterate(reader):
         user = annotation['user']
         item = annotation['item']
         tag = annotation['tag']
@@ -17,17 +17,27 @@ from itertools import combinations
 from random import seed
 from random import shuffle
 
+from multiprocessing.pool import ThreadPool
+
 from tagassess.dao.helpers import FilteredUserItemAnnotations
 from tagassess.dao.pytables.annotations import AnnotReader
+from tagassess.probability_estimates.base import set_num_threads
 from tagassess.probability_estimates.helpers import create_bayes_estimator
 from tagassess.probability_estimates.helpers import create_lda_estimator
+from tagassess.probability_estimates.precomputed_store import \
+        ProbabilityStoreWriter
 
+import json
 import numpy as np
 import multiprocessing
 import os
 import plac
+import resource
+import shutil
 import sys
 import tables
+import time
+import traceback
 
 #Parameter values considered
 #For the Bayes smooth, the paper plots -log10([2 .. 6]), thus values are
@@ -42,9 +52,76 @@ LDA_GAMMA_PARAMS = {'p1_gamma':[0.25, 0.5, 0.001, 0.01, 0.1, 25, 50],
 
 NUM_RANDOM_TAGS = 50
 
+#Parameters which do not change the counts an estimator is trained on. Cells
+#only differing in these are evaluated on the same trained estimator (e.g.
+#for the smooth estimator lambda only changes the smoothing formula and the
+#fraction of tags only the user profiles)
+REUSABLE_PARAMS = {'smooth':('p1_lambda', 'p2_fract_tags'),
+                   'lda':()}
+
+#Written to the folder of a cell once all of its results are saved. Cells
+#with this file are skipped when the search is restarted
+DONE_MARKER = 'done.json'
+
+#Status of every cell run, and the last error of cells which failed
+REPORT_FILE = 'grid-report.tsv'
+FAILED_FILE = 'failed-cells.txt'
+
+#Seconds between checks of running job processes
+POLL_INTERVAL = 1
+
+#Estimator and tags used by `compute_user`. Set by `run_exp` before workers
+#are created, so that forked processes share the trained estimator
+_USER_EXP = None
+
+def compute_user(user):
+    '''Computes p(i|u) and p(i|t,u) for one user (see `run_exp`)'''
+    est, gamma_items, random_tags, user_validation_tags, user_test_tags = \
+            _USER_EXP
+    
+    probs_i_given_u = est.prob_items_given_user(user, gamma_items)
+    
+    tags_for_user = set()
+    for tag in random_tags:
+        tags_for_user.add(tag)
+    
+    for tag in user_validation_tags[user]:
+        tags_for_user.add(tag)
+    
+    for tag in user_test_tags[user]:
+        tags_for_user.add(tag)
+    
+    probs_i_given_u_t = {}
+    for tag in tags_for_user:
+        probs_i_given_u_t[tag] = est.prob_items_given_user_tag(user, tag, 
+                gamma_items)
+    
+    return user, probs_i_given_u, probs_i_given_u_t
+
+def create_pool(num_workers):
+    '''
+    Creates a pool of processes, or of threads if running in a pool worker
+    (daemonic processes cannot have children).
+    
+    Estimators use OpenMP, so each worker is limited to one OpenMP thread 
+    (see `set_num_threads`). Processes are forked after the estimator is 
+    trained, and with libgomp a forked child starting a parallel region with
+    more threads than one may hang. For threads this avoids starting 
+    `num_workers` full OpenMP teams.
+    '''
+    if multiprocessing.current_process().daemon:
+        return ThreadPool(num_workers, set_num_threads, (1,))
+    return multiprocessing.Pool(num_workers, set_num_threads, (1,))
+
 def run_exp(user_items_to_filter, user_validation_tags, user_test_tags, 
-        user_to_item, num_items, random_tags, est, output_folder, save_lhood):
-    '''Computes probabilities for one user and saves results to files'''
+        user_to_item, num_items, random_tags, est, output_folder, save_lhood,
+        num_workers=1):
+    '''
+    Computes probabilities for each user and saves results to files. Users
+    are split among `num_workers` workers, results are written by this 
+    process only. Returns the number of users.
+    '''
+    global _USER_EXP
     
     #Save train data if necessary
     if save_lhood:
@@ -57,41 +134,41 @@ def run_exp(user_items_to_filter, user_validation_tags, user_test_tags,
         train_h5file.createArray(train_h5file.root, 'chain', chain)
         train_h5file.createArray(train_h5file.root, 'likelihood',
                 np.array([log_likelihood]))
+        train_h5file.createArray(train_h5file.root, 'burn_in',
+                np.array([est.get_burn_in()]))
 
         train_h5file.close()
-
-    #Run experiment
-    for user in user_items_to_filter:
-        
-        user_fpath = os.path.join(output_folder, 'user-%d.h5' % user)
-        user_h5file = tables.openFile(user_fpath, mode='w')
-        
-        gamma_items = [item for item in xrange(num_items) 
-                            if item not in user_to_item[item]]
-        
-        gamma_items = np.asarray(gamma_items)
-        user_h5file.createArray(user_h5file.root, 'gamma', gamma_items)
-        
-        probs_i_given_u = est.prob_items_given_user(user, gamma_items)
-        user_h5file.createArray(user_h5file.root, 'piu', probs_i_given_u)
-
-        tags_for_user = set()
-        for tag in random_tags:
-            tags_for_user.add(tag)
-        
-        for tag in user_validation_tags[user]:
-            tags_for_user.add(tag)
-        
-        for tag in user_test_tags[user]:
-            tags_for_user.add(tag)
-        
-        for tag in tags_for_user:
-            probs_i_given_u_t = est.prob_items_given_user_tag(user, tag, 
-                gamma_items)
-            user_h5file.createArray(user_h5file.root, 'pitu_tag_%d' % tag, 
-                    probs_i_given_u_t)
-            
-        user_h5file.close()
+    
+    #Items i such that i is in user_to_item[i] are not in gamma. This is the
+    #same for every user, so it is computed once.
+    gamma_items = np.asarray([item for item in xrange(num_items) 
+                              if item not in user_to_item.get(item, ())])
+    
+    _USER_EXP = (est, gamma_items, random_tags, user_validation_tags, 
+                 user_test_tags)
+    users = list(user_items_to_filter)
+    
+    pool = None
+    if num_workers > 1:
+        pool = create_pool(num_workers)
+        chunksize = max(1, len(users) // (num_workers * 8))
+        results = pool.imap(compute_user, users, chunksize)
+    else:
+        results = (compute_user(user) for user in users)
+    
+    #Run experiment, probabilities are saved to a single store (see
+    #tagassess.probability_estimates.precomputed_store)
+    try:
+        with ProbabilityStoreWriter(output_folder) as store:
+            for user, probs_i_given_u, probs_i_given_u_t in results:
+                store.add_user(user, gamma_items, probs_i_given_u, 
+                               probs_i_given_u_t)
+        return len(users)
+    finally:
+        _USER_EXP = None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
 def load_dict_from_file(fpath):
     '''Loads dictionary from file'''
@@ -143,11 +220,15 @@ def run_one(args):
        output folder. This provides sufficient information for choosing the best
        estimator (on the validation set) and performing further experiments 
        (actually computing tag values) on the test set.  
+    
+    Steps 1 to 3 (except for the estimator parameters) are the same for every
+    cell in `cells`, which are evaluated in order. When possible (see 
+    `REUSABLE_PARAMS`) the estimator is trained only for the first cell.
     '''
     
     #unbox arguments
     db_fpath, db_name, output_folder, cross_val_folder, est_name, \
-            param_one, value_one, param_two, value_two = args
+            cells, checkpoint_folder, convergence_tol, user_workers = args
     
     #get cross validation dicts
     user_items_to_filter, user_validation_tags, user_test_tags = \
@@ -167,7 +248,7 @@ def run_one(args):
         
         #Generate 50 random tags not used by any user in validation or test
         #Also creates some indexes used to define gamma items
-        annotations = annot_filter.annotations(reader.iterate())
+        annotations = annot_filter.iterate(reader)
         user_to_item = defaultdict(set)
         items = set()
         tags = set()
@@ -191,25 +272,218 @@ def run_one(args):
         num_items = len(items)
         num_tags = len(tags)
         
-        #Create estimator
-        annotations = annot_filter.annotations(reader.iterate())
-        save_lhood = False
-        if est_name == 'lda':
-            est = create_lda_estimator(annotations, value_one, 
-                num_items, num_tags, value_two)
-            save_lhood = True
-        else:
-            est = create_bayes_estimator(annotations, value_one, value_two)
+        est = None
+        results = []
+        for cell in cells:
+            param_one, value_one, param_two, value_two = cell
+            param_name = cell_name(cell)
+            param_out_folder = os.path.join(output_folder, param_name)
+            
+            #Leftovers of a run which did not finish
+            if os.path.exists(param_out_folder):
+                shutil.rmtree(param_out_folder)
+            
+            start = time.time()
+            try:
+                save_lhood = False
+                if est_name == 'lda':
+                    checkpoint_fpath = None
+                    if checkpoint_folder is not None:
+                        checkpoint_fpath = os.path.join(checkpoint_folder, 
+                                                        param_name + '.npz')
+                    
+                    annotations = annot_filter.iterate(reader)
+                    est = create_lda_estimator(annotations, value_one, 
+                        num_items, num_tags, value_two, 
+                        checkpoint_fpath=checkpoint_fpath, 
+                        convergence_tol=convergence_tol)
+                    save_lhood = True
+                elif est is None:
+                    annotations = annot_filter.iterate(reader)
+                    est = create_bayes_estimator(annotations, value_one, 
+                                                 value_two)
+                else: #Same counts, only lambda and profile size change
+                    est.set_params(lambda_=value_one, 
+                                   user_profile_fract_size=value_two)
+                
+                os.mkdir(param_out_folder)
+                num_users = run_exp(user_items_to_filter, 
+                        user_validation_tags, user_test_tags, user_to_item, 
+                        num_items, random_tags, est, param_out_folder, 
+                        save_lhood, user_workers)
+            except Exception:
+                #The estimator may be half updated, the next cell retrains
+                est = None
+                results.append((cell, False, time.time() - start, 0, 
+                                traceback.format_exc()))
+                continue
+            
+            elapsed = time.time() - start
+            with open(os.path.join(param_out_folder, DONE_MARKER), 'w') as \
+                    marker:
+                json.dump({'elapsed':elapsed, 'num_users':num_users}, marker)
+            results.append((cell, True, elapsed, num_users, None))
         
-        param_out_folder = os.path.join(output_folder, \
-                'params-%s-%f_%s-%f' % \
-                (param_one, value_one, param_two, value_two))
-
-        os.mkdir(param_out_folder)
-        run_exp(user_items_to_filter, user_validation_tags, user_test_tags,
-                user_to_item, num_items, random_tags, est, param_out_folder,
-                save_lhood)
+        return results
+
+def run_job(args):
+    '''
+    Calls `run_one` and returns its results. Errors before cells are
+    evaluated (e.g. loading the data) fail every cell of the job.
+    '''
+    cells = args[5]
+    start = time.time()
+    try:
+        return run_one(args)
+    except Exception:
+        error = traceback.format_exc()
+        return [(cell, False, time.time() - start, 0, error) 
+                for cell in cells]
+
+def limit_memory(max_memory_mb):
+    '''
+    Limits the address space of this process, so that jobs using too much
+    memory fail with MemoryError instead of being killed. The limit cannot
+    be raised again, only call this in job processes.
+    '''
+    if max_memory_mb > 0:
+        max_bytes = max_memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+def job_process(args, conn, max_memory_mb):
+    '''Target of job processes, sends the results of `run_job` to `conn`'''
+    limit_memory(max_memory_mb)
+    conn.send(run_job(args))
+    conn.close()
+
+def crashed_job_results(args, exitcode):
+    '''
+    Results of a job whose process died without sending them. Cells saved 
+    before the crash are done, the remaining ones failed.
+    '''
+    output_folder, cells = args[2], args[5]
+    error = 'Job process exited with code %s\n' % exitcode
+    
+    results = []
+    for cell in cells:
+        if is_done(output_folder, cell):
+            marker_fpath = os.path.join(output_folder, cell_name(cell), 
+                                        DONE_MARKER)
+            with open(marker_fpath) as marker_file:
+                marker = json.load(marker_file)
+            results.append((cell, True, marker['elapsed'], 
+                            marker['num_users'], None))
+        else:
+            results.append((cell, False, 0, 0, error))
+    return results
+
+def receive_results(conn):
+    '''
+    Receives the results sent by `job_process` to `conn`, or None if the 
+    process died and the pipe was closed without them.
+    '''
+    try:
+        return conn.recv()
+    except EOFError:
+        return None
+
+def run_jobs(jobs, num_cores, max_memory_mb):
+    '''
+    Runs each job in a new process, at most `num_cores` at a time, and 
+    generates the results of each job (see `run_one`) as they finish. A 
+    process which dies (e.g. killed by the kernel for using too much memory,
+    or a crash on compiled code) fails the cells of its job which were not
+    saved.
+    
+    Job processes are not daemonic, so users of a cell can still be split 
+    among processes (see `create_pool`).
+    '''
+    jobs = list(jobs)
+    running = {}
+    try:
+        while jobs or running:
+            while jobs and len(running) < num_cores:
+                args = jobs.pop(0)
+                recv_conn, send_conn = multiprocessing.Pipe(False)
+                process = multiprocessing.Process(target=job_process, 
+                        args=(args, send_conn, max_memory_mb))
+                process.start()
+                send_conn.close()
+                running[recv_conn] = (process, args)
+            
+            finished = []
+            for conn, (process, args) in running.items():
+                if conn.poll():
+                    results = receive_results(conn)
+                elif not process.is_alive():
+                    #Results may have been sent just before the process
+                    #exited, after the poll above
+                    if conn.poll():
+                        results = receive_results(conn)
+                    else:
+                        results = None
+                else:
+                    continue
                 
+                process.join()
+                if results is None:
+                    results = crashed_job_results(args, process.exitcode)
+                finished.append(conn)
+                yield results
+            
+            for conn in finished:
+                conn.close()
+                del running[conn]
+            
+            if not finished:
+                time.sleep(POLL_INTERVAL)
+    finally:
+        for process, _ in running.values():
+            process.terminate()
+            process.join()
+
+def cell_name(cell):
+    '''Name of the output folder of a cell'''
+    return 'params-%s-%f_%s-%f' % cell
+
+def is_done(output_folder, cell):
+    '''Indicates if the results of the cell were all saved'''
+    return os.path.exists(os.path.join(output_folder, cell_name(cell), 
+                                       DONE_MARKER))
+
+def grid_cells(params):
+    '''
+    Generates the cells of the grid, (param_one, value_one, param_two, 
+    value_two), for every pair of parameters.
+    '''
+    for param_one, param_two in combinations(sorted(params.keys()), 2):
+        values_one = params[param_one]
+        values_two = params[param_two]
+        
+        for i in range(len(values_one)):
+            for j in range(len(values_two)):
+                yield param_one, values_one[i], param_two, values_two[j]
+
+def group_cells(est_name, cells):
+    '''
+    Splits cells in lists of cells which only differ in `REUSABLE_PARAMS`, so
+    that they can be evaluated with a single trained estimator.
+    '''
+    reusable = REUSABLE_PARAMS[est_name]
+    groups = {}
+    keys = []
+    for cell in cells:
+        fixed = tuple((name, value) for name, value in (cell[:2], cell[2:])
+                      if name not in reusable)
+        
+        key = (cell[0], cell[2], fixed)
+        if key not in groups:
+            groups[key] = []
+            keys.append(key)
+        groups[key].append(cell)
+    
+    return [groups[key] for key in keys]
+
 @plac.annotations(
     db_fpath = plac.Annotation('H5 database file', type=str),
     db_name = plac.Annotation('H5 database name', type=str),
@@ -220,16 +494,39 @@ def run_one(args):
             choices=['lda', 'smooth'], kind='option'),
     rand_seed = plac.Annotation('Random seed to use (None = default seed)',
             type=int, kind='option'),
-    num_cores = plac.Annotation('Number of cores to use', type=int))
+    num_cores = plac.Annotation('Number of cores to use', type=int),
+    checkpoint_folder = plac.Annotation('Folder to save LDA checkpoints. ' + 
+            'Runs resume from checkpoints found here', type=str, 
+            kind='option'),
+    convergence_tol = plac.Annotation('Stop LDA sampling once the chain ' + 
+            'converges with this tolerance (0 = fixed iterations)', 
+            type=float, kind='option'),
+    user_workers = plac.Annotation('Number of workers computing ' +
+            'probabilities of users in each cell (0 = the number of cores ' +
+            'when a single group of cells is evaluated, e.g. for the smooth ' +
+            'estimator, whose cells are all evaluated on one trained ' +
+            'estimator, else 1)', type=int, kind='option'),
+    max_retries = plac.Annotation('Number of times failed cells are ' +
+            'retried', type=int, kind='option'),
+    max_memory_mb = plac.Annotation('Memory limit, in MB, of each process ' +
+            'running cells (0 = no limit)', type=int, kind='option'))
 def main(db_fpath, db_name, cross_val_folder, output_folder, est_name, 
-         rand_seed=None, num_cores=-1):
-    '''Dispatches jobs in multiple cores'''
+         rand_seed=None, num_cores=-1, checkpoint_folder=None,
+         convergence_tol=0, user_workers=0, max_retries=1, max_memory_mb=0):
+    '''
+    Dispatches jobs in multiple cores, each group of cells runs in its own
+    process (see `run_jobs`). Cells already done (see `DONE_MARKER`)
+    are skipped, so an interrupted search is resumed by running it again on
+    the same output folder. Failed cells are retried up to `max_retries`
+    times and are listed on `FAILED_FILE`.
+    '''
     
     seed(rand_seed)
     
     #Basic asserts for the folder
     assert os.path.isdir(output_folder)
-    assert len(os.listdir(output_folder)) == 0
+    if checkpoint_folder is not None:
+        assert os.path.isdir(checkpoint_folder)
     
     if est_name == 'lda':
         params = LDA_GAMMA_PARAMS
@@ -240,26 +537,65 @@ def main(db_fpath, db_name, cross_val_folder, output_folder, est_name,
     
     if num_cores <= 0:
         num_cores = multiprocessing.cpu_count()
-        
-    pool = multiprocessing.Pool(num_cores)
     
-    def params_generator():
+    cells = list(grid_cells(params))
+    pending = [cell for cell in cells if not is_done(output_folder, cell)]
+    print('%d of %d cells already done' % (len(cells) - len(pending), 
+                                          len(cells)), file=sys.stderr)
+    
+    def params_generator(cells):
         '''Generates arguments for each core to use'''
-        for param_one, param_two in combinations(sorted(params.keys()), 2):
-            values_one = params[param_one]
-            values_two = params[param_two]
+        groups = group_cells(est_name, cells)
+        
+        #A single group runs alone, its users are split among the cores
+        workers = user_workers
+        if workers <= 0:
+            workers = num_cores if len(groups) == 1 else 1
+        
+        for group in groups:
+            yield db_fpath, db_name, output_folder, cross_val_folder, \
+                    est_name, group, checkpoint_folder, convergence_tol, \
+                    workers
+    
+    errors = {}
+    report_fpath = os.path.join(output_folder, REPORT_FILE)
+    with open(report_fpath, 'a') as report:
+        for attempt in range(max_retries + 1):
+            if not pending:
+                break
             
-            for i in range(len(values_one)):
-                for j in range(len(values_two)):
-                    val_one = values_one[i]
-                    val_two = values_two[j]
-
-                    yield db_fpath, db_name, output_folder, cross_val_folder, \
-                        est_name, param_one, val_one, param_two, val_two
+            results = run_jobs(params_generator(pending), num_cores, 
+                               max_memory_mb)
+            
+            pending = []
+            for job_results in results:
+                for cell, ok, elapsed, num_users, error in job_results:
+                    users_per_sec = num_users / elapsed if elapsed > 0 else 0
+                    status = 'done' if ok else 'failed'
+                    print('%s\t%s\t%d\t%.3f\t%d\t%.3f' % (cell_name(cell), 
+                          status, attempt, elapsed, num_users, users_per_sec),
+                          file=report)
+                    report.flush()
+                    
+                    print('%s %s in %.1fs (%.2f users/s)' % (cell_name(cell),
+                          status, elapsed, users_per_sec), file=sys.stderr)
+                    if ok:
+                        errors.pop(cell, None)
+                    else:
+                        errors[cell] = error
+                        pending.append(cell)
     
-    pool.map(run_one, params_generator()) #Run in parallel, go go cores!
-    pool.close()
-    pool.join()
+    failed_fpath = os.path.join(output_folder, FAILED_FILE)
+    if errors:
+        with open(failed_fpath, 'w') as failed_file:
+            for cell in sorted(errors):
+                print(cell_name(cell), file=failed_file)
+                print(errors[cell], file=failed_file)
+        print('%d cells failed, see %s' % (len(errors), failed_fpath), 
+              file=sys.stderr)
+        return 1
+    elif os.path.exists(failed_fpath):
+        os.remove(failed_fpath)
     
 if __name__ == '__main__':
     sys.exit(plac.call(main))
@@ -18,11 +18,16 @@ import sys
 
 def main(args=[]):
 
-    if len(args) < 4:
+    #Building indexes is expensive on large traces, they can be created
+    #later with AnnotWriter.create_indexes
+    create_indexes = '--no-index' not in args
+    args = [arg for arg in args if arg != '--no-index']
+
+    if len(args) < 5:
         types = '{flickr, delicious, bibsonomy, connotea, citeulike, lt}'
-        print('Usage %s %s %s %s %s'
+        print('Usage %s %s %s %s %s %s %s'
               %(args[0], '<annotation_file>', '<database_file>', '<ids folder>',
-                '<ftype = %s>' % types),
+                '<ftype = %s>' % types, '[num_workers = 1]', '[--no-index]'),
                 file=sys.stderr)
         return 1
 
@@ -37,6 +42,9 @@ def main(args=[]):
     db_fpath = args[2]
     ids_folder = args[3]
     func_name = args[4]
+    num_workers = 1
+    if len(args) > 5:
+        num_workers = int(args[5])
     
     if func_name not in func_map:
         print('ftype %s unknown'%func_name)
@@ -45,28 +53,24 @@ def main(args=[]):
 
     #Saving Table to PyTables
     parser = data_parser.Parser()
-    with open(in_fpath) as annotf, AnnotWriter(db_fpath) as writer:
-        writer.create_table(func_name)
-        
-        for annotation in parser.iparse(annotf, parse_func, sys.stderr):
-            writer.append_row(annotation)
-
-    #Saving IDs to text files
-    user_ids = parser.user_ids
-    item_ids = parser.item_ids
-    tag_ids = parser.tag_ids
-
-    with open(os.path.join(ids_folder, func_name + '.user'), 'w') as userf:
-        for user in sorted(user_ids, key=user_ids.__getitem__):
-            print(user[1], user_ids[user], file=userf)
-
-    with open(os.path.join(ids_folder, func_name + '.items'), 'w') as itemsf:
-        for item in sorted(item_ids, key=item_ids.__getitem__):
-            print(item[1], item_ids[item], file=itemsf)
+    with AnnotWriter(db_fpath) as writer:
+        #Rough number of lines (annotations), a hint for the chunk size
+        writer.create_table(func_name,
+                            expectedrows=os.path.getsize(in_fpath) // 50)
+        chunks = parser.iparse_columns(in_fpath, parse_func, num_workers,
+                                       sys.stderr)
+        writer.append_chunks(chunks)
+        if create_indexes:
+            writer.create_indexes()
 
-    with open(os.path.join(ids_folder, func_name + '.tags'), 'w') as tagsf:
-        for tag in sorted(tag_ids, key=tag_ids.__getitem__):
-            print(tag[1], tag_ids[tag], file=tagsf)
+    #Saving IDs to text files, and in binary form (see CompactID.load)
+    for ids, ext in ((parser.user_ids, '.user'), (parser.item_ids, '.items'),
+                     (parser.tag_ids, '.tags')):
+        ids_fpath = os.path.join(ids_folder, func_name + ext)
+        with open(ids_fpath, 'w') as idsf:
+            for id_, (_, key) in enumerate(ids):
+                print(key, id_, file=idsf)
+        ids.save(ids_fpath)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
\ No newline at end of file
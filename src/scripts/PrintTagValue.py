@@ -16,6 +16,7 @@ from random import shuffle
 
 from tagassess.dao.helpers import FilteredUserItemAnnotations
 from tagassess.dao.pytables.annotations import AnnotReader
+from tagassess.index_creator import IndexCache
 from tagassess.probability_estimates.helpers import create_bayes_estimator
 from tagassess.probability_estimates.helpers import create_lda_estimator
 from tagassess.value_calculator import ValueCalculator
@@ -91,9 +92,11 @@ def load_train_test_validation(cross_val_folder):
             choices=['lda', 'smooth'], kind='option'),
     rand_seed = plac.Annotation('Random seed to use (None = default seed)',
             type=int, kind='option'),
-    num_cores = plac.Annotation('Number of cores to use', type=int))
+    num_cores = plac.Annotation('Number of cores to use', type=int),
+    cache_folder = plac.Annotation('Folder to cache indexes built from ' +
+            'the database (None = no cache)', type=str, kind='option'))
 def main(db_fpath, db_name, cross_val_folder, param_value, est_name, 
-         rand_seed=None, num_cores=-1):
+         rand_seed=None, num_cores=-1, cache_folder=None):
     '''Dispatches jobs in multiple cores'''
     
     seed(rand_seed)
@@ -116,7 +119,7 @@ def main(db_fpath, db_name, cross_val_folder, param_value, est_name,
         
         #Generate 50 random tags not used by any user the test set
         #Also creates some indexes used to define gamma items
-        annotations = annot_filter.annotations(reader.iterate())
+        annotations = annot_filter.iterate(reader)
         user_to_item = defaultdict(set)
         items = set()
         tags = set()
@@ -141,15 +144,18 @@ def main(db_fpath, db_name, cross_val_folder, param_value, est_name,
         num_tags = len(tags)
         
         #Create estimator
-        annotations = annot_filter.annotations(reader.iterate())
+        annotations = annot_filter.iterate(reader)
         if est_name == 'lda':
             est = create_lda_estimator(annotations, param_value, 
                 num_items, num_tags)
         else:
             est = create_bayes_estimator(annotations, param_value)
 
-        annotations = annot_filter.annotations(reader.iterate())
-        value_calc = ValueCalculator(est, annotations)
+        index_cache = IndexCache(cache_folder, db_fpath, db_name,
+                os.path.join(cross_val_folder, 'user_item_filter.dat'))
+        tag_to_item = index_cache.occurrence_index('tag', 'item',
+                lambda: annot_filter.filter_chunks(reader.iter_chunks()))
+        value_calc = ValueCalculator(est, tag_to_item)
         
         run_exp(user_items_to_filter, user_test_tags, user_to_item, num_items, 
                 random_tags, value_calc)
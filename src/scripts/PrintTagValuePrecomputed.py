@@ -4,6 +4,7 @@ from __future__ import division, print_function
 
 from tagassess.dao.helpers import FilteredUserItemAnnotations
 from tagassess.dao.pytables.annotations import AnnotReader
+from tagassess.index_creator import IndexCache
 from tagassess.probability_estimates.precomputed import PrecomputedEstimator
 from tagassess.value_calculator import ValueCalculator
 
@@ -70,8 +71,10 @@ def load_train_test_validation(cross_val_folder):
     db_name = plac.Annotation('H5 database name', type=str),
     cross_val_folder = plac.Annotation('Folder with cross validation files', 
             type=str),
-    probs_folder = plac.Annotation('Probabilities Folder', type=str))
-def main(db_fpath, db_name, cross_val_folder, probs_folder):
+    probs_folder = plac.Annotation('Probabilities Folder', type=str),
+    cache_folder = plac.Annotation('Folder to cache indexes built from ' +
+            'the database (None = no cache)', type=str, kind='option'))
+def main(db_fpath, db_name, cross_val_folder, probs_folder, cache_folder=None):
     
     #get cross validation dicts
     user_items_to_filter, user_validation_tags, user_test_tags = \
@@ -81,10 +84,13 @@ def main(db_fpath, db_name, cross_val_folder, probs_folder):
         reader.change_table(db_name)
         
         annot_filter = FilteredUserItemAnnotations(user_items_to_filter)
-        annotations = annot_filter.annotations(reader.iterate())
+        index_cache = IndexCache(cache_folder, db_fpath, db_name,
+                os.path.join(cross_val_folder, 'user_item_filter.dat'))
+        tag_to_item = index_cache.occurrence_index('tag', 'item',
+                lambda: annot_filter.filter_chunks(reader.iter_chunks()))
         
-        est = PrecomputedEstimator(probs_folder)
-        value_calc = ValueCalculator(est, annotations)
+        est = PrecomputedEstimator(probs_folder, lazy=True)
+        value_calc = ValueCalculator(est, tag_to_item)
         
         run_exp(user_validation_tags, user_test_tags, est, value_calc)
     
@@ -0,0 +1,290 @@
+# -*- coding: utf8
+'''CompactID class'''
+
+from __future__ import print_function, division
+
+from array import array
+from collections import Mapping
+
+import numpy as np
+import struct
+
+#Integer types, long only exists on Python 2
+try:
+    _INT_TYPES = (int, long)
+except NameError:
+    _INT_TYPES = (int,)
+
+_LENGTH = struct.Struct('<I')
+
+#Empty slot of the hash table, and its initial number of slots
+_EMPTY = -1
+_MIN_SLOTS = 8
+
+def _to_bytes(key):
+    '''
+    Encodes a key as bytes, prefixed by its type: text (utf8), bytes, 
+    integers, floats or tuples of those (each element prefixed by its 
+    length). On Python 2 str is text.
+    '''
+    if isinstance(key, (str, type(u''))):
+        if not isinstance(key, bytes):
+            key = key.encode('utf8')
+        return b's' + key
+    elif isinstance(key, bytes):
+        return b'b' + key
+    elif isinstance(key, _INT_TYPES):
+        return b'i' + str(int(key)).encode('ascii')
+    elif isinstance(key, float):
+        return b'f' + repr(key).encode('ascii')
+    elif isinstance(key, tuple):
+        parts = [b't']
+        for element in key:
+            raw = _to_bytes(element)
+            parts.append(_LENGTH.pack(len(raw)))
+            parts.append(raw)
+        return b''.join(parts)
+    
+    raise TypeError('Unsupported key type %s' % type(key))
+
+def _from_bytes(raw):
+    '''Inverse of `_to_bytes`'''
+    #On Python 2 bytes is str, which gives the repr of arrays
+    if isinstance(raw, np.ndarray):
+        raw = raw.tobytes()
+    else:
+        raw = bytes(raw)
+    kind, value = raw[:1], raw[1:]
+    if kind == b's':
+        return value if str is bytes else value.decode('utf8')
+    elif kind == b'b':
+        return value
+    elif kind == b'i':
+        return int(value)
+    elif kind == b'f':
+        return float(value)
+    
+    key = []
+    pos = 0
+    while pos < len(value):
+        length, = _LENGTH.unpack_from(value, pos)
+        pos += _LENGTH.size
+        key.append(_from_bytes(value[pos:pos + length]))
+        pos += length
+    return tuple(key)
+
+class CompactID(Mapping):
+    '''
+    A compact version of `ContiguousID`. Keys are mapped to contiguous 
+    integers (in order of first access) and are stored once, encoded as 
+    bytes, in a contiguous byte arena. Key `i` spans 
+    `arena[offsets[i]:offsets[i + 1]]`, so the reverse lookup does not need a
+    second dict.
+
+    Lookups do not use a dict either. Ids are kept in an open addressing
+    hash table (`slots`, an int64 array) with linear probing, and the hash
+    of each key is kept in `hashes`. A candidate id is compared with the
+    key through its hash and then its arena slice. Besides the arena, a key
+    costs 16 bytes (hash and offset) plus at most 24 bytes of slots.
+
+    Keys may be text, bytes, integers, floats or tuples of those, and reverse
+    lookups return keys of the same type. Keys of different types are 
+    different keys, i.e., 1 and '1' (or 1 and 1.0) get different ids.
+
+    Example:
+
+    >>> x = CompactID()
+    >>> x['a']
+    0
+    >>> x['b']
+    1
+    >>> x['a']
+    0
+    >>> x.reverse_lookup(1)
+    'b'
+
+    The arena and the offsets can be saved with `save` and memory mapped back
+    with `load`. The hash table is only rebuilt if keys are looked up,
+    reverse lookups and iteration use the mapped arrays directly.
+    '''
+
+    def __init__(self):
+        '''
+        Creates a new empty mapping.
+        '''
+        self.slots = array('q', [_EMPTY]) * _MIN_SLOTS
+        self.hashes = array('q')
+        self.arena = bytearray()
+        self.offsets = array('q', [0])
+        self.mapped = False
+
+    def __materialize(self):
+        '''
+        Copies mapped arrays to memory, so that new keys can be added, and
+        rebuilds the hash table.
+        '''
+        if not self.mapped:
+            return
+
+        arena = bytearray(np.asarray(self.arena).tobytes())
+        offsets = array('q', np.asarray(self.offsets, dtype=np.int64).tolist())
+
+        self.hashes = array('q', (hash(bytes(arena[offsets[id_]:
+                                                   offsets[id_ + 1]]))
+                                  for id_ in range(len(offsets) - 1)))
+        self.arena = arena
+        self.offsets = offsets
+        self.mapped = False
+        self.__rehash(_MIN_SLOTS)
+
+    def __rehash(self, min_slots):
+        '''
+        Rebuilds the hash table with at least `min_slots` slots, keeping the
+        load factor below 2/3. Keys are not hashed again.
+        '''
+        num_slots = min_slots
+        while 3 * len(self.hashes) >= 2 * num_slots:
+            num_slots *= 2
+
+        mask = num_slots - 1
+        slots = array('q', [_EMPTY]) * num_slots
+        for id_, hash_ in enumerate(self.hashes):
+            pos = hash_ & mask
+            while slots[pos] != _EMPTY:
+                pos = (pos + 1) & mask
+            slots[pos] = id_
+        self.slots = slots
+
+    def __find(self, raw, hash_):
+        '''
+        Returns the id of the encoded key `raw`, with hash `hash_`, or the
+        negative of (slot + 1) where it should be inserted if it is new.
+        '''
+        slots = self.slots
+        mask = len(slots) - 1
+        pos = hash_ & mask
+        while True:
+            id_ = slots[pos]
+            if id_ == _EMPTY:
+                return -(pos + 1)
+            if self.hashes[id_] == hash_ and \
+                    self.arena[self.offsets[id_]:self.offsets[id_ + 1]] == raw:
+                return id_
+            pos = (pos + 1) & mask
+
+    def __getitem__(self, key):
+        '''
+        Get's the value associated with the item. If the item has already been
+        "looked up" it returns the previous key. Else, it will return the next
+        integer beginning with 0.
+        '''
+        self.__materialize()
+
+        raw = _to_bytes(key)
+        hash_ = hash(raw)
+        id_ = self.__find(raw, hash_)
+        if id_ < 0:
+            self.slots[-id_ - 1] = len(self.hashes)
+            id_ = len(self.hashes)
+            self.hashes.append(hash_)
+            self.arena.extend(raw)
+            self.offsets.append(len(self.arena))
+            if 3 * len(self.hashes) >= 2 * len(self.slots):
+                self.__rehash(2 * len(self.slots))
+        return id_
+
+    def __contains__(self, key):
+        self.__materialize()
+        try:
+            raw = _to_bytes(key)
+        except TypeError:
+            return False
+        return self.__find(raw, hash(raw)) >= 0
+
+    def encode(self, keys):
+        '''
+        Returns the ids of every key in `keys` as an int32 array. New keys
+        get ids in order of first appearance, the same as looking up each key
+        in order. For arrays, only distinct keys are looked up one by one.
+
+        Arguments
+        ---------
+        keys: array or list
+            The keys to encode. Lists may hold keys of any supported type, 
+            arrays must be one dimensional arrays of text or numbers.
+        '''
+        if not isinstance(keys, np.ndarray):
+            return np.array([self[key] for key in keys], dtype=np.int32)
+
+        if keys.shape[0] == 0:
+            return np.zeros(0, dtype=np.int32)
+
+        unique, first, inverse = np.unique(keys, return_index=True,
+                                           return_inverse=True)
+        ids = np.zeros(unique.shape[0], dtype=np.int32)
+        for i in np.argsort(first, kind='mergesort'):
+            key = unique[i]
+            if isinstance(key, np.generic):
+                key = key.item()
+            ids[i] = self[key]
+
+        return ids[inverse.ravel()]
+
+    def reverse_lookup(self, id_):
+        '''Returns the key of the given id'''
+        if id_ < 0 or id_ >= len(self):
+            raise KeyError(id_)
+        return _from_bytes(self.arena[self.offsets[id_]:self.offsets[id_ + 1]])
+
+    def save(self, fpath):
+        '''
+        Saves the ids to `fpath` + '.arena' (raw bytes) and `fpath` +
+        '.offsets.npy' (int64), both can be memory mapped by `load`.
+
+        Arguments
+        ---------
+        fpath: str
+            Path prefix of the files
+        '''
+        with open(fpath + '.arena', 'wb') as arena_file:
+            arena_file.write(bytes(np.asarray(self.arena, dtype=np.uint8)
+                                   .tobytes()))
+        np.save(fpath + '.offsets.npy', np.asarray(self.offsets,
+                                                   dtype=np.int64))
+
+    @classmethod
+    def load(cls, fpath, mmap=True):
+        '''
+        Loads ids saved by `save`. With `mmap` the files are memory mapped
+        and only read when needed.
+
+        Arguments
+        ---------
+        fpath: str
+            Path prefix of the files
+        mmap: bool
+            Indicates if files are memory mapped
+        '''
+        rv = cls()
+        offsets = np.load(fpath + '.offsets.npy',
+                          mmap_mode='r' if mmap else None)
+
+        if offsets[-1] == 0: #np.memmap does not map empty files
+            arena = np.zeros(0, dtype=np.uint8)
+        elif mmap:
+            arena = np.memmap(fpath + '.arena', dtype=np.uint8, mode='r')
+        else:
+            arena = np.fromfile(fpath + '.arena', dtype=np.uint8)
+
+        rv.arena = arena
+        rv.offsets = offsets
+        rv.mapped = True
+        return rv
+
+    def __iter__(self):
+        '''Iterates over keys in order of ids'''
+        for id_ in range(len(self)):
+            yield self.reverse_lookup(id_)
+
+    def __len__(self):
+        return len(self.offsets) - 1
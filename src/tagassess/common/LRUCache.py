@@ -0,0 +1,85 @@
+# -*- coding: utf8
+'''LRUCache class'''
+
+from __future__ import print_function, division
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''
+    A size bounded cache of values loaded on demand. Values are loaded by
+    `load_func(key)` when a missing key is looked up, and the least recently
+    used values are evicted (calling `on_evict(key, value)`, e.g. to close
+    files) once the total size goes over `max_size`. The size of each value
+    is given by `size_func(value)`, by default every value has size one.
+    
+    Example:
+    
+    >>> cache = LRUCache(2, lambda key: key * 2)
+    >>> cache[1]
+    2
+    >>> cache[2]
+    4
+    >>> cache[3]
+    6
+    >>> 1 in cache
+    False
+    >>> (cache.hits, cache.misses)
+    (0, 3)
+    
+    The last value looked up is never evicted, even if larger than
+    `max_size`.
+    '''
+    
+    def __init__(self, max_size, load_func, size_func=None, on_evict=None):
+        self.max_size = max_size
+        self.load_func = load_func
+        self.size_func = size_func
+        self.on_evict = on_evict
+        
+        self.values = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        
+        self.hits = 0
+        self.misses = 0
+    
+    def __getitem__(self, key):
+        if key in self.values:
+            self.hits += 1
+            value = self.values.pop(key)
+            self.values[key] = value
+            return value
+        
+        self.misses += 1
+        value = self.load_func(key)
+        
+        size = 1
+        if self.size_func is not None:
+            size = self.size_func(value)
+        
+        self.values[key] = value
+        self.sizes[key] = size
+        self.size += size
+        
+        while self.size > self.max_size and len(self.values) > 1:
+            self.__evict()
+        return value
+    
+    def __evict(self):
+        '''Removes the least recently used value'''
+        key, value = self.values.popitem(last=False)
+        self.size -= self.sizes.pop(key)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+    
+    def __contains__(self, key):
+        return key in self.values
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def clear(self):
+        '''Evicts every value'''
+        while self.values:
+            self.__evict()
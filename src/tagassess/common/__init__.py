@@ -5,4 +5,6 @@ Common
 Common and utilities modules/classes.
 '''
 
-from .ContiguousID import ContiguousID
\ No newline at end of file
+from .CompactID import CompactID
+from .ContiguousID import ContiguousID
+from .LRUCache import LRUCache
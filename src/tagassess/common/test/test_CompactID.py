@@ -0,0 +1,126 @@
+# -*- coding: utf8
+#pylint: disable-msg=C0301
+#pylint: disable-msg=C0111
+#pylint: disable-msg=C0103
+
+from __future__ import print_function, division
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from tagassess.common import CompactID
+
+class TestCompactID(unittest.TestCase):
+
+    def test_all(self):
+        compact_id = CompactID()
+        self.assertEquals(compact_id['a'], 0)
+        self.assertEquals(compact_id['b'], 1)
+        self.assertEquals(compact_id[10], 2)
+
+        self.assertEquals(compact_id['a'], 0)
+        self.assertEquals(compact_id['10'], 3)
+        self.assertEquals(compact_id['hardware pc'], 4)
+
+        self.assertEquals(5, len(compact_id))
+        self.assertEquals(['a', 'b', 10, '10', 'hardware pc'], 
+                          list(compact_id))
+        self.assertEquals('hardware pc', compact_id.reverse_lookup(4))
+        self.assertEquals(10, compact_id.reverse_lookup(2))
+        self.assertRaises(KeyError, compact_id.reverse_lookup, 5)
+
+        self.assertTrue('b' in compact_id)
+        self.assertFalse('c' in compact_id)
+        self.assertFalse([1] in compact_id)
+        self.assertEquals(5, len(compact_id))
+
+    def test_key_types(self):
+        compact_id = CompactID()
+        keys = [(1, 'user'), (2, 'user'), (1, u'caf\xe9'), 1.5, -3,
+                ((1, 2), 'a'), ()]
+        for i, key in enumerate(keys):
+            self.assertEquals(i, compact_id[key])
+
+        self.assertEquals(keys, list(compact_id))
+        self.assertEquals(0, compact_id[(1, 'user')])
+        self.assertTrue((2, 'user') in compact_id)
+        self.assertFalse((3, 'user') in compact_id)
+        self.assertRaises(TypeError, compact_id.__getitem__, [1])
+
+    def test_many_keys(self):
+        #Enough keys to grow the hash table several times
+        compact_id = CompactID()
+        keys = ['tag%d' % i for i in range(5000)] + list(range(5000))
+        for i, key in enumerate(keys):
+            self.assertEquals(i, compact_id[key])
+
+        for i, key in enumerate(keys):
+            self.assertEquals(i, compact_id[key])
+            self.assertTrue(key in compact_id)
+        self.assertEquals(keys, list(compact_id))
+        self.assertFalse('tag5000' in compact_id)
+
+    def test_encode(self):
+        compact_id = CompactID()
+        compact_id['z']
+
+        ids = compact_id.encode(np.array(['y', 'z', 'x', 'y', 'w', 'x']))
+        self.assertEquals([1, 0, 2, 1, 3, 2], list(ids))
+        self.assertEquals(np.int32, ids.dtype)
+        self.assertEquals(['z', 'y', 'x', 'w'], list(compact_id))
+
+        self.assertEquals([4, 0], list(compact_id.encode([7, 'z'])))
+        self.assertEquals(7, compact_id.reverse_lookup(4))
+        self.assertEquals([5, 5, 0], 
+                          list(compact_id.encode([(1, 'z'), (1, 'z'), 'z'])))
+        self.assertEquals(0, compact_id.encode([]).shape[0])
+
+    def test_save_load(self):
+        folder = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(folder, 'ids')
+
+            compact_id = CompactID()
+            compact_id.encode(['tinker', 'hardware', 'hardware pc'])
+            compact_id.save(fpath)
+
+            for mmap in [True, False]:
+                loaded = CompactID.load(fpath, mmap)
+                self.assertEquals(list(compact_id), list(loaded))
+                self.assertEquals('hardware', loaded.reverse_lookup(1))
+
+                self.assertEquals(2, loaded['hardware pc'])
+                self.assertEquals(3, loaded['bala'])
+                self.assertEquals(4, len(loaded))
+
+            empty = CompactID()
+            empty.save(fpath)
+            self.assertEquals(0, len(CompactID.load(fpath)))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_save_load_reverse_lookup(self):
+        folder = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(folder, 'ids')
+
+            keys = [(1, 'user'), (3, ('item', 2)), 7, 'tag', 2.5, -1]
+            compact_id = CompactID()
+            compact_id.encode(keys)
+            compact_id.save(fpath)
+
+            #Mapped arrays are used until a key is looked up
+            for mmap in [True, False]:
+                loaded = CompactID.load(fpath, mmap)
+                for i, key in enumerate(keys):
+                    self.assertEquals(key, loaded.reverse_lookup(i))
+                self.assertEquals(keys, list(loaded))
+        finally:
+            shutil.rmtree(folder)
+
+if __name__ == "__main__":
+    unittest.main()
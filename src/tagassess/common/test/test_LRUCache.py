@@ -0,0 +1,56 @@
+# -*- coding: utf8
+#pylint: disable-msg=C0301
+#pylint: disable-msg=C0111
+#pylint: disable-msg=C0103
+
+from __future__ import print_function, division
+
+import unittest
+
+from tagassess.common import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_count_bounded(self):
+        loaded = []
+        evicted = []
+        def load(key):
+            loaded.append(key)
+            return str(key)
+        
+        cache = LRUCache(3, load, on_evict=lambda k, v: evicted.append((k, v)))
+        for key in [1, 2, 3, 1, 4, 1, 5, 2]:
+            self.assertEquals(str(key), cache[key])
+        
+        #1 is kept since it is always recently used
+        self.assertEquals([1, 2, 3, 4, 5, 2], loaded)
+        self.assertEquals([(2, '2'), (3, '3'), (4, '4')], evicted)
+        self.assertEquals(2, cache.hits)
+        self.assertEquals(6, cache.misses)
+        self.assertEquals(3, len(cache))
+        self.assertTrue(1 in cache)
+        self.assertFalse(4 in cache)
+        
+        cache.clear()
+        self.assertEquals(0, len(cache))
+        self.assertEquals(0, cache.size)
+        self.assertEquals(6, len(evicted))
+
+    def test_size_bounded(self):
+        cache = LRUCache(10, lambda key: 'x' * key, size_func=len)
+        cache[4]
+        cache[5]
+        self.assertEquals(9, cache.size)
+        cache[3]
+        self.assertEquals(8, cache.size)
+        self.assertFalse(4 in cache)
+        
+        #Larger than the bound, still kept until the next lookup
+        self.assertEquals('x' * 20, cache[20])
+        self.assertEquals(1, len(cache))
+        self.assertEquals(20, cache.size)
+        cache[1]
+        self.assertEquals(1, cache.size)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,6 +5,12 @@ Contains base classes for accessing data stored on DBs.
 from __future__ import division, print_function
 
 import abc
+import numpy as np
+
+def _rows_to_columns(rows):
+    '''Converts (user, item, tag, date) tuples to four column arrays'''
+    rows = np.array(rows, dtype='i8').reshape((len(rows), 4))
+    return tuple(rows[:, j].astype('i4') for j in range(4))
 
 class Base(object):
     '''
@@ -66,6 +72,40 @@ class Reader(Base):
         Each element of the iterator should be a dict
         '''
         pass
+
+    def iter_chunks(self, chunk_size=2 ** 20, query=None, **kwargs):
+        '''
+        Returns a iterator of (user, item, tag, date) column arrays, with at
+        most `chunk_size` annotations each. Subclasses should override this 
+        with a bulk read, the default converts the rows from `iterate`.
+        
+        Arguments
+        ---------
+        chunk_size: int
+            Maximum number of annotations in each chunk
+        query (optional): any (depends on subclass)
+            A query to filter some rows
+        '''
+        fields = ('user', 'item', 'tag', 'date')
+        rows = []
+        for row in self.iterate(query, **kwargs):
+            rows.append(tuple(row[field] for field in fields))
+            if len(rows) == chunk_size:
+                yield _rows_to_columns(rows)
+                rows = []
+        
+        if rows:
+            yield _rows_to_columns(rows)
+
+    def read_columns(self, query=None, **kwargs):
+        '''
+        Returns the (user, item, tag, date) columns of every annotation, or of
+        the ones which match `query`.
+        '''
+        chunks = list(self.iter_chunks(query=query, **kwargs))
+        if not chunks:
+            return _rows_to_columns([])
+        return tuple(np.concatenate(column) for column in zip(*chunks))
     
 class Writer(Base):
     '''
@@ -85,6 +125,21 @@ class Writer(Base):
         '''
         pass
 
+    def append_rows(self, user, item, tag, date, **kwargs):
+        '''
+        Appends the annotations given as columns to the end of the table.
+        Subclasses should override this with a bulk write, the default 
+        calls `append_row` for each annotation.
+        
+        Arguments
+        ---------
+        user, item, tag, date: array like
+            Columns of the annotations, all of the same size
+        '''
+        for i in range(len(user)):
+            self.append_row({'user':user[i], 'item':item[i], 'tag':tag[i],
+                             'date':date[i]}, **kwargs)
+
     @abc.abstractmethod
     def create_table(self, tname, **kwargs):
         '''
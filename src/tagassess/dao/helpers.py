@@ -4,11 +4,87 @@ Contains helpers classes for filtering data stored on DBs.
 '''
 from __future__ import division, print_function
 
+import numpy as np
+
+#Number of annotations tested at once when filtering iterators of dicts
+BLOCK_SIZE = 2 ** 16
+
+def pack_user_items(users, items):
+    '''
+    Packs user and item ids in a single int64 key (user << 32 | item)
+
+    Arguments
+    ---------
+    users : int array
+        User ids
+    items : int array
+        Item ids, (same size as users)
+    '''
+    users = np.asarray(users, dtype=np.int64)
+    items = np.asarray(items, dtype=np.int64)
+    return (users << 32) | (items & 0xFFFFFFFF)
+
+def iterate_columns(chunks):
+    '''
+    Converts (user, item, tag, date) column chunks to annotations (dicts),
+    i.e, the same annotations as the `iterate` method of readers.
+    '''
+    for user, item, tag, date in chunks:
+        user = user.tolist()
+        item = item.tolist()
+        tag = tag.tolist()
+        date = date.tolist()
+        for i in range(len(user)):
+            yield {'user':user[i], 'item':item[i], 'tag':tag[i],
+                   'date':date[i]}
+
+def load_mask(fpath, mmap=True):
+    '''
+    Loads a mask saved by `FilteredUserItemAnnotations.save_mask`.
+
+    Arguments
+    ---------
+    fpath : str
+        Path of the mask file
+    mmap : bool
+        Indicates if the file is memory mapped
+    '''
+    return np.load(fpath, mmap_mode='r' if mmap else None)
+
+def iter_masked_chunks(reader, mask, chunk_size=2 ** 20):
+    '''
+    Generates the (user, item, tag, date) column chunks of the reader current
+    table keeping only rows where `mask` is True.
+
+    Arguments
+    ---------
+    reader : `tagassess.dao.base.Reader`
+        Reader where the table to filter is selected
+    mask : bool array
+        One value for each row of the table (see `load_mask`)
+    chunk_size : int
+        Number of table rows read at a time
+    '''
+    start = 0
+    for chunk in reader.iter_chunks(chunk_size):
+        keep = np.asarray(mask[start:start + chunk[0].shape[0]])
+        start += chunk[0].shape[0]
+        if keep.any():
+            yield tuple(column[keep] for column in chunk)
+
+    if start != mask.shape[0]:
+        raise ValueError('Mask has %d rows, table has %d' %
+                         (mask.shape[0], start))
+
 class FilteredUserItemAnnotations(object):
     '''
     Auxiliary class which mocks annotation database by iterating over the old
     one and filtering out annotations based on items selected for removal.
-    
+
+    User item pairs are kept as a sorted array of packed (user << 32 | item)
+    keys, built once, and annotations are tested in blocks with a sorted
+    search.
+
     Arguments
     ---------
     user_item_pairs : dict of user to items
@@ -17,22 +93,141 @@ class FilteredUserItemAnnotations(object):
 
     def __init__(self, user_item_pairs):
         self.user_item_pairs = user_item_pairs
-        
+
+        users = []
+        items = []
+        for user, user_items in user_item_pairs.items():
+            users.extend([user] * len(user_items))
+            items.extend(user_items)
+        self.keys = np.unique(pack_user_items(users, items))
+
+    def mask(self, users, items):
+        '''
+        Returns a boolean array which is True for the annotations to keep,
+        i.e, the ones with user item pairs not selected for removal.
+
+        Arguments
+        ---------
+        users : int array
+            User of each annotation
+        items : int array
+            Item of each annotation
+        '''
+        keys = pack_user_items(users, items)
+        if self.keys.shape[0] == 0:
+            return np.ones(keys.shape[0], dtype=bool)
+
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == self.keys.shape[0]] = 0
+        return self.keys[pos] != keys
+
+    def filter_chunks(self, chunks):
+        '''
+        Filters (user, item, tag, date) column chunks, such as the ones of
+        `iter_chunks` from readers. Empty chunks are skipped.
+
+        Arguments
+        ---------
+        chunks : iterator to column chunks
+        '''
+        for chunk in chunks:
+            keep = self.mask(chunk[0], chunk[1])
+            if keep.any():
+                yield tuple(column[keep] for column in chunk)
+
+    def iterate(self, reader, chunk_size=2 ** 20):
+        '''
+        Same as `annotations(reader.iterate())`, but the table is read and
+        filtered in column chunks.
+
+        Arguments
+        ---------
+        reader : `tagassess.dao.base.Reader`
+            Reader where the table to filter is selected
+        chunk_size : int
+            Number of table rows read at a time
+        '''
+        return iterate_columns(self.filter_chunks(
+                reader.iter_chunks(chunk_size)))
+
     def annotations(self, annotations_it):
         '''
         Generates new annotations based on the original iterator to annotations
-        
+
         Arguments
         ---------
         annotations_it : iterator to annotations
         '''
-        
+        block = []
         for annotation in annotations_it:
-            user = annotation['user']
-            item = annotation['item']
-            
-            if user in self.user_item_pairs and \
-                    item in self.user_item_pairs[user]:
-                continue
-            
-            yield annotation
\ No newline at end of file
+            block.append(annotation)
+            if len(block) == BLOCK_SIZE:
+                for annotation in self.__filter_block(block):
+                    yield annotation
+                block = []
+
+        for annotation in self.__filter_block(block):
+            yield annotation
+
+    def __filter_block(self, block):
+        '''Returns the annotations in the block which are kept'''
+        if not block:
+            return []
+
+        keep = self.mask([annotation['user'] for annotation in block],
+                         [annotation['item'] for annotation in block])
+        return [block[i] for i in np.flatnonzero(keep)]
+
+    def save_mask(self, reader, fpath, chunk_size=2 ** 20):
+        '''
+        Saves a boolean array, one value for each row of the reader current
+        table, which is True for the annotations which are kept (the train
+        set). The mask can be reused with `load_mask` and
+        `iter_masked_chunks`. Returns the number of annotations kept.
+
+        Arguments
+        ---------
+        reader : `tagassess.dao.base.Reader`
+            Reader where the table to filter is selected
+        fpath : str
+            Path of the mask file (.npy)
+        chunk_size : int
+            Number of table rows read at a time
+        '''
+        masks = [self.mask(chunk[0], chunk[1])
+                 for chunk in reader.iter_chunks(chunk_size)]
+
+        if masks:
+            mask = np.concatenate(masks)
+        else:
+            mask = np.zeros(0, dtype=bool)
+
+        np.save(fpath, mask)
+        return int(mask.sum())
+
+    def write_table(self, reader, writer, tname, chunk_size=2 ** 20,
+                    **kwargs):
+        '''
+        Writes the annotations which are kept to a new table of `writer`.
+        Returns the number of annotations written.
+
+        Arguments
+        ---------
+        reader : `tagassess.dao.base.Reader`
+            Reader where the table to filter is selected
+        writer : `tagassess.dao.base.Writer`
+            Opened writer where the table will be created
+        tname : str
+            Name of the new table
+        chunk_size : int
+            Number of table rows read at a time
+        kwargs :
+            Passed to `create_table`
+        '''
+        writer.create_table(tname, **kwargs)
+        num_rows = 0
+        for user, item, tag, date in \
+                self.filter_chunks(reader.iter_chunks(chunk_size)):
+            writer.append_rows(user, item, tag, date)
+            num_rows += user.shape[0]
+        return num_rows
@@ -0,0 +1,3 @@
+'''
+Memory mapped interface for accessing annotations.
+'''
@@ -0,0 +1,265 @@
+# -*- coding: utf8
+'''
+Classes for reading and writing annotations as raw column files. A database
+is a folder with a `manifest.json` file describing its tables. Each table is
+stored as one file of little endian int32 values per column (user, item, tag
+and date). Readers map the files with `np.memmap`, so many processes reading
+the same database share the page cached data.
+'''
+from __future__ import division, print_function
+
+from tagassess.dao.base import Reader
+from tagassess.dao.base import Writer
+
+import json
+import os
+import numpy as np
+
+#Columns of the annotation table and their on disk type
+ANNOT_COLUMNS = ('user', 'item', 'tag', 'date')
+DTYPE = np.dtype('<i4')
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+def _column_fpath(fpath, tname, column):
+    '''Path of the file of a column'''
+    return os.path.join(fpath, '%s.%s.i4' % (tname, column))
+
+def _load_manifest(fpath):
+    '''Loads the manifest of the database, or an empty one if it's new'''
+    manifest_fpath = os.path.join(fpath, MANIFEST)
+    if not os.path.exists(manifest_fpath):
+        return {'version':VERSION, 'tables':{}}
+    
+    with open(manifest_fpath) as manifest_file:
+        return json.load(manifest_file)
+
+def _save_manifest(fpath, manifest):
+    '''Saves the manifest atomically (write to temp file then rename)'''
+    manifest_fpath = os.path.join(fpath, MANIFEST)
+    with open(manifest_fpath + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.rename(manifest_fpath + '.tmp', manifest_fpath)
+
+def _matches(query, columns):
+    '''Boolean mask of the rows in `columns` matched by the query'''
+    if callable(query):
+        return np.asarray(query(*columns), dtype=bool)
+    
+    mask = np.ones(columns[0].shape[0], dtype=bool)
+    for name, value in query.items():
+        mask &= columns[ANNOT_COLUMNS.index(name)] == value
+    return mask
+
+class AnnotReader(Reader):
+    '''
+    A `AnnotReader` is used to read memory mapped databases.
+    
+    Queries are either dicts of column to value, matching rows which have
+    all of the values (e.g. {'user':1}), or callables which receive the
+    (user, item, tag, date) column arrays and return a boolean mask.
+    '''
+    def __init__(self, fpath):
+        super(AnnotReader, self).__init__()
+        self.fpath = fpath
+        self.opened = False
+        self.manifest = None
+        self.columns = None
+        
+    def open(self):
+        if not self.opened:
+            if not os.path.exists(os.path.join(self.fpath, MANIFEST)):
+                raise IOError('%s is not a database' % self.fpath)
+            self.manifest = _load_manifest(self.fpath)
+            self.opened = True
+            self.columns = None
+
+    def close(self):
+        if self.opened:
+            self.opened = False
+            self.manifest = None
+            self.columns = None
+
+    def change_table(self, tname, **kwargs):
+        table = self.manifest['tables'][tname]
+        num_rows = table['num_rows']
+        
+        columns = []
+        for name in ANNOT_COLUMNS:
+            if num_rows == 0: #np.memmap does not map empty files
+                columns.append(np.zeros(0, dtype=DTYPE))
+            else:
+                columns.append(np.memmap(_column_fpath(self.fpath, tname, 
+                                                       name), 
+                                         dtype=DTYPE, mode='r', 
+                                         shape=(num_rows,)))
+        self.columns = tuple(columns)
+    
+    def iterate(self, query=None, **kwargs):
+        for user, item, tag, date in self.iter_chunks(query=query):
+            for i in range(user.shape[0]):
+                yield {'user':int(user[i]),
+                       'item':int(item[i]),
+                       'tag':int(tag[i]),
+                       'date':int(date[i])}
+    
+    def iter_chunks(self, chunk_size=2 ** 20, query=None, **kwargs):
+        '''
+        Generates the annotations as (user, item, tag, date) column arrays 
+        of `chunk_size` rows. Without a `query` the chunks are views of the 
+        mapped files, else they hold the matching rows among `chunk_size` rows
+        (empty chunks are skipped).
+        '''
+        num_rows = self.columns[0].shape[0]
+        for start in range(0, num_rows, chunk_size):
+            chunk = tuple(column[start:start + chunk_size] 
+                          for column in self.columns)
+            if query:
+                mask = _matches(query, chunk)
+                if not mask.any():
+                    continue
+                chunk = tuple(column[mask] for column in chunk)
+            yield chunk
+    
+    def read_columns(self, query=None, **kwargs):
+        '''
+        Returns the (user, item, tag, date) columns of the table (the mapped
+        arrays themselves), or of the rows which match `query`.
+        '''
+        if query:
+            mask = _matches(query, self.columns)
+            return tuple(column[mask] for column in self.columns)
+        return self.columns
+
+class AnnotWriter(Writer):
+    '''
+    A `AnnotWriter` is used to create and write annotations to memory 
+    mapped databases. Rows are appended to the column files, the manifest
+    is only updated on `flush` and `close`, so readers never see partially
+    written rows.
+    '''
+
+    def __init__(self, fpath, mode='a'):
+        super(AnnotWriter, self).__init__()
+        self.fpath = fpath
+        self.mode = mode
+        self.opened = False
+        self.manifest = None
+        self.tname = None
+        self.files = None
+        self.buffer = None
+        
+    def open(self):
+        if not self.opened:
+            if not os.path.exists(self.fpath):
+                os.makedirs(self.fpath)
+            
+            if self.mode == 'w':
+                self.manifest = {'version':VERSION, 'tables':{}}
+                _save_manifest(self.fpath, self.manifest)
+            else:
+                self.manifest = _load_manifest(self.fpath)
+            self.opened = True
+            self.tname = None
+
+    def close(self):
+        if self.opened:
+            self.__close_table()
+            _save_manifest(self.fpath, self.manifest)
+            self.opened = False
+            self.tname = None
+
+    def __close_table(self):
+        '''Flushes and closes the files of the current table'''
+        if self.tname is not None:
+            self.flush()
+            for column_file in self.files:
+                column_file.close()
+            self.files = None
+            self.tname = None
+
+    def __open_table(self, tname, truncate):
+        '''Opens the column files of a table for appending'''
+        self.__close_table()
+        num_rows = self.manifest['tables'][tname]['num_rows']
+        
+        self.files = []
+        for name in ANNOT_COLUMNS:
+            column_fpath = _column_fpath(self.fpath, tname, name)
+            column_file = open(column_fpath, 'wb' if truncate else 'r+b')
+            #Drops rows not in the manifest (e.g. from a crash)
+            column_file.truncate(num_rows * DTYPE.itemsize)
+            column_file.seek(0, os.SEEK_END)
+            self.files.append(column_file)
+        
+        self.tname = tname
+        self.buffer = []
+
+    def change_table(self, tname, **kwargs):
+        self.__open_table(tname, False)
+
+    def create_table(self, tname, **kwargs):
+        if tname in self.manifest['tables']:
+            raise ValueError('Table %s already exists' % tname)
+        
+        self.manifest['tables'][tname] = {'num_rows':0, 
+                                          'dtype':DTYPE.str,
+                                          'columns':list(ANNOT_COLUMNS)}
+        self.__open_table(tname, True)
+        _save_manifest(self.fpath, self.manifest)
+
+    def append_row(self, row, **kwargs):
+        self.buffer.append(tuple(row[name] for name in ANNOT_COLUMNS))
+        if len(self.buffer) >= 2 ** 16:
+            self.__write_buffer()
+
+    def __write_buffer(self):
+        '''Writes rows appended with `append_row`'''
+        if self.buffer:
+            rows = np.array(self.buffer, dtype='i8')
+            self.buffer = []
+            self.__write(*[rows[:, j] for j in range(len(ANNOT_COLUMNS))])
+
+    def __write(self, user, item, tag, date):
+        '''Writes columns to the end of the files'''
+        columns = [np.asarray(column) for column in (user, item, tag, date)]
+        num_rows = columns[0].shape[0]
+        for column in columns:
+            if column.shape != (num_rows,):
+                raise ValueError('Columns must be 1d and of the same size')
+        
+        for column_file, column in zip(self.files, columns):
+            column_file.write(column.astype(DTYPE).tobytes())
+        self.manifest['tables'][self.tname]['num_rows'] += num_rows
+
+    def append_rows(self, user, item, tag, date, **kwargs):
+        '''
+        Appends the annotations given as columns, i.e, annotation `i` is
+        (`user[i]`, `item[i]`, `tag[i]`, `date[i]`).
+        '''
+        self.__write_buffer()
+        self.__write(user, item, tag, date)
+
+    def append_chunks(self, chunks, **kwargs):
+        '''
+        Calls `append_rows` for each (user, item, tag, date) chunk of columns
+        in the iterable `chunks` and flushes the table at the end. Returns
+        the number of annotations written.
+        '''
+        num_rows = 0
+        for user, item, tag, date in chunks:
+            self.append_rows(user, item, tag, date)
+            num_rows += len(user)
+        
+        self.flush()
+        return num_rows
+
+    def flush(self):
+        '''Writes pending rows to disk and updates the manifest'''
+        if self.tname is not None:
+            self.__write_buffer()
+            for column_file in self.files:
+                column_file.flush()
+                os.fsync(column_file.fileno())
+            _save_manifest(self.fpath, self.manifest)
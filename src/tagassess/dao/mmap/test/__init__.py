@@ -0,0 +1 @@
+'''Tests for the memory mapped dao module'''
\ No newline at end of file
@@ -0,0 +1,100 @@
+# -*- coding: utf8
+#pylint: disable-msg=C0301
+#pylint: disable-msg=C0111
+#pylint: disable-msg=C0103
+
+from __future__ import print_function, division
+
+from tagassess.dao.mmap import annotations
+from tagassess import data_parser
+from tagassess import test
+
+import shutil
+import tempfile
+import unittest
+
+class TestAnnotWriterReader(unittest.TestCase):
+    '''Tests for basic reading and writing from memory mapped databases'''
+
+    def setUp(self):
+        self.db_folder = tempfile.mkdtemp('testw')
+
+    def tearDown(self):
+        shutil.rmtree(self.db_folder)
+
+    def base_tfunc(self, fpath, parse_func):
+        '''
+        This simple test writes annotations to the database and reads them 
+        back. Comparing if both are equal.
+        '''
+        parser = data_parser.Parser()
+        written_list = []
+        with open(fpath) as in_f:
+            with annotations.AnnotWriter(self.db_folder) as writer:
+                writer.create_table('bibs')
+                for annot in parser.iparse(in_f, parse_func):
+                    annot['date'] = int(annot['date'])
+                    written_list.append(tuple(sorted(annot.items())))
+                    writer.append_row(annot)
+
+        read_list = []
+        with annotations.AnnotReader(self.db_folder) as reader:
+            reader.change_table('bibs')
+            for annot in reader.iterate():
+                read_list.append(tuple(sorted(annot.items())))
+        self.assertEquals(read_list, written_list)
+    
+    def test_chunks_and_queries(self):
+        parser = data_parser.Parser()
+        chunks = list(parser.iparse_columns(test.BIBSONOMY_FILE, 
+                                            data_parser.bibsonomy_parser,
+                                            chunk_bytes=5000))
+        expected = []
+        for user, item, tag, date in chunks:
+            expected.extend(zip(user, item, tag, date.astype('i')))
+        
+        with annotations.AnnotWriter(self.db_folder) as writer:
+            writer.create_table('bibs')
+            num_rows = len(chunks[0][0]) + len(chunks[1][0])
+            self.assertEquals(num_rows, writer.append_chunks(chunks[:2]))
+        
+        #Reopens and appends the remaining chunks
+        with annotations.AnnotWriter(self.db_folder) as writer:
+            self.assertRaises(ValueError, writer.create_table, 'bibs')
+            writer.change_table('bibs')
+            for user, item, tag, date in chunks[2:]:
+                writer.append_rows(user, item, tag, date)
+        
+        with annotations.AnnotReader(self.db_folder) as reader:
+            reader.change_table('bibs')
+            
+            read_list = []
+            for user, item, tag, date in reader.iter_chunks(999):
+                self.assertTrue(len(user) <= 999)
+                read_list.extend(zip(user, item, tag, date))
+            self.assertEquals(expected, read_list)
+            
+            user, item, tag, date = reader.read_columns()
+            self.assertEquals(expected, list(zip(user, item, tag, date)))
+            
+            read_list = []
+            for columns in reader.iter_chunks(999, {'user':1, 'tag':3}):
+                read_list.extend(zip(*columns))
+            self.assertEquals([a for a in expected if a[0] == 1 and a[2] == 3],
+                              read_list)
+            
+            columns = reader.read_columns(lambda u, i, t, d: i < 10)
+            self.assertEquals([a for a in expected if a[1] < 10],
+                              list(zip(*columns)))
+
+    def test_create_and_write_bibsonomy(self):
+        self.base_tfunc(test.BIBSONOMY_FILE, data_parser.bibsonomy_parser)
+
+    def test_create_and_write_citeulike(self):
+        self.base_tfunc(test.CITEULIKE_FILE, data_parser.citeulike_parser)
+
+    def test_create_and_write_delicious(self):
+        self.base_tfunc(test.DELICIOUS_FILE, data_parser.delicious_flickr_parser)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,15 @@ from tagassess.dao.base import Writer
 from tables import *
 
 import itertools
+import numpy as np
+
+#Columns of the annotation table
+ANNOT_COLUMNS = ('user', 'item', 'tag', 'date')
+
+def _to_columns(rows):
+    '''Splits a record array of annotations in contiguous columns'''
+    return tuple(np.ascontiguousarray(rows[field]) 
+                 for field in ANNOT_COLUMNS)
 
 class AnnotReader(Reader):
     '''
@@ -49,6 +58,74 @@ class AnnotReader(Reader):
         
         return itertools.imap(conv, iterable)
     
+    def iter_chunks(self, chunk_size=2 ** 20, query=None, **kwargs):
+        '''
+        Generates the annotations as (user, item, tag, date) column arrays.
+        Rows are read `chunk_size` at a time with `Table.read`, or with 
+        `Table.readWhere` if a `query` is given (in this case chunks hold
+        the matching rows among `chunk_size` rows, empty chunks are skipped).
+        
+        Arguments
+        ---------
+        chunk_size: int
+            Number of table rows in each chunk
+        query (optional): str
+            A PyTables condition to filter rows
+        '''
+        for start in range(0, self.table.nrows, chunk_size):
+            stop = start + chunk_size
+            if query:
+                rows = self.table.readWhere(query, start=start, stop=stop)
+            else:
+                rows = self.table.read(start, stop)
+            
+            if rows.shape[0] > 0:
+                yield _to_columns(rows)
+    
+    def read_columns(self, query=None, **kwargs):
+        '''
+        Returns the (user, item, tag, date) columns of the whole table, or of
+        the rows which match `query`.
+        '''
+        if query:
+            rows = self.table.readWhere(query)
+        else:
+            rows = self.table.read()
+        return _to_columns(rows)
+    
+    def __read_where(self, condition, condvars):
+        '''Reads the columns of the rows matching the condition'''
+        return _to_columns(self.table.readWhere(condition, condvars))
+    
+    def annotations_for_user(self, user):
+        '''
+        Returns the (user, item, tag, date) columns of the annotations of the
+        given user. Uses the index on user, if any (see 
+        `AnnotWriter.create_indexes`).
+        '''
+        return self.__read_where('user == value', {'value':user})
+
+    def annotations_for_item(self, item):
+        '''Same as `annotations_for_user`, for the given item'''
+        return self.__read_where('item == value', {'value':item})
+
+    def annotations_for_tag(self, tag):
+        '''Same as `annotations_for_user`, for the given tag'''
+        return self.__read_where('tag == value', {'value':tag})
+
+    def annotations_in_date_range(self, start, end):
+        '''
+        Returns the (user, item, tag, date) columns of the annotations with 
+        `start` <= date < `end`. Uses the index on date, if any.
+        '''
+        return self.__read_where('(date >= start) & (date < end)',
+                                 {'start':start, 'end':end})
+    
+    def indexed_columns(self):
+        '''Returns the names of the columns of the table with an index'''
+        return [name for name in ANNOT_COLUMNS 
+                if getattr(self.table.cols, name).is_indexed]
+
 class AnnotWriter(Writer):
     '''
     A `AnnotWriter` is used to create and write `Annotation` 
@@ -78,9 +155,36 @@ class AnnotWriter(Writer):
     def change_table(self, tname, **kwargs):
         self.table = self.tablefile.getNode('/', tname)
 
-    def create_table(self, tname, **kwargs):
+    def create_table(self, tname, expectedrows=10000, chunkshape=None,
+                     complib=None, complevel=5, **kwargs):
+        '''
+        Creates a new annotation table.
+        
+        Arguments
+        ---------
+        tname: str
+            The name of the new table
+        expectedrows: int
+            Hint of the number of annotations to be written, used by PyTables
+            to pick the chunk size
+        chunkshape: int or tuple (optional)
+            Number of rows in each HDF5 chunk, overrides `expectedrows`
+        complib: str (optional)
+            Compression library ('blosc', 'zlib', 'lzo' or 'bzip2'). No
+            compression if `None`
+        complevel: int
+            Compression level (0-9), only used with `complib`
+        '''
+        filters = None
+        if complib:
+            filters = Filters(complevel=complevel, complib=complib)
+        
         self.table = self.tablefile.createTable(self.tablefile.root,
-                                                tname, AnnotationDesc)
+                                                tname, AnnotationDesc,
+                                                filters=filters,
+                                                expectedrows=expectedrows,
+                                                chunkshape=chunkshape)
+        return self.table
 
     def append_row(self, row, **kwargs):
         self.table.row['date'] = row['date']
@@ -89,6 +193,62 @@ class AnnotWriter(Writer):
         self.table.row['item'] = row['item']
         self.table.row.append()
 
+    def append_rows(self, user, item, tag, date, **kwargs):
+        '''
+        Appends the annotations given as columns, i.e, annotation `i` is
+        (`user[i]`, `item[i]`, `tag[i]`, `date[i]`). Columns are copied to a 
+        single record array which is written with one `Table.append` call.
+        
+        Arguments
+        ---------
+        user, item, tag, date: array like
+            Columns of the annotations, all of the same size
+        '''
+        user = np.asarray(user)
+        num_rows = user.shape[0]
+        if num_rows == 0:
+            return
+        
+        rows = np.empty(num_rows, dtype=self.table.dtype)
+        rows['user'] = user
+        rows['item'] = item
+        rows['tag'] = tag
+        rows['date'] = date
+        self.table.append(rows)
+
+    def append_chunks(self, chunks, **kwargs):
+        '''
+        Calls `append_rows` for each (user, item, tag, date) chunk of columns
+        in the iterable `chunks` and flushes the table at the end. Returns
+        the number of annotations written.
+        '''
+        num_rows = 0
+        for user, item, tag, date in chunks:
+            self.append_rows(user, item, tag, date)
+            num_rows += len(user)
+        
+        self.table.flush()
+        return num_rows
+
+    def create_indexes(self, columns=ANNOT_COLUMNS):
+        '''
+        Creates completely sorted indexes (CSI) on the given columns, so 
+        that queries on them (e.g. `AnnotReader.annotations_for_user`) do not
+        scan the whole table. Should be called after all rows are written,
+        existing indexes are rebuilt.
+        
+        Arguments
+        ---------
+        columns: sequence of str
+            Names of the columns to index
+        '''
+        self.table.flush()
+        for name in columns:
+            column = getattr(self.table.cols, name)
+            if column.is_indexed:
+                column.removeIndex()
+            column.createCSIndex()
+
 class AnnotationDesc(IsDescription):
     '''
     Defines an annotation description to be saved on file.
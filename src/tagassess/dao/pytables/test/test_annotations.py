@@ -46,6 +46,94 @@ class TestAnnotWriterReader(unittest.TestCase):
         self.assertEquals(n_lines, len(written_list))
         self.assertEquals(read_list, written_list)
             
+    def test_append_chunks(self):
+        expected = []
+        with open(test.BIBSONOMY_FILE) as in_f:
+            for annot in data_parser.Parser().iparse(in_f, 
+                    data_parser.bibsonomy_parser):
+                expected.append(tuple(sorted(annot.items())))
+        
+        parser = data_parser.Parser()
+        chunks = parser.iparse_columns(test.BIBSONOMY_FILE, 
+                                       data_parser.bibsonomy_parser,
+                                       chunk_bytes=5000)
+        with annotations.AnnotWriter(self.h5_file) as writer:
+            writer.create_table('bibs', expectedrows=10000, complib='zlib')
+            self.assertEquals(len(expected), writer.append_chunks(chunks))
+        
+        read_list = []
+        with annotations.AnnotReader(self.h5_file) as reader:
+            reader.change_table('bibs')
+            for annot in reader.iterate():
+                read_list.append(tuple(sorted(annot.items())))
+        self.assertEquals(expected, read_list)
+
+    def test_iter_chunks(self):
+        parser = data_parser.Parser()
+        with open(test.BIBSONOMY_FILE) as in_f:
+            with annotations.AnnotWriter(self.h5_file) as writer:
+                writer.create_table('bibs')
+                for annot in parser.iparse(in_f, data_parser.bibsonomy_parser):
+                    writer.append_row(annot)
+        
+        with annotations.AnnotReader(self.h5_file) as reader:
+            reader.change_table('bibs')
+            expected = [(a['user'], a['item'], a['tag'], a['date']) 
+                        for a in reader.iterate()]
+            expected_u0 = [(a['user'], a['item'], a['tag'], a['date']) 
+                           for a in reader.iterate('user == 0')]
+            
+            read_list = []
+            for user, item, tag, date in reader.iter_chunks(999):
+                self.assertTrue(len(user) <= 999)
+                read_list.extend(zip(user, item, tag, date))
+            self.assertEquals(expected, read_list)
+            
+            read_list = []
+            for user, item, tag, date in reader.iter_chunks(999, 'user == 0'):
+                self.assertTrue((user == 0).all())
+                read_list.extend(zip(user, item, tag, date))
+            self.assertEquals(expected_u0, read_list)
+            
+            user, item, tag, date = reader.read_columns()
+            self.assertEquals(expected, list(zip(user, item, tag, date)))
+
+    def test_indexed_queries(self):
+        parser = data_parser.Parser()
+        with open(test.BIBSONOMY_FILE) as in_f:
+            with annotations.AnnotWriter(self.h5_file) as writer:
+                writer.create_table('bibs')
+                for annot in parser.iparse(in_f, data_parser.bibsonomy_parser):
+                    writer.append_row(annot)
+                writer.create_indexes()
+        
+        with annotations.AnnotReader(self.h5_file) as reader:
+            reader.change_table('bibs')
+            self.assertEquals(list(annotations.ANNOT_COLUMNS), 
+                              reader.indexed_columns())
+            
+            all_annots = [(a['user'], a['item'], a['tag'], a['date']) 
+                          for a in reader.iterate()]
+            dates = sorted(a[3] for a in all_annots)
+            start, end = dates[len(dates) // 4], dates[len(dates) // 2]
+            
+            for user in (0, 1, 7):
+                expected = sorted(a for a in all_annots if a[0] == user)
+                result = sorted(zip(*reader.annotations_for_user(user)))
+                self.assertEquals(expected, result)
+            
+            expected = sorted(a for a in all_annots if a[1] == 3)
+            result = sorted(zip(*reader.annotations_for_item(3)))
+            self.assertEquals(expected, result)
+            
+            expected = sorted(a for a in all_annots if a[2] == 3)
+            result = sorted(zip(*reader.annotations_for_tag(3)))
+            self.assertEquals(expected, result)
+            
+            expected = sorted(a for a in all_annots if start <= a[3] < end)
+            result = sorted(zip(*reader.annotations_in_date_range(start, end)))
+            self.assertEquals(expected, result)
+
     def test_create_and_write_bibsonomy(self):
         self.base_tfunc(test.BIBSONOMY_FILE, data_parser.bibsonomy_parser)
 
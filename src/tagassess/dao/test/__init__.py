@@ -0,0 +1 @@
+'''Tests for the dao module'''
\ No newline at end of file
@@ -0,0 +1,95 @@
+# -*- coding: utf8
+#pylint: disable-msg=C0301
+#pylint: disable-msg=C0111
+#pylint: disable-msg=C0103
+
+from __future__ import print_function, division
+
+from tagassess.dao import helpers
+from tagassess.dao.mmap.annotations import AnnotReader
+from tagassess.dao.mmap.annotations import AnnotWriter
+from tagassess import data_parser
+from tagassess import test
+
+import os
+import shutil
+import tempfile
+import unittest
+
+def naive_filter(user_item_pairs, annotations):
+    return [a for a in annotations 
+            if not (a['user'] in user_item_pairs and 
+                    a['item'] in user_item_pairs[a['user']])]
+
+class TestFilteredUserItemAnnotations(unittest.TestCase):
+
+    def setUp(self):
+        self.db_folder = tempfile.mkdtemp('testf')
+        
+        parser = data_parser.Parser()
+        with open(test.BIBSONOMY_FILE) as in_f, \
+                AnnotWriter(self.db_folder) as writer:
+            writer.create_table('bibs')
+            for annot in parser.iparse(in_f, data_parser.bibsonomy_parser):
+                writer.append_row(annot)
+        
+        with AnnotReader(self.db_folder) as reader:
+            reader.change_table('bibs')
+            self.annots = list(reader.iterate())
+        
+        self.user_item_pairs = {}
+        for annot in self.annots[::7]:
+            self.user_item_pairs.setdefault(annot['user'], set()).add(
+                    annot['item'])
+        self.user_item_pairs[10 ** 6] = set([1, 2])
+
+    def tearDown(self):
+        shutil.rmtree(self.db_folder)
+
+    def test_annotations(self):
+        expected = naive_filter(self.user_item_pairs, self.annots)
+        self.assertTrue(0 < len(expected) < len(self.annots))
+        
+        annot_filter = helpers.FilteredUserItemAnnotations(
+                self.user_item_pairs)
+        self.assertEquals(expected, 
+                          list(annot_filter.annotations(iter(self.annots))))
+        
+        with AnnotReader(self.db_folder) as reader:
+            reader.change_table('bibs')
+            self.assertEquals(expected, list(annot_filter.iterate(reader, 
+                                                                  999)))
+
+    def test_empty(self):
+        annot_filter = helpers.FilteredUserItemAnnotations({})
+        self.assertEquals(self.annots, 
+                          list(annot_filter.annotations(self.annots)))
+        self.assertEquals([], list(annot_filter.annotations([])))
+
+    def test_mask_and_table(self):
+        expected = naive_filter(self.user_item_pairs, self.annots)
+        annot_filter = helpers.FilteredUserItemAnnotations(
+                self.user_item_pairs)
+        
+        mask_fpath = os.path.join(self.db_folder, 'mask.npy')
+        with AnnotReader(self.db_folder) as reader:
+            reader.change_table('bibs')
+            self.assertEquals(len(expected), 
+                              annot_filter.save_mask(reader, mask_fpath, 999))
+            
+            mask = helpers.load_mask(mask_fpath)
+            chunks = helpers.iter_masked_chunks(reader, mask, 999)
+            self.assertEquals(expected, 
+                              list(helpers.iterate_columns(chunks)))
+        
+            with AnnotWriter(self.db_folder) as writer:
+                self.assertEquals(len(expected), 
+                                  annot_filter.write_table(reader, writer, 
+                                                           'train', 999))
+        
+        with AnnotReader(self.db_folder) as reader:
+            reader.change_table('train')
+            self.assertEquals(expected, list(reader.iterate()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,12 +4,208 @@ Module used for parsing annotation files.
 '''
 from __future__ import print_function, division
 
+from tagassess.common import CompactID
 from tagassess.common import ContiguousID
+from collections import deque
 
+import multiprocessing
+import numpy as np
+import os
 import time
 
+#Formats with a fast path in `decode_time`, they differ only on the date and
+#time separator and on the trailing Z.
+FIXED_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%SZ')
+
+#Days before each month in non leap years
+_DAYS_BEFORE_MONTH = np.array([0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 
+                               273, 304, 334], dtype=np.int64)
+_DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+                          dtype=np.int64)
+
+#Local time (in seconds) of the start of each hour seen by the decoders. The
+#UTC offset, including daylight saving, is computed by mktime once per hour.
+#Hours skipped or repeated by daylight saving changes are stored as None.
+_HOUR_CACHE = {}
+
+def _is_leap(year):
+    return (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+
+def _hour_start(year, month, day, hour):
+    '''
+    Local time in seconds of the given hour, cached. None if the hour does 
+    not exist or happens twice in the local zone (daylight saving changes), 
+    since mktime may resolve each second of it differently.
+    '''
+    key = (year, month, day, hour)
+    if key not in _HOUR_CACHE:
+        start = time.mktime((year, month, day, hour, 0, 0, 0, 0, -1))
+        end = time.mktime((year, month, day, hour, 59, 59, 0, 0, -1))
+        standard = time.mktime((year, month, day, hour, 0, 0, 0, 0, 0))
+        daylight = time.mktime((year, month, day, hour, 0, 0, 0, 0, 1))
+        
+        wall_clock = (year, month, day, hour, 0, 0)
+        if tuple(time.localtime(start)[:6]) != wall_clock or \
+                end - start != 3599 or (standard != daylight and 
+                tuple(time.localtime(standard)[:6]) == wall_clock and 
+                tuple(time.localtime(daylight)[:6]) == wall_clock):
+            start = None
+        _HOUR_CACHE[key] = start
+    return _HOUR_CACHE[key]
+
+def decode_time(time_string, fmt=FIXED_TIME_FORMATS[0]):
+    '''
+    Converts a timestamp in `fmt`, one of the `FIXED_TIME_FORMATS`, to 
+    seconds in the local zone, the same as 
+    `time.mktime(time.strptime(time_string, fmt))`. Fields are sliced at 
+    fixed positions and only the start of each hour goes through mktime (see
+    `_hour_start`). Returns None if `fmt` is not one of the fixed formats, if
+    the string is not in its layout, if a field is out of range or if the 
+    hour is changed by daylight saving.
+    
+    Arguments
+    ---------
+    time_string: str
+        The timestamp
+    fmt: str
+        Format of the timestamp
+    '''
+    if fmt not in FIXED_TIME_FORMATS:
+        return None
+    
+    zulu = fmt == FIXED_TIME_FORMATS[1]
+    length = len(time_string)
+    if length != 19 + zulu or (zulu and time_string[19] != 'Z'):
+        return None
+    
+    if time_string[4] != '-' or time_string[7] != '-' or \
+            time_string[13] != ':' or time_string[16] != ':' or \
+            time_string[10] != ('T' if zulu else ' '):
+        return None
+    
+    digits = time_string[0:4] + time_string[5:7] + time_string[8:10] + \
+            time_string[11:13] + time_string[14:16] + time_string[17:19]
+    if not digits.isdigit():
+        return None
+    
+    year = int(digits[0:4])
+    month = int(digits[4:6])
+    day = int(digits[6:8])
+    hour = int(digits[8:10])
+    minute = int(digits[10:12])
+    second = int(digits[12:14])
+    
+    if month < 1 or month > 12 or day < 1 or hour > 23 or minute > 59 or \
+            second > 61 or \
+            day > _DAYS_IN_MONTH[month] + (month == 2 and _is_leap(year)):
+        return None
+    
+    start = _hour_start(year, month, day, hour)
+    if start is None:
+        return None
+    return start + minute * 60 + second
+
+def decode_times(time_strings, fmt=FIXED_TIME_FORMATS[0]):
+    '''
+    Converts an array of timestamps in `fmt` to seconds in the local zone. 
+    If `fmt` is one of the `FIXED_TIME_FORMATS` the timestamps in its layout
+    are decoded at once: fields are read from the characters at fixed 
+    positions, each distinct hour is found with a day number (days since 
+    1970-01-01, from a table of days before each month) and mktime is called
+    once per distinct hour. Other timestamps are converted with 
+    `time.strptime`, as are the ones in hours changed by daylight saving.
+    
+    Arguments
+    ---------
+    time_strings: array or list of str
+        The timestamps
+    fmt: str
+        Format of the timestamps
+    '''
+    time_strings = np.asarray(time_strings)
+    num_strings = time_strings.shape[0]
+    return_val = np.zeros(num_strings, dtype='d')
+    if num_strings == 0:
+        return return_val
+    
+    if time_strings.dtype.kind == 'U':
+        raw = np.char.encode(time_strings, 'ascii', 'replace')
+    else:
+        raw = time_strings
+    
+    lengths = np.char.str_len(raw)
+    chars = np.zeros((num_strings, 20), dtype=np.uint8)
+    fixed = raw.astype('S20')
+    chars[:] = np.frombuffer(fixed.tobytes(), dtype=np.uint8).reshape(-1, 20)
+    
+    digit_cols = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+    digits = chars[:, digit_cols].astype(np.int64) - ord('0')
+    
+    if fmt == FIXED_TIME_FORMATS[0]:
+        valid = (lengths == 19) & (chars[:, 10] == ord(' '))
+    elif fmt == FIXED_TIME_FORMATS[1]:
+        valid = (lengths == 20) & (chars[:, 10] == ord('T')) & \
+                (chars[:, 19] == ord('Z'))
+    else:
+        valid = np.zeros(num_strings, dtype=bool)
+    valid &= (chars[:, 4] == ord('-')) & (chars[:, 7] == ord('-'))
+    valid &= (chars[:, 13] == ord(':')) & (chars[:, 16] == ord(':'))
+    valid &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+    
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + \
+            digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    hour = digits[:, 8] * 10 + digits[:, 9]
+    minute = digits[:, 10] * 10 + digits[:, 11]
+    second = digits[:, 12] * 10 + digits[:, 13]
+    
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (hour <= 23) & \
+            (minute <= 59) & (second <= 61)
+    month = np.where(valid, month, 1)
+    leap = _is_leap(year)
+    valid &= day <= _DAYS_IN_MONTH[month] + ((month == 2) & leap)
+    
+    #Day number, from the table of days before each month
+    years_before = year - 1
+    day_number = 365 * (year - 1970) + \
+            (years_before // 4 - years_before // 100 + years_before // 400) - \
+            477 + _DAYS_BEFORE_MONTH[month] + ((month > 2) & leap) + day - 1
+    
+    hour_key = day_number * 24 + hour
+    unique_keys, first, inverse = np.unique(hour_key[valid], 
+                                            return_index=True, 
+                                            return_inverse=True)
+    
+    valid_idx = np.where(valid)[0]
+    hour_starts = np.array([_hour_start(int(year[i]), int(month[i]), 
+                                        int(day[i]), int(hour[i]))
+                            for i in valid_idx[first]], dtype='d')
+    
+    return_val[valid] = hour_starts[inverse] + minute[valid] * 60 + \
+            second[valid]
+    
+    #None becomes NaN, these hours go through strptime
+    valid[valid_idx[np.isnan(return_val[valid_idx])]] = False
+    
+    for i in np.where(~valid)[0]:
+        time_string = time_strings[i]
+        if not isinstance(time_string, str):
+            time_string = time_string.decode('utf8')
+        return_val[i] = __convert_str_time(time_string, fmt)
+    
+    return return_val
+
 def __convert_str_time(time_string, fmt):
-    '''Converts the string to our time in local zone'''
+    '''
+    Converts the string to our time in local zone. If `fmt` is one of the 
+    `FIXED_TIME_FORMATS`, strings in its layout are converted by 
+    `decode_time`.
+    '''
+    rv = decode_time(time_string, fmt)
+    if rv is not None:
+        return rv
+    
     return time.mktime(time.strptime(time_string, fmt))
 
 def citeulike_parser(line):
@@ -148,6 +344,96 @@ def to_json(user, item, tag, date):
             'tag':tag,
             'date':date}
 
+def _chunk_bounds(fpath, chunk_bytes):
+    '''
+    Splits the file in byte ranges of about `chunk_bytes`. Ranges always 
+    begin at the start of a line.
+    '''
+    size = os.path.getsize(fpath)
+    bounds = [0]
+    with open(fpath, 'rb') as inf:
+        while bounds[-1] < size:
+            inf.seek(min(bounds[-1] + chunk_bytes, size))
+            inf.readline()
+            bounds.append(min(inf.tell(), size))
+    
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _parse_chunk(args):
+    '''
+    Parses the lines in a byte range of the file. Returns the number of 
+    lines read, the user, item and tag keys in order of first appearance,
+    the annotations (with ids local to the chunk) as four arrays and the
+    lines which could not be parsed. Runs in a worker process.
+    '''
+    fpath, start, end, parse_func = args
+    with open(fpath, 'rb') as inf:
+        inf.seek(start)
+        data = inf.read(end - start)
+    
+    if not isinstance(data, str):
+        data = data.decode('utf8')
+    #Same lines as iterating over the file, i.e, ending with '\n'
+    lines = [line + '\n' for line in data.split('\n')]
+    if data.endswith('\n'):
+        lines.pop()
+    elif lines:
+        lines[-1] = lines[-1][:-1]
+    
+    #Chunk ids are looked up for every line, plain dicts are much faster
+    #than the compact (global) ids, which only get the distinct keys.
+    user_ids = ContiguousID()
+    item_ids = ContiguousID()
+    tag_ids = ContiguousID()
+    
+    users = []
+    items = []
+    tags = []
+    dates = []
+    errors = []
+    for i, line in enumerate(lines):
+        try:
+            user, item, tag, date = parse_func(line)
+            users.append(user_ids[user])
+            items.append(item_ids[item])
+            tags.append(tag_ids[tag])
+            dates.append(date)
+        except Exception as exc:
+            errors.append((i, line, str(exc)))
+    
+    keys = [[ids.reverse_lookup(id_) for id_ in range(len(ids))]
+            for ids in (user_ids, item_ids, tag_ids)]
+    
+    return len(lines), keys, np.array(users, dtype='i'), \
+            np.array(items, dtype='i'), np.array(tags, dtype='i'), \
+            np.array(dates, dtype='d'), errors
+
+def _cached_id(cache, ids, key):
+    '''
+    Returns `ids[key]`, remembering it in the dict `cache`. Used to look up
+    keys of every line without going through the compact ids each time.
+    '''
+    id_ = cache.get(key)
+    if id_ is None:
+        id_ = cache[key] = ids[key]
+    return id_
+
+def _imap_window(pool, func, tasks, window):
+    '''
+    Same as `pool.imap(func, tasks)`, but only `window` tasks are submitted
+    and not yet consumed at any time. `imap` consumes all tasks as soon as
+    it can, so the results of a fast pool with a slow consumer would pile up
+    in memory.
+    '''
+    pending = deque()
+    for task in tasks:
+        if len(pending) == window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    
+    while pending:
+        yield pending.popleft().get()
+
 class Parser(object):
 
     '''
@@ -175,21 +461,97 @@ class Parser(object):
         parse_func: callable
             Method or callable which will parse each line from the file
         '''
+        user_cache = {}
+        item_cache = {}
+        tag_cache = {}
         for i, line in enumerate(inf):
             try:
                 user, item, tag, date = parse_func(line)
+                
                 #We make use of tuple (1 to 3, X) in order to differentiate
                 #user, tags and items with same names.
-                yield to_json(self.user_ids[(1, user)],
-                              self.item_ids[(2, item)],
-                              self.tag_ids[(3, tag)], date)
+                yield to_json(_cached_id(user_cache, self.user_ids, (1, user)),
+                              _cached_id(item_cache, self.item_ids, (2, item)),
+                              _cached_id(tag_cache, self.tag_ids, (3, tag)), 
+                              date)
             except Exception as exc:
                 if logf:
                     print('Error at line %d:\n\t%s\nEx=%s'%(i, line, str(exc)))
 
+    def iparse_columns(self, fpath, parse_func, num_workers=1, logf=None,
+                       chunk_bytes=64 * 1024 * 1024):
+        '''
+        Parses the file in byte ranges of about `chunk_bytes`, generating, for
+        each range, the annotations as four arrays (user, item, tag, date). 
+        With more than one worker the ranges are parsed by `num_workers`
+        processes, with at most 2 * `num_workers` chunks parsed and not yet
+        merged at any time. Chunks are merged in file order and the ids of 
+        each chunk are remapped in order of first appearance, so the 
+        annotations and ids generated are the same as the ones of `iparse`.
+        
+        Arguments:
+        ----------
+        fpath: str
+            Path of the text file to parse
+        parse_func: callable
+            Function which will parse each line from the file. Must be
+            picklable (e.g. a module level function) if `num_workers` > 1
+        num_workers: int
+            Number of processes to use
+        chunk_bytes: int
+            Approximate size of each chunk
+        '''
+        tasks = ((fpath, start, end, parse_func) 
+                 for start, end in _chunk_bounds(fpath, chunk_bytes))
+        
+        pool = None
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers)
+            results = _imap_window(pool, _parse_chunk, tasks, 
+                                   2 * num_workers)
+        else:
+            results = (_parse_chunk(task) for task in tasks)
+        
+        try:
+            first_line = 0
+            for num_lines, keys, users, items, tags, dates, errors in results:
+                remaps = [ids.encode([(kind, key) for key in chunk_keys]) 
+                          for kind, ids, chunk_keys in 
+                          zip((1, 2, 3), 
+                              (self.user_ids, self.item_ids, self.tag_ids), 
+                              keys)]
+                
+                yield remaps[0][users], remaps[1][items], remaps[2][tags], \
+                        dates
+                
+                if logf:
+                    for i, line, exc in errors:
+                        print('Error at line %d:\n\t%s\nEx=%s' % 
+                              (first_line + i, line, exc))
+                first_line += num_lines
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def iparse_parallel(self, fpath, parse_func, num_workers, logf=None,
+                        chunk_bytes=64 * 1024 * 1024):
+        '''
+        Same as `iparse` but the file is parsed by `num_workers` processes.
+        
+        See also
+        --------
+        iparse_columns
+        '''
+        for users, items, tags, dates in \
+                self.iparse_columns(fpath, parse_func, num_workers, logf,
+                                    chunk_bytes):
+            for i in range(dates.shape[0]):
+                yield to_json(int(users[i]), int(items[i]), int(tags[i]),
+                              float(dates[i]))
+
     def __reset(self):
         '''Resets the parser ids to new ones. Useful for reusing
         the same parser object'''
-        self.tag_ids = ContiguousID()
-        self.item_ids = ContiguousID()
-        self.user_ids = ContiguousID()
\ No newline at end of file
+        self.tag_ids = CompactID()
+        self.item_ids = CompactID()
+        self.user_ids = CompactID()
\ No newline at end of file
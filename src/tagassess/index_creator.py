@@ -1,10 +1,18 @@
 # -*- coding: utf8
 '''
-Functions used to create indices and reverse lists. 
+Functions used to create indices and reverse lists. The `create_csr_*`
+functions build array backed versions of the indexes from columnar input,
+which can be reused among runs with an `IndexCache`.
 '''
 from __future__ import division, print_function
 
 from collections import defaultdict
+from collections import Mapping
+
+import hashlib
+import json
+import numpy as np
+import os
 
 def create_occurrence_index(annotation_it, from_, dest):
     '''
@@ -114,3 +122,299 @@ def create_metrics_index(annotation_it, from_, dest):
     
     return (from_dest_frequencies, collection_from_frequency, 
             collection_dest_frequency)
+
+#Position of each field in (user, item, tag, date) column chunks
+COLUMNS = {'user':0, 'item':1, 'tag':2, 'date':3}
+
+#Files saved for each array of an `OccurrenceIndex`
+CSR_ARRAYS = ('keys', 'indptr', 'indices', 'counts')
+
+class OccurrenceIndex(Mapping):
+    '''
+    Array backed occurrence index in compressed sparse row (CSR) form. The
+    `dest` ids of the i-th key, `keys[i]`, are `indices[indptr[i]:indptr[i + 1]]`
+    (sorted) and `counts` holds the number of annotations of each pair. 
+
+    Looking up a key returns a view of its sorted `dest` ids, which can be
+    iterated, sized and tested with `in` such as the sets of
+    `create_occurrence_index`. Like those (defaultdicts), keys which are not
+    in the index have no ids. Use `contains` and `count` for fast tests.
+    
+    Indexes can be pickled, or saved with `save` and memory mapped by `load`.
+    '''
+
+    def __init__(self, keys, indptr, indices, counts):
+        self.keys = keys
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+
+    def __row(self, key):
+        '''Returns the position of the key in `keys`, -1 if not found'''
+        pos = np.searchsorted(self.keys, key)
+        if pos < self.keys.shape[0] and self.keys[pos] == key:
+            return pos
+        return -1
+
+    def __getitem__(self, key):
+        pos = self.__row(key)
+        if pos < 0:
+            return self.indices[0:0]
+        return self.indices[self.indptr[pos]:self.indptr[pos + 1]]
+
+    def __contains__(self, key):
+        return self.__row(key) >= 0
+
+    def __iter__(self):
+        return iter(self.keys.tolist())
+
+    def __len__(self):
+        return self.keys.shape[0]
+
+    def get_counts(self, key):
+        '''Returns the counts of the ids returned by `index[key]`'''
+        pos = self.__row(key)
+        if pos < 0:
+            return self.counts[0:0]
+        return self.counts[self.indptr[pos]:self.indptr[pos + 1]]
+
+    def count(self, key, dest_id):
+        '''Returns the number of annotations with the pair (key, dest_id)'''
+        pos = self.__row(key)
+        if pos < 0:
+            return 0
+        
+        start = self.indptr[pos]
+        end = self.indptr[pos + 1]
+        i = start + np.searchsorted(self.indices[start:end], dest_id)
+        if i < end and self.indices[i] == dest_id:
+            return int(self.counts[i])
+        return 0
+
+    def contains(self, key, dest_id):
+        '''Indicates if the pair (key, dest_id) is in the index'''
+        return self.count(key, dest_id) > 0
+
+    def save(self, fpath):
+        '''
+        Saves the index to `fpath` + '.<array>.npy' files, one for each array.
+        
+        Arguments
+        ---------
+        fpath: str
+            Path prefix of the files
+        '''
+        for name in CSR_ARRAYS:
+            np.save('%s.%s.npy' % (fpath, name), getattr(self, name))
+
+    @classmethod
+    def load(cls, fpath, mmap=True):
+        '''
+        Loads an index saved by `save`. With `mmap` the files are memory
+        mapped (read only) and can be shared among processes.
+        
+        Arguments
+        ---------
+        fpath: str
+            Path prefix of the files
+        mmap: bool
+            Indicates if files are memory mapped
+        '''
+        return cls(*[np.load('%s.%s.npy' % (fpath, name), 
+                             mmap_mode='r' if mmap else None) 
+                     for name in CSR_ARRAYS])
+
+def _read_pairs(chunks, from_, dest):
+    '''Concatenates the `from_` and `dest` columns of the chunks'''
+    from_cols = []
+    dest_cols = []
+    for chunk in chunks:
+        from_cols.append(np.asarray(chunk[COLUMNS[from_]], dtype=np.int64))
+        dest_cols.append(np.asarray(chunk[COLUMNS[dest]], dtype=np.int64))
+    
+    if not from_cols:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(from_cols), np.concatenate(dest_cols)
+
+def _build_csr(from_ids, dest_ids):
+    '''Builds an `OccurrenceIndex` from pairs of ids'''
+    order = np.lexsort((dest_ids, from_ids))
+    from_ids = from_ids[order]
+    dest_ids = dest_ids[order]
+    
+    #Position of the first of each distinct pair and of each distinct key
+    new_pair = np.ones(from_ids.shape[0], dtype=bool)
+    new_pair[1:] = (from_ids[1:] != from_ids[:-1]) | \
+            (dest_ids[1:] != dest_ids[:-1])
+    pair_starts = np.flatnonzero(new_pair)
+    counts = np.diff(np.append(pair_starts, from_ids.shape[0]))
+    
+    pair_from = from_ids[pair_starts]
+    new_key = np.ones(pair_from.shape[0], dtype=bool)
+    new_key[1:] = pair_from[1:] != pair_from[:-1]
+    key_starts = np.flatnonzero(new_key)
+    
+    return OccurrenceIndex(pair_from[key_starts].astype(np.int32),
+                           np.append(key_starts, 
+                                     pair_from.shape[0]).astype(np.int64),
+                           dest_ids[pair_starts].astype(np.int32),
+                           counts.astype(np.int32))
+
+def create_csr_occurrence_index(chunks, from_, dest):
+    '''
+    Array backed version of `create_occurrence_index`, built with a sort
+    over columnar input.
+    
+    Arguments
+    ---------
+    chunks: iterable
+        (user, item, tag, date) column chunks, such as the ones of the 
+        `iter_chunks` method of readers. Use `[reader.read_columns()]` for
+        whole columns.
+    from_: str 
+        the key of the index {'tag', 'item', 'user'}
+    dest: str
+        the lists to create. {'tag', 'item', 'user'}
+    
+    Returns
+    -------
+    An `OccurrenceIndex`
+    '''
+    return _build_csr(*_read_pairs(chunks, from_, dest))
+
+def create_csr_double_occurrence_index(chunks, from_, dest):
+    '''
+    Array backed version of `create_double_occurrence_index`. Returns two
+    `OccurrenceIndex`: from -> dest and dest -> from.
+    '''
+    from_ids, dest_ids = _read_pairs(chunks, from_, dest)
+    return _build_csr(from_ids, dest_ids), _build_csr(dest_ids, from_ids)
+
+def create_csr_metrics_index(chunks, from_, dest):
+    '''
+    Array backed version of `create_metrics_index`. Returns a tuple with an
+    `OccurrenceIndex` with the frequencies of `from_` and `dest` together
+    (see `OccurrenceIndex.count`) and two arrays with the global `from_` and 
+    `dest` frequencies, indexed by id.
+    '''
+    from_ids, dest_ids = _read_pairs(chunks, from_, dest)
+    from_freq = np.bincount(from_ids) if from_ids.shape[0] else \
+            np.zeros(0, dtype=np.int64)
+    dest_freq = np.bincount(dest_ids) if dest_ids.shape[0] else \
+            np.zeros(0, dtype=np.int64)
+    return _build_csr(from_ids, dest_ids), from_freq, dest_freq
+
+def _file_signature(fpath):
+    '''Size and modification time of a file, or of a database folder'''
+    if os.path.isdir(fpath): #e.g. tagassess.dao.mmap databases
+        fpaths = [os.path.join(fpath, name) for name in os.listdir(fpath)]
+    else:
+        fpaths = [fpath]
+    
+    return sorted([os.path.basename(path), os.path.getsize(path), 
+                   os.path.getmtime(path)] for path in fpaths)
+
+def _file_hash(fpath):
+    '''sha1 of the contents of the file'''
+    sha1 = hashlib.sha1()
+    with open(fpath, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(2 ** 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+class IndexCache(object):
+    '''
+    On disk cache of `OccurrenceIndex` objects built from a database table,
+    optionally filtered by a cross validation filter file. Indexes are 
+    stored in `cache_folder` under a key of (database path, table, hash of
+    the filter file, index kind) and are memory mapped when loaded. 
+    A cached index is rebuilt if the size or modification time of the 
+    database changed since it was saved.
+    
+    If `cache_folder` is `None` indexes are built every time.
+    
+    Arguments
+    ---------
+    cache_folder: str
+        Folder where indexes are saved
+    db_fpath: str
+        Path of the database (file or folder)
+    tname: str
+        Name of the table
+    filter_fpath (optional): str
+        File of the user item pairs filtered out of the table
+    '''
+    
+    def __init__(self, cache_folder, db_fpath, tname, filter_fpath=None):
+        self.cache_folder = cache_folder
+        self.db_fpath = os.path.abspath(db_fpath)
+        self.tname = tname
+        self.filter_hash = None
+        if filter_fpath is not None:
+            self.filter_hash = _file_hash(filter_fpath)
+        
+        self.hits = 0
+        self.misses = 0
+    
+    def __fpath(self, kind):
+        '''Path prefix of the index of the given kind'''
+        key = '\0'.join([self.db_fpath, self.tname, 
+                         self.filter_hash or '', kind])
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()[:16]
+        return os.path.join(self.cache_folder, '%s-%s' % (kind, digest))
+    
+    def __meta(self, kind):
+        '''Metadata used to validate a cached index'''
+        return {'db_fpath':self.db_fpath,
+                'tname':self.tname,
+                'filter_hash':self.filter_hash,
+                'kind':kind,
+                'db_signature':_file_signature(self.db_fpath)}
+    
+    def occurrence_index(self, from_, dest, chunks_func):
+        '''
+        Returns the `OccurrenceIndex` from `from_` to `dest` (see
+        `create_csr_occurrence_index`), loading it from the cache if 
+        possible.
+        
+        Arguments
+        ---------
+        from_: str 
+            the key of the index {'tag', 'item', 'user'}
+        dest: str
+            the lists to create. {'tag', 'item', 'user'}
+        chunks_func: callable
+            Called without arguments when the index has to be built, returns
+            the (filtered) column chunks of the table
+        '''
+        kind = 'occurrence_%s_%s' % (from_, dest)
+        if self.cache_folder is None:
+            self.misses += 1
+            return create_csr_occurrence_index(chunks_func(), from_, dest)
+        
+        fpath = self.__fpath(kind)
+        meta = self.__meta(kind)
+        meta_fpath = fpath + '.json'
+        if os.path.exists(meta_fpath):
+            with open(meta_fpath) as meta_file:
+                if json.load(meta_file) == meta:
+                    self.hits += 1
+                    return OccurrenceIndex.load(fpath)
+        
+        self.misses += 1
+        index = create_csr_occurrence_index(chunks_func(), from_, dest)
+        
+        #Saves to a temporary prefix and renames, so that concurrent 
+        #processes never load partially written indexes. The metadata file 
+        #is written last.
+        tmp_fpath = '%s.tmp%d' % (fpath, os.getpid())
+        index.save(tmp_fpath)
+        for name in CSR_ARRAYS:
+            os.rename('%s.%s.npy' % (tmp_fpath, name),
+                      '%s.%s.npy' % (fpath, name))
+        
+        with open(tmp_fpath + '.json', 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.rename(tmp_fpath + '.json', meta_fpath)
+        
+        return index
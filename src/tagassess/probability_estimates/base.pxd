@@ -8,6 +8,10 @@ cdef class ProbabilityEstimator:
     cpdef np.ndarray[np.double_t, ndim=1] prob_items_given_user_tag(self,
             int user, int tag, np.ndarray[np.int_t, ndim=1] gamma_items)
     
+    cpdef np.ndarray[np.double_t, ndim=2] prob_items_given_user_tags(self,
+            int user, np.ndarray[np.int_t, ndim=1] tags, 
+            np.ndarray[np.int_t, ndim=1] gamma_items)
+    
     cpdef np.ndarray[np.double_t, ndim=1] prob_items_given_tag(self, 
             int tag, np.ndarray[np.int_t, ndim=1] gamma_items)
     
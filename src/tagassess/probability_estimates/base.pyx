@@ -4,9 +4,29 @@
 '''This modules defines the base class which decorates other estimators'''
 
 cimport cython
+cimport openmp
+
+import numpy as np
 cimport numpy as np
 np.import_array()
 
+def set_num_threads(int num_threads):
+    '''
+    Sets the number of OpenMP threads used by estimators in parallel 
+    regions started from the calling thread (OpenMP keeps this setting per 
+    thread).
+    
+    Forked processes must set it to 1 before estimators are called if the 
+    parent has already used OpenMP, since with GCC's libgomp a parallel 
+    region with more threads after a fork may hang the child.
+    
+    Arguments
+    ---------
+    num_threads: int
+        Number of threads
+    '''
+    openmp.omp_set_num_threads(num_threads)
+
 cdef class ProbabilityEstimator:
     '''
     Base class for probability estimates. This class only defines the methods
@@ -53,6 +73,37 @@ cdef class ProbabilityEstimator:
         '''
         pass
     
+    cpdef np.ndarray[np.double_t, ndim=2] prob_items_given_user_tags(self,
+            int user, np.ndarray[np.int_t, ndim=1] tags, 
+            np.ndarray[np.int_t, ndim=1] gamma_items):
+        '''
+        Computes P(I|u,t) for every tag in `tags`, i.e., returns a matrix
+        where each row is the probability of each item given the user and the
+        tag. Row `j` is equal to `prob_items_given_user_tag(user, tags[j], 
+        gamma_items)`.
+        
+        This implementation simply calls `prob_items_given_user_tag` for each
+        tag. Subclasses should override it to share the per user computations.
+        
+        Arguments
+        ---------
+        user: int
+            User id
+        tags: int array
+            Tag ids
+        gamma_items:
+            Items to consider. 
+        '''
+        cdef Py_ssize_t n_tags = tags.shape[0]
+        cdef np.ndarray[np.double_t, ndim=2] return_val = \
+                np.ndarray((n_tags, gamma_items.shape[0]), dtype='d')
+        
+        cdef Py_ssize_t tag_idx
+        for tag_idx in range(n_tags):
+            return_val[tag_idx] = self.prob_items_given_user_tag(user, 
+                    tags[tag_idx], gamma_items)
+        return return_val
+    
     cpdef np.ndarray[np.double_t, ndim=1] prob_items_given_tag(self, 
             int tag, np.ndarray[np.int_t, ndim=1] gamma_items):
         '''
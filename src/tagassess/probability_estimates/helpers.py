@@ -9,12 +9,21 @@ from tagassess.probability_estimates.lda_estimator import LDAEstimator
 from tagassess.probability_estimates.smooth_estimator import SmoothEstimator
 
 def create_lda_estimator(annotations_it, gamma, num_items, num_tags, 
-        num_topics=200):
+        num_topics=200, num_workers=1, sampler='dense', checkpoint_fpath=None,
+        checkpoint_every=10, convergence_tol=0):
     '''
     Creates the lda estimator with the parameters described in [1]_. Alpha and
     Beta are defined as a function of the number of items and tags, thus only
     gamma is needed to be varied. 
     
+    When `num_workers` is greater than one, gibbs sampling is performed in 
+    parallel by that many threads (approximate distributed LDA). The
+    `sampler` can be 'dense' or 'alias', see `LDAEstimator`. If 
+    `checkpoint_fpath` is given, the sampler state is saved there every 
+    `checkpoint_every` iterations and sampling resumes from it if it exists.
+    A `convergence_tol` greater than zero turns the number of iterations and
+    burn in into upper bounds, sampling stops once the chain converges.
+    
     References
     ----------
     ..[1] Harvey, M., Ruthven, I., & Carman, M. J. (2011). 
@@ -31,7 +40,10 @@ def create_lda_estimator(annotations_it, gamma, num_items, num_tags,
     sample_every = 5 #based on the author thesis
     seed = 0 #time based seed
     lda_estimator = LDAEstimator(annotations_it, num_topics, alpha, beta, 
-            gamma, iterations, burn_in, sample_every, seed)
+            gamma, iterations, burn_in, sample_every, seed, num_workers, 
+            sampler, checkpoint_fpath=checkpoint_fpath, 
+            checkpoint_every=checkpoint_every, 
+            convergence_tol=convergence_tol)
     return lda_estimator
 
 def create_bayes_estimator(annotations, lambda_, user_profile_fract_size=.4):
@@ -24,9 +24,29 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
     cdef double gamma
     
     cdef Py_ssize_t curr_iter
+    cdef int useful_steps
+    cdef int likelihood_steps
+    
+    #Schedules of the likelihood computation and of the accumulation of
+    #probability matrices after burn in (thinning)
+    cdef int likelihood_every
+    cdef int accumulate_every
     cdef double[:] log_likelihoods_train
     cdef double final_log_likelihood
     
+    #Checkpoints are saved to this file every `checkpoint_every` iterations
+    cdef object checkpoint_fpath
+    cdef int checkpoint_every
+    
+    #Adaptive burn in and stopping, `burn_in_end` is the first iteration 
+    #after burn in (-1 while unknown).
+    cdef double convergence_tol
+    cdef int convergence_window
+    cdef int burn_in_end
+    cdef int converged
+    cdef list trace
+    cdef list prb_snapshot
+    
     #Indicates when are we going to sample from p(z|u) in gibbs routine.
     #Mimicks the parameter $\pi_u$.
     cdef int sample_user_dist_every
@@ -58,6 +78,53 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
     cdef int[:] annot_document
     cdef int[:] annot_term
     
+    #Approximate distributed sampling (AD-LDA). Annotations are split in
+    #`num_workers` shards grouped by user (`shard_annots` holds annotation
+    #ids ordered by user), so each worker owns the user x topic rows of its
+    #users. The shared counts are read only during a sweep, each worker keeps
+    #its changes to them as local deltas, merged after the sweep.
+    #
+    #Deltas are kept only for the documents and terms of each shard. The 
+    #columns of shard `w` are `shard_documents[shard_document_bounds[w]:
+    #shard_document_bounds[w + 1]]` (same for terms) and `annot_shard_document`
+    #is the position of the document of an annotation among them. The deltas
+    #of all shards are stored in a flat array, see `_delta_pos`.
+    cdef int num_workers
+    cdef int use_workers
+    cdef Py_ssize_t[::1] shard_annots
+    cdef Py_ssize_t[::1] shard_bounds
+    cdef int[::1] shard_documents
+    cdef int[::1] shard_terms
+    cdef Py_ssize_t[::1] shard_document_bounds
+    cdef Py_ssize_t[::1] shard_term_bounds
+    cdef int[::1] annot_shard_document
+    cdef int[::1] annot_shard_term
+    cdef int[::1] delta_topic_document_cnt
+    cdef int[::1] delta_topic_term_cnt
+    cdef int[:, ::1] delta_topic_cnt
+    cdef Py_ssize_t[::1] worker_annot
+    cdef double[:, ::1] worker_probs
+    cdef unsigned long long[::1] worker_rng
+    
+    #Sampler used for topics (dense or alias). The alias sampler uses one 
+    #alias table per term, document and user. Tables are rows x topics, with
+    #the proposal weights kept to compute the acceptance ratio.
+    cdef int sampler_id
+    cdef int mh_steps
+    cdef double[::1] topic_probs
+    
+    cdef double[:, ::1] term_alias_weight
+    cdef double[:, ::1] term_alias_prob
+    cdef int[:, ::1] term_alias_idx
+    cdef double[:, ::1] document_alias_weight
+    cdef double[:, ::1] document_alias_prob
+    cdef int[:, ::1] document_alias_idx
+    cdef double[:, ::1] user_alias_weight
+    cdef double[:, ::1] user_alias_prob
+    cdef int[:, ::1] user_alias_idx
+    cdef int[::1] alias_small
+    cdef int[::1] alias_large
+    
     #Populate methods
     cdef void _gibbs_populate(self, annotation_it)
     cdef void _populate_count_matrices(self, dict user_cnt, dict topic_cnt, 
@@ -67,7 +134,25 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
     cdef void _populate_annotations(self, list annotations_list)
    
     #Gibbs sample methods
-    cdef void _gibbs_sample(self)
+    cdef void _gibbs_sample(self) except *
+    cdef Py_ssize_t _load_checkpoint(self, fpath) except -1
+    cdef int _check_convergence(self, Py_ssize_t i, 
+                                int accumulated) except -1
+    cdef void _init_workers(self) except *
+    cdef void _gibbs_parallel_sweep(self, int sample_user)
+    cdef void _build_alias_tables(self) except *
+    cdef void _sample_shard(self, Py_ssize_t worker, int sample_user) nogil
+    cdef double _local_posterior(self, Py_ssize_t worker, int user, int topic,
+                                 int document, int term, 
+                                 int sample_user) nogil
+    cdef int _dense_sample(self, Py_ssize_t worker, int user, int document,
+                           int term, int sample_user) nogil
+    cdef int _alias_sample(self, Py_ssize_t worker, int user, int topic,
+                           int document, int term, int sample_user) nogil
+    cdef int _mh_step(self, Py_ssize_t worker, double[:, ::1] alias_weight,
+                      double[:, ::1] alias_prob, int[:, ::1] alias_idx, 
+                      int row, int user, int topic, int document, int term,
+                      int sample_user, double *posterior) nogil
     cpdef int _gibbs_update(self, int user, int old_topic, int document, 
                             int term, int sample_user)
     cdef double _get_likelihood(self)
@@ -13,9 +13,177 @@ import numpy as np
 cimport numpy as np
 np.import_array()
 
+import os
+
 #Log from C99
 cdef extern from "math.h":
-    double log(double)
+    double log(double) nogil
+
+cdef inline double _prior(int joint_count, int global_count, 
+                         int num_occurences, double parameter) nogil:
+    '''Same as `prior`, but can be called without the gil'''
+    cdef double numerator = parameter + joint_count
+    cdef double denominator = global_count + (parameter * num_occurences)
+    
+    if denominator == 0:
+        return 0
+
+    return numerator / denominator
+
+cdef inline double _rand_uniform(unsigned long long *state) nogil:
+    '''
+    Xorshift64* generator. Returns a uniform number in [0, 1). Used by the 
+    parallel workers, which cannot call numpy without the gil.
+    '''
+    cdef unsigned long long x = state[0]
+    x ^= x >> 12
+    x ^= x << 25
+    x ^= x >> 27
+    state[0] = x
+    return ((x * 2685821657736338717ULL) >> 11) * (1.0 / 9007199254740992.0)
+
+cdef int DENSE = 1
+cdef int ALIAS = 2
+
+#Records of the convergence trace when saved in checkpoints
+TRACE_DTYPE = [('iteration', 'i8'), ('phase', 'S8'), ('statistic', 'd'), 
+               ('decision', 'i4')]
+
+cdef void _build_alias(double[:, ::1] weights, double[:, ::1] alias_prob,
+                       int[:, ::1] alias_idx, int[::1] small, 
+                       int[::1] large) nogil:
+    '''
+    Builds one alias table (Vose's method) for each row of `weights`. After
+    this, a value proportional to `weights[row]` can be drawn in O(1) by 
+    picking a column `z` uniformly and returning `z` with probability 
+    `alias_prob[row, z]`, or `alias_idx[row, z]` otherwise.
+    
+    The `small` and `large` arrays are work buffers with one position per 
+    column.
+    '''
+    cdef Py_ssize_t num_rows = weights.shape[0]
+    cdef int num_cols = weights.shape[1]
+    cdef Py_ssize_t row
+    cdef int col, less, more, num_small, num_large
+    cdef double total
+    
+    for row in range(num_rows):
+        total = 0
+        for col in range(num_cols):
+            total += weights[row, col]
+        
+        num_small = 0
+        num_large = 0
+        for col in range(num_cols):
+            if total > 0:
+                alias_prob[row, col] = weights[row, col] * num_cols / total
+            else:
+                alias_prob[row, col] = 1
+            alias_idx[row, col] = col
+            
+            if alias_prob[row, col] < 1:
+                small[num_small] = col
+                num_small += 1
+            else:
+                large[num_large] = col
+                num_large += 1
+        
+        while num_small > 0 and num_large > 0:
+            num_small -= 1
+            num_large -= 1
+            less = small[num_small]
+            more = large[num_large]
+            
+            alias_idx[row, less] = more
+            alias_prob[row, more] -= 1 - alias_prob[row, less]
+            if alias_prob[row, more] < 1:
+                small[num_small] = more
+                num_small += 1
+            else:
+                large[num_large] = more
+                num_large += 1
+        
+        #Leftovers are only due to rounding errors
+        while num_large > 0:
+            num_large -= 1
+            alias_prob[row, large[num_large]] = 1
+        
+        while num_small > 0:
+            num_small -= 1
+            alias_prob[row, small[num_small]] = 1
+
+cdef double _count_log_likelihood(int[:, ::1] joint_cnt, int[:] row_cnt,
+                                 int num_occurences, double parameter) nogil:
+    '''
+    Log likelihood of the annotations with respect to one of the count 
+    matrices, where rows are the given variable (e.g. user_topic_cnt and 
+    user_cnt for p(z | u)). Annotations that fall on the same cell have the
+    same probability, so this is:
+    
+    .. math :: \sum_{y,x} N_{x,y} log(p(x | y))
+    
+    which requires one log per non-empty cell instead of one per annotation.
+    Rows are processed in parallel.
+    '''
+    cdef Py_ssize_t row, col
+    cdef int count
+    cdef double rv = 0
+    
+    for row in prange(joint_cnt.shape[0], schedule='static'):
+        for col in range(joint_cnt.shape[1]):
+            count = joint_cnt[row, col]
+            if count > 0:
+                rv += count * log(_prior(count, row_cnt[row], num_occurences,
+                                         parameter))
+    return rv
+
+cdef void _accumulate_prior(double[:, ::1] prb, int[:, ::1] joint_cnt, 
+                            int[:] row_cnt, int num_occurences, 
+                            double parameter) nogil:
+    '''
+    Adds the current estimate of each cell (see `prior`) to `prb`. Rows are 
+    processed in parallel.
+    '''
+    cdef Py_ssize_t row, col
+    
+    for row in prange(joint_cnt.shape[0], schedule='static'):
+        for col in range(joint_cnt.shape[1]):
+            prb[row, col] += _prior(joint_cnt[row, col], row_cnt[row], 
+                                    num_occurences, parameter)
+
+cdef inline Py_ssize_t _delta_pos(Py_ssize_t[::1] bounds, Py_ssize_t worker,
+                                  int topic, int local,
+                                  int num_topics) nogil:
+    '''
+    Position in a flat delta array of the cell (`topic`, `local`) of
+    `worker`. The deltas of a worker are a topics x columns block, where
+    columns are the ones its shard touches (`bounds[worker]` to
+    `bounds[worker + 1]`), and blocks are stored one after the other.
+    '''
+    cdef Py_ssize_t width = bounds[worker + 1] - bounds[worker]
+    return num_topics * bounds[worker] + topic * width + local
+
+cdef void _merge_deltas(int[:, ::1] joint_cnt, int[::1] delta,
+                        int[::1] columns, Py_ssize_t[::1] bounds) nogil:
+    '''
+    Adds the deltas of every worker (see `_delta_pos`) to `joint_cnt`, a
+    topics x columns matrix, and zeroes them for the next sweep. `columns`
+    maps the local columns of each worker to the ones of `joint_cnt`. Rows
+    are processed in parallel, the cost is proportional to the number of
+    columns touched by the shards and not to the size of `joint_cnt`.
+    '''
+    cdef int num_topics = joint_cnt.shape[0]
+    cdef Py_ssize_t num_workers = bounds.shape[0] - 1
+    cdef Py_ssize_t row, worker, local, pos
+
+    for row in prange(num_topics, schedule='static'):
+        for worker in range(num_workers):
+            pos = _delta_pos(bounds, worker, row, 0, num_topics)
+            for local in range(bounds[worker + 1] - bounds[worker]):
+                if delta[pos + local] != 0:
+                    joint_cnt[row, columns[bounds[worker] + local]] += \
+                            delta[pos + local]
+                    delta[pos + local] = 0
 
 cpdef double prior(int joint_count, int global_count, int num_occurences, 
                    double parameter):
@@ -69,6 +237,30 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
     where, \Theta, \Phi, \Psi correspond to p(w | z), p(d | z) and  p(z | u)
     respectively.
     
+    If `checkpoint_fpath` is given, the sampler state is saved to that (.npz)
+    file every `checkpoint_every` iterations and at the end of sampling. When 
+    the file already exists, sampling resumes from it instead of starting 
+    from iteration 0 (see `save_checkpoint`).
+    
+    If `convergence_tol` is greater than zero, `num_iterations` and 
+    `num_burn_in` are upper bounds. Burn in ends once the log likelihood 
+    chain reaches a plateau and sampling stops once the averaged posteriors
+    stabilize (see `_check_convergence`). The decisions taken are available 
+    at `convergence_trace`.
+    
+    The log likelihood is computed every `likelihood_every` iterations (and
+    always at the last one, or when sampling stops before any was computed
+    after burn in), skipped iterations are NaN in `chain_likelihood`. After burn in, the probability matrices are 
+    accumulated every `accumulate_every` iterations, i.e., the chain is 
+    thinned.
+    
+    Two samplers are available, chosen by the `sampler` parameter:
+    
+        * 'dense' -> computes the posterior for every topic, O(K) per
+          annotation. This is the default.
+        * 'alias' -> Metropolis-Hastings with proposals drawn from alias
+          tables (see `_alias_sample`), O(`mh_steps`) per annotation.
+    
     References
     ----------
     ..[1] Harvey, M., Ruthven, I., & Carman, M. J. (2011). 
@@ -79,13 +271,24 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
     '''
     def __init__(self, annotation_it, int num_topics, double alpha, double
                  beta, double gamma, int num_iterations, int num_burn_in,
-                 int sample_user_dist_every, int seed):
+                 int sample_user_dist_every, int seed, int num_workers=1,
+                 sampler='dense', int mh_steps=2, checkpoint_fpath=None,
+                 int checkpoint_every=0, double convergence_tol=0,
+                 int convergence_window=10, int likelihood_every=1,
+                 int accumulate_every=1):
         super(LDAEstimator, self).__init__()
         
         if seed > 0:
             np.random.seed(seed)
         
+        samplers = {'dense':DENSE,
+                    'alias':ALIAS}
+        
+        self.sampler_id = samplers[sampler]
+        self.mh_steps = mh_steps
+        
         self.num_topics = num_topics
+        self.topic_probs = np.zeros(num_topics, dtype='d')
         self.alpha = alpha
         self.beta = beta
         self.gamma = gamma
@@ -97,6 +300,23 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
         self.log_likelihoods_train = np.zeros(self.num_iterations, dtype='d')
         self.final_log_likelihood = 0
         self.sample_user_dist_every = sample_user_dist_every
+        self.num_workers = max(num_workers, 1)
+        self.useful_steps = 0
+        self.likelihood_steps = 0
+        self.likelihood_every = max(likelihood_every, 1)
+        self.accumulate_every = max(accumulate_every, 1)
+        self.checkpoint_fpath = checkpoint_fpath
+        self.checkpoint_every = checkpoint_every
+        
+        self.convergence_tol = convergence_tol
+        self.convergence_window = max(convergence_window, 1)
+        self.converged = 0
+        self.trace = []
+        self.prb_snapshot = []
+        if convergence_tol > 0 and num_burn_in > 0:
+            self.burn_in_end = -1
+        else:
+            self.burn_in_end = num_burn_in
         
         self._gibbs_populate(annotation_it)
         self._gibbs_sample()
@@ -261,7 +481,7 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
         
         return
     
-    cdef void _gibbs_sample(self):
+    cdef void _gibbs_sample(self) except *:
         '''
         Performs actual gibbs sampling. Most of this implementation is based on
         [1]_ and [2]_. It was based on a pseudocode described in [3]_ and a 
@@ -298,6 +518,20 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
             allocation," Standford University, vol. 18, no. 11, p. 3, 2002.
         [3] http://cxwangyi.files.wordpress.com/2012/01/llt.pdf
         [4] http://arbylon.net/projects/LdaGibbsSampler.java
+        
+        When `num_workers` > 1 each sweep is done by `_gibbs_parallel_sweep`,
+        an approximate distributed sampler as described in [5]_. The alias
+        sampler always runs through `_gibbs_parallel_sweep` (with a single 
+        worker the sweep is exact), its proposal tables are rebuilt from the
+        global counts before each sweep.
+        
+        Checkpoints are saved after the sweep (see `save_checkpoint`). 
+        Convergence is also tested after the sweep (`_check_convergence`), 
+        when enabled.
+        
+        [5] D. Newman, A. Asuncion, P. Smyth and M. Welling,
+            "Distributed Algorithms for Topic Models," 
+            Journal of Machine Learning Research, vol. 10, pp. 1801-1828, 2009.
         '''
         
         cdef int user = 0
@@ -305,15 +539,26 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
         cdef int document = 0
         cdef int term = 0
         cdef int new_topic = 0
-        cdef int useful_steps = 0
 
         cdef Py_ssize_t i = 0
+        cdef Py_ssize_t start = 0
         cdef Py_ssize_t annot = 0
         cdef double log_likelihood = 0
         
         cdef int sample_user = 1
+        cdef int accumulated = 0
+        self.use_workers = self.num_workers > 1 or self.sampler_id == ALIAS
         
-        for i from 0 <= i < self.num_iterations:
+        if self.use_workers:
+            self._init_workers()
+        
+        if self.checkpoint_fpath is not None and \
+                os.path.exists(self.checkpoint_fpath):
+            start = self._load_checkpoint(self.checkpoint_fpath)
+            if self.converged:
+                start = self.num_iterations
+        
+        for i from start <= i < self.num_iterations:
             self.curr_iter = i
             if ((i + 1) % self.sample_user_dist_every) == 0:
                 sample_user = 1
@@ -321,110 +566,633 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
                 sample_user = 0 
             
             log_likelihood = 0
-            for annot from 0 <= annot < self.num_annotations:
-                user = self.annot_user[annot]
-                old_topic = self.annot_topic[annot]
-                document = self.annot_document[annot]
-                term = self.annot_term[annot]
-                
-                #Update count matrices
-                new_topic = self._gibbs_update(user, old_topic, document, term,
-                                               sample_user)
-                self.annot_topic[annot] = new_topic
+            if self.use_workers:
+                if self.sampler_id == ALIAS:
+                    self._build_alias_tables()
+                self._gibbs_parallel_sweep(sample_user)
+            else:
+                for annot from 0 <= annot < self.num_annotations:
+                    user = self.annot_user[annot]
+                    old_topic = self.annot_topic[annot]
+                    document = self.annot_document[annot]
+                    term = self.annot_term[annot]
+                    
+                    #Update count matrices
+                    new_topic = self._gibbs_update(user, old_topic, document, 
+                                                   term, sample_user)
+                    self.annot_topic[annot] = new_topic
             
-            if i < self.num_burn_in:
-                log_likelihood = self._get_likelihood()
-            if i >= self.num_burn_in:
+            if (i + 1) % self.likelihood_every == 0 or \
+                    i == self.num_iterations - 1:
                 log_likelihood = self._get_likelihood()
+                if self.burn_in_end >= 0 and i >= self.burn_in_end:
+                    self.final_log_likelihood += log_likelihood
+                    self.likelihood_steps += 1
+            else:
+                log_likelihood = np.nan
+            
+            accumulated = self.burn_in_end >= 0 and i >= self.burn_in_end \
+                    and (i - self.burn_in_end) % self.accumulate_every == 0
+            if accumulated:
                 self._accumulate()
-                self.final_log_likelihood += log_likelihood
-                useful_steps += 1
+                self.useful_steps += 1
             
             self.log_likelihoods_train[i] = log_likelihood
+            
+            if self.convergence_tol > 0:
+                self.converged = self._check_convergence(i, accumulated)
+            
+            #Stopped before any likelihood after burn in was computed
+            if self.converged and self.likelihood_steps == 0:
+                log_likelihood = self._get_likelihood()
+                self.log_likelihoods_train[i] = log_likelihood
+                self.final_log_likelihood += log_likelihood
+                self.likelihood_steps += 1
+            
+            if self.checkpoint_fpath is not None and \
+                    (i == self.num_iterations - 1 or self.converged or
+                     (self.checkpoint_every > 0 and 
+                      (i + 1) % self.checkpoint_every == 0)):
+                self.save_checkpoint(self.checkpoint_fpath)
+            
+            if self.converged:
+                break
                 
         #Average out the sums which were considered
-        self.final_log_likelihood /= useful_steps
-        self._average_probs(useful_steps)
+        self.final_log_likelihood /= self.likelihood_steps
+        self._average_probs(self.useful_steps)
         return
 
-    cdef double _get_likelihood(self):
+    cdef int _check_convergence(self, Py_ssize_t i, 
+                                int accumulated) except -1:
         '''
-        Computes likelihood.
+        Convergence tests performed after iteration `i`, `accumulated` tells
+        if the probability matrices were accumulated in it. Returns 1 if 
+        sampling should stop. Let `w` be the `convergence_window`:
+        
+            * During burn in, the relative change between the means of the 
+              last two windows of `w` log likelihoods is computed. Burn in 
+              ends when it is below `convergence_tol`, or after `num_burn_in`
+              iterations.
+            * After burn in, every `w` samples the averaged probability 
+              matrices are compared with the ones from `w` samples before. 
+              Sampling stops when the relative L1 change is below
+              `convergence_tol`. Iterations skipped by `accumulate_every` 
+              add no sample, so they are not tested.
+        
+        Each test is stored in `trace` as (iteration, phase, statistic,
+        decision). Log likelihoods skipped by `likelihood_every` are ignored,
+        no test is done while a window has none.
         '''
-        cdef int user = 0
-        cdef int document = 0
-        cdef int term = 0
-        cdef int topic = 0
+        cdef int window = self.convergence_window
+        cdef double statistic
+        cdef int decision
+        
+        if self.burn_in_end < 0:
+            if i + 1 >= 2 * window:
+                chain = np.asarray(self.log_likelihoods_train)
+                curr = chain[i - window + 1:i + 1]
+                prev = chain[i - 2 * window + 1:i - window + 1]
+                curr = curr[~np.isnan(curr)]
+                prev = prev[~np.isnan(prev)]
+                if curr.shape[0] > 0 and prev.shape[0] > 0:
+                    statistic = abs(curr.mean() - prev.mean()) / \
+                            abs(prev.mean())
+                    decision = statistic < self.convergence_tol
+                    self.trace.append((i, 'burn_in', statistic, decision))
+                    if decision:
+                        self.burn_in_end = i + 1
+            
+            if self.burn_in_end < 0 and i + 1 >= self.num_burn_in:
+                self.burn_in_end = i + 1
+            return 0
+        
+        if not accumulated or self.useful_steps % window != 0:
+            return 0
+        
+        averaged = [np.asarray(self.user_topic_prb) / self.useful_steps,
+                    np.asarray(self.topic_document_prb) / self.useful_steps,
+                    np.asarray(self.topic_term_prb) / self.useful_steps]
+        
+        decision = 0
+        if self.prb_snapshot:
+            diff = 0.0
+            total = 0.0
+            for curr, prev in zip(averaged, self.prb_snapshot):
+                diff += np.abs(curr - prev).sum()
+                total += np.abs(prev).sum()
+            
+            statistic = diff / total
+            decision = statistic < self.convergence_tol
+            self.trace.append((i, 'sampling', statistic, decision))
         
-        cdef double p_topic_gv_user
-        cdef double p_document_gv_topic
-        cdef double p_term_gv_topic
-        cdef double log_likelihood = 0
+        self.prb_snapshot = averaged
+        return decision
+
+    def save_checkpoint(self, fpath):
+        '''
+        Saves the state of the sampler to the .npz file `fpath`. This is
+        the count matrices, the topic assignments, the sums of the
+        probability matrices accumulated after burn in, the likelihood chain
+        and the state of the random generators. The file is written to a 
+        temporary path first and then renamed, so a crash while saving 
+        does not destroy the previous checkpoint.
+        
+        This method is meant to be called during sampling (it is called by 
+        the sampler when `checkpoint_fpath` is set), afterwards the 
+        probability matrices are already averaged.
+        
+        Arguments
+        ---------
+        fpath: str
+            Path of the checkpoint
+        '''
+        
+        rng_name, rng_keys, rng_pos, rng_has_gauss, rng_gauss = \
+                np.random.get_state()
+        
+        if self.use_workers:
+            worker_rng = np.asarray(self.worker_rng)
+        else:
+            worker_rng = np.zeros(0, dtype=np.uint64)
+        
+        num_done = self.curr_iter + 1
+        trace = np.array(self.trace, dtype=TRACE_DTYPE)
+        snapshot = self.prb_snapshot or [np.zeros((0, 0))] * 3
+        tmp_fpath = fpath + '.tmp'
+        with open(tmp_fpath, 'wb') as tmp_file:
+            np.savez(tmp_file,
+                     num_done=num_done,
+                     num_topics=self.num_topics,
+                     useful_steps=self.useful_steps,
+                     likelihood_steps=self.likelihood_steps,
+                     final_log_likelihood=self.final_log_likelihood,
+                     log_likelihoods_train=\
+                             np.asarray(self.log_likelihoods_train)[:num_done],
+                     annot_user=np.asarray(self.annot_user),
+                     annot_document=np.asarray(self.annot_document),
+                     annot_term=np.asarray(self.annot_term),
+                     annot_topic=np.asarray(self.annot_topic),
+                     user_topic_cnt=np.asarray(self.user_topic_cnt),
+                     topic_document_cnt=np.asarray(self.topic_document_cnt),
+                     topic_term_cnt=np.asarray(self.topic_term_cnt),
+                     topic_cnt=np.asarray(self.topic_cnt),
+                     user_topic_prb=np.asarray(self.user_topic_prb),
+                     topic_document_prb=np.asarray(self.topic_document_prb),
+                     topic_term_prb=np.asarray(self.topic_term_prb),
+                     rng_keys=rng_keys,
+                     rng_pos=rng_pos,
+                     rng_has_gauss=rng_has_gauss,
+                     rng_gauss=rng_gauss,
+                     worker_rng=worker_rng,
+                     burn_in_end=self.burn_in_end,
+                     converged=self.converged,
+                     trace=trace,
+                     has_snapshot=len(self.prb_snapshot) > 0,
+                     user_topic_snapshot=snapshot[0],
+                     topic_document_snapshot=snapshot[1],
+                     topic_term_snapshot=snapshot[2])
+        os.rename(tmp_fpath, fpath)
+
+    cdef Py_ssize_t _load_checkpoint(self, fpath) except -1:
+        '''
+        Restores the state saved by `save_checkpoint` and returns the number
+        of iterations already done. The checkpoint must have been created 
+        with the same annotations and number of topics. The number of 
+        iterations may be larger than the one of the checkpointed run, in 
+        which case sampling continues the old chain.
+        '''
+        checkpoint = np.load(fpath)
+        try:
+            if checkpoint['num_topics'] != self.num_topics or \
+                    checkpoint['annot_user'].shape[0] != self.num_annotations \
+                    or (checkpoint['annot_user'] != 
+                        np.asarray(self.annot_user)).any() \
+                    or (checkpoint['annot_document'] != 
+                        np.asarray(self.annot_document)).any() \
+                    or (checkpoint['annot_term'] != 
+                        np.asarray(self.annot_term)).any():
+                raise ValueError('Checkpoint %s does not match annotations' 
+                                 % fpath)
+            
+            num_done = int(checkpoint['num_done'])
+            if num_done > self.num_iterations:
+                raise ValueError('Checkpoint %s has more iterations than %d' 
+                                 % (fpath, self.num_iterations))
+            
+            np.asarray(self.annot_topic)[:] = checkpoint['annot_topic']
+            np.asarray(self.user_topic_cnt)[:] = checkpoint['user_topic_cnt']
+            np.asarray(self.topic_document_cnt)[:] = \
+                    checkpoint['topic_document_cnt']
+            np.asarray(self.topic_term_cnt)[:] = checkpoint['topic_term_cnt']
+            np.asarray(self.topic_cnt)[:] = checkpoint['topic_cnt']
+            np.asarray(self.user_topic_prb)[:] = checkpoint['user_topic_prb']
+            np.asarray(self.topic_document_prb)[:] = \
+                    checkpoint['topic_document_prb']
+            np.asarray(self.topic_term_prb)[:] = checkpoint['topic_term_prb']
+            np.asarray(self.log_likelihoods_train)[:num_done] = \
+                    checkpoint['log_likelihoods_train']
+            
+            self.useful_steps = int(checkpoint['useful_steps'])
+            if 'likelihood_steps' in checkpoint.files:
+                self.likelihood_steps = int(checkpoint['likelihood_steps'])
+            else:
+                self.likelihood_steps = self.useful_steps
+            self.final_log_likelihood = \
+                    float(checkpoint['final_log_likelihood'])
+            self.curr_iter = num_done - 1
+            
+            np.random.set_state(('MT19937', checkpoint['rng_keys'], 
+                                 int(checkpoint['rng_pos']), 
+                                 int(checkpoint['rng_has_gauss']),
+                                 float(checkpoint['rng_gauss'])))
+            
+            self.burn_in_end = int(checkpoint['burn_in_end'])
+            self.converged = int(checkpoint['converged'])
+            self.trace = [tuple(x) for x in checkpoint['trace'].tolist()]
+            if checkpoint['has_snapshot']:
+                self.prb_snapshot = [checkpoint['user_topic_snapshot'],
+                                     checkpoint['topic_document_snapshot'],
+                                     checkpoint['topic_term_snapshot']]
+            
+            worker_rng = checkpoint['worker_rng']
+            if self.use_workers and worker_rng.shape[0] == self.num_workers:
+                np.asarray(self.worker_rng)[:] = worker_rng
+        finally:
+            checkpoint.close()
+        
+        return num_done
+
+    cdef void _init_workers(self) except *:
+        '''
+        Creates the shards and the delta buffers used by the parallel
+        workers. Annotations are ordered by user and split at user boundaries
+        in shards with about the same number of annotations. Each shard gets
+        deltas only for the documents and terms of its annotations, so the
+        buffers hold K * (D_w + W_w) ints per shard, at most K ints per
+        annotation. The random generator of each worker is seeded from numpy,
+        so the `seed` parameter still determines the chain.
+        '''
+        cdef int num_workers = self.num_workers
+        
+        users = np.asarray(self.annot_user)
+        order = users.argsort(kind='mergesort')
+        sorted_users = users[order]
+        user_starts = np.flatnonzero(np.r_[True, sorted_users[1:] != 
+                                                 sorted_users[:-1]])
+        
+        #Each shard ends at the first user starting after its target size
+        targets = np.linspace(0, self.num_annotations, num_workers + 1)
+        starts = np.r_[user_starts, self.num_annotations]
+        bounds = np.r_[0, starts[np.searchsorted(user_starts, targets[1:-1])],
+                       self.num_annotations]
+        
+        self.shard_annots = order.astype(np.intp)
+        self.shard_bounds = bounds.astype(np.intp)
+        
+        documents = np.asarray(self.annot_document)
+        terms = np.asarray(self.annot_term)
+        annot_shard_document = np.zeros(self.num_annotations, dtype='i')
+        annot_shard_term = np.zeros(self.num_annotations, dtype='i')
+        shard_documents = []
+        shard_terms = []
+        for worker in range(num_workers):
+            annots = order[bounds[worker]:bounds[worker + 1]]
+
+            columns, local = np.unique(documents[annots], return_inverse=True)
+            shard_documents.append(columns)
+            annot_shard_document[annots] = local
+
+            columns, local = np.unique(terms[annots], return_inverse=True)
+            shard_terms.append(columns)
+            annot_shard_term[annots] = local
+
+        self.annot_shard_document = annot_shard_document
+        self.annot_shard_term = annot_shard_term
+        self.shard_documents = np.concatenate(shard_documents).astype('i')
+        self.shard_terms = np.concatenate(shard_terms).astype('i')
+        self.shard_document_bounds = np.r_[0, np.cumsum([x.shape[0]
+                for x in shard_documents])].astype(np.intp)
+        self.shard_term_bounds = np.r_[0, np.cumsum([x.shape[0]
+                for x in shard_terms])].astype(np.intp)
 
-        cdef Py_ssize_t annot
-        for annot from 0 <= annot < self.num_annotations:
+        self.delta_topic_document_cnt = np.zeros(self.num_topics *
+                self.shard_documents.shape[0], dtype='i')
+        self.delta_topic_term_cnt = np.zeros(self.num_topics *
+                self.shard_terms.shape[0], dtype='i')
+        self.delta_topic_cnt = np.zeros((num_workers, self.num_topics),
+                                        dtype='i')
+
+        self.worker_annot = np.zeros(num_workers, dtype=np.intp)
+        self.worker_probs = np.zeros((num_workers, self.num_topics), dtype='d')
+        self.worker_rng = np.random.randint(1, 2 ** 62, 
+                size=num_workers).astype(np.uint64)
+        
+        if self.sampler_id == ALIAS:
+            self.term_alias_weight = np.zeros((self.num_terms, 
+                                               self.num_topics), dtype='d')
+            self.term_alias_prob = np.zeros((self.num_terms, self.num_topics),
+                                            dtype='d')
+            self.term_alias_idx = np.zeros((self.num_terms, self.num_topics),
+                                           dtype='i')
+            
+            self.document_alias_weight = np.zeros((self.num_documents, 
+                                                   self.num_topics), dtype='d')
+            self.document_alias_prob = np.zeros((self.num_documents, 
+                                                 self.num_topics), dtype='d')
+            self.document_alias_idx = np.zeros((self.num_documents, 
+                                                self.num_topics), dtype='i')
+            
+            self.user_alias_weight = np.zeros((self.num_users, 
+                                               self.num_topics), dtype='d')
+            self.user_alias_prob = np.zeros((self.num_users, self.num_topics),
+                                            dtype='d')
+            self.user_alias_idx = np.zeros((self.num_users, self.num_topics),
+                                           dtype='i')
+            
+            self.alias_small = np.zeros(self.num_topics, dtype='i')
+            self.alias_large = np.zeros(self.num_topics, dtype='i')
+        return
+    
+    cdef void _build_alias_tables(self) except *:
+        '''
+        Rebuilds the proposal tables of the alias sampler from the global 
+        counts. Proposals are p(w | z), p(d | z) and p(z | u) (without the
+        normalizing constant in the last case). Tables become stale during the
+        sweep, this is corrected by the acceptance step in `_mh_step`. The 
+        cost is O(K * (W + D + U)) per sweep, against O(K * N) of the dense
+        sampler.
+        '''
+        topic = np.asarray(self.topic_cnt)
+        
+        np.asarray(self.term_alias_weight)[:] = \
+                ((np.asarray(self.topic_term_cnt) + self.beta) / 
+                 (topic + self.num_terms * self.beta)[:, None]).T
+        np.asarray(self.document_alias_weight)[:] = \
+                ((np.asarray(self.topic_document_cnt) + self.alpha) / 
+                 (topic + self.num_documents * self.alpha)[:, None]).T
+        np.asarray(self.user_alias_weight)[:] = \
+                np.asarray(self.user_topic_cnt) + self.gamma
+        
+        with nogil:
+            _build_alias(self.term_alias_weight, self.term_alias_prob, 
+                         self.term_alias_idx, self.alias_small, 
+                         self.alias_large)
+            _build_alias(self.document_alias_weight, self.document_alias_prob,
+                         self.document_alias_idx, self.alias_small, 
+                         self.alias_large)
+            _build_alias(self.user_alias_weight, self.user_alias_prob, 
+                         self.user_alias_idx, self.alias_small, 
+                         self.alias_large)
+        return
+    
+    cdef void _gibbs_parallel_sweep(self, int sample_user):
+        '''
+        One AD-LDA sweep. Workers sample the topics of their shards in 
+        parallel (with OpenMP). User x topic counts are updated in place,
+        since each user belongs to a single shard. The document, term and 
+        topic counts are shared: workers only read them, seeing the counts 
+        at the start of the sweep plus their own changes, and the deltas of 
+        every worker are added to them after the sweep.
+        '''
+        cdef int num_workers = self.num_workers
+        cdef Py_ssize_t worker, topic
+        
+        with nogil:
+            for worker in prange(num_workers, schedule='static', chunksize=1,
+                                 num_threads=num_workers):
+                self._sample_shard(worker, sample_user)
+            
+            _merge_deltas(self.topic_document_cnt, 
+                          self.delta_topic_document_cnt, 
+                          self.shard_documents, self.shard_document_bounds)
+            _merge_deltas(self.topic_term_cnt, self.delta_topic_term_cnt,
+                          self.shard_terms, self.shard_term_bounds)
+            
+            for worker in range(num_workers):
+                for topic in range(self.num_topics):
+                    self.topic_cnt[topic] += \
+                            self.delta_topic_cnt[worker, topic]
+                    self.delta_topic_cnt[worker, topic] = 0
+        return
+    
+    cdef void _sample_shard(self, Py_ssize_t worker, int sample_user) nogil:
+        '''
+        Gibbs sweep over the shard of `worker`, changes to the shared counts
+        go to its deltas. This is the same update as `_gibbs_update`. The
+        annotation being sampled is kept at `worker_annot`, so that 
+        `_local_posterior` can find its deltas.
+        '''
+        cdef Py_ssize_t i, annot
+        cdef int user, document, term, old_topic, new_topic
+        cdef int local_document, local_term
+        
+        for i in range(self.shard_bounds[worker], 
+                       self.shard_bounds[worker + 1]):
+            annot = self.shard_annots[i]
             user = self.annot_user[annot]
-            topic = self.annot_topic[annot]
+            old_topic = self.annot_topic[annot]
             document = self.annot_document[annot]
             term = self.annot_term[annot]
-
-            p_topic_gv_user = self._est_prob_topic_given_user(user, topic)
-            p_document_gv_topic = self._est_prob_document_given_topic(topic, 
-                                                                  document)
-            p_term_gv_topic = self._est_prob_term_given_topic(topic, term)
+            local_document = self.annot_shard_document[annot]
+            local_term = self.annot_shard_term[annot]
+            self.worker_annot[worker] = annot
             
-            log_likelihood += log(p_topic_gv_user) + log(p_document_gv_topic) +\
-                    log(p_term_gv_topic)
-
-                
+            self.user_topic_cnt[user, old_topic] -= 1
+            self.delta_topic_document_cnt[_delta_pos(
+                    self.shard_document_bounds, worker, old_topic, 
+                    local_document, self.num_topics)] -= 1
+            self.delta_topic_term_cnt[_delta_pos(
+                    self.shard_term_bounds, worker, old_topic, local_term,
+                    self.num_topics)] -= 1
+            self.delta_topic_cnt[worker, old_topic] -= 1
+            
+            if self.sampler_id == ALIAS:
+                new_topic = self._alias_sample(worker, user, old_topic, 
+                                               document, term, sample_user)
+            else:
+                new_topic = self._dense_sample(worker, user, document, term,
+                                               sample_user)
+            
+            self.user_topic_cnt[user, new_topic] += 1
+            self.delta_topic_document_cnt[_delta_pos(
+                    self.shard_document_bounds, worker, new_topic, 
+                    local_document, self.num_topics)] += 1
+            self.delta_topic_term_cnt[_delta_pos(
+                    self.shard_term_bounds, worker, new_topic, local_term,
+                    self.num_topics)] += 1
+            self.delta_topic_cnt[worker, new_topic] += 1
+            self.annot_topic[annot] = new_topic
+    
+    cdef double _local_posterior(self, Py_ssize_t worker, int user, int topic,
+                                 int document, int term, 
+                                 int sample_user) nogil:
+        '''
+        Same as `_est_posterior_prob`, as seen by `worker` while sampling the
+        annotation at `worker_annot`.
+        '''
+        cdef Py_ssize_t annot = self.worker_annot[worker]
+        cdef int topic_cnt = self.topic_cnt[topic] + \
+                self.delta_topic_cnt[worker, topic]
+        cdef int document_delta = self.delta_topic_document_cnt[_delta_pos(
+                self.shard_document_bounds, worker, topic, 
+                self.annot_shard_document[annot], self.num_topics)]
+        cdef int term_delta = self.delta_topic_term_cnt[_delta_pos(
+                self.shard_term_bounds, worker, topic, 
+                self.annot_shard_term[annot], self.num_topics)]
+        cdef double rv = \
+            _prior(self.topic_document_cnt[topic, document] + document_delta,
+                   topic_cnt, self.num_documents, self.alpha) * \
+            _prior(self.topic_term_cnt[topic, term] + term_delta, 
+                   topic_cnt, self.num_terms, self.beta)
+        
+        #user_cnt is not changed by the update, so the z_-1 count for the 
+        #user is always user_cnt - 1
+        if sample_user == 1:
+            rv *= _prior(self.user_topic_cnt[user, topic], 
+                         self.user_cnt[user] - 1, self.num_topics, self.gamma)
+        return rv
+    
+    cdef int _dense_sample(self, Py_ssize_t worker, int user, int document,
+                           int term, int sample_user) nogil:
+        '''
+        Same as `_sample_topic`, using the counts, probability buffer and 
+        random generator of `worker`.
+        '''
+        cdef int topic
+        cdef double u
+        
+        for topic in range(self.num_topics):
+            self.worker_probs[worker, topic] = \
+                    self._local_posterior(worker, user, topic, document, term,
+                                          sample_user)
+            if topic > 0:
+                self.worker_probs[worker, topic] += \
+                        self.worker_probs[worker, topic - 1]
+        
+        u = _rand_uniform(&self.worker_rng[worker]) * \
+                self.worker_probs[worker, self.num_topics - 1]
+        for topic in range(self.num_topics):
+            if u < self.worker_probs[worker, topic]:
+                return topic
+        
+        return self.num_topics - 1
+    
+    cdef int _alias_sample(self, Py_ssize_t worker, int user, int topic,
+                           int document, int term, int sample_user) nogil:
+        '''
+        Draws a new topic for the annotation, currently assigned to `topic`,
+        with a Metropolis-Hastings chain as described in [1]_. Each of the
+        `mh_steps` steps cycles through proposals from p(w | z), p(d | z) and, 
+        when `sample_user` is set, p(z | u). Proposals are drawn in O(1) from
+        the alias tables, so the cost does not depend on the number of topics.
+        
+        References
+        ----------
+        [1] J. Yuan, F. Gao, Q. Ho, W. Dai, J. Wei, X. Zheng, E. P. Xing, 
+            T.-Y. Liu and W.-Y. Ma,
+            "LightLDA: Big Topic Models on Modest Computer Clusters," 
+            Proceedings of the 24th International Conference on World Wide 
+            Web - WWW '15. doi:10.1145/2736277.2741115
+        '''
+        cdef int step
+        cdef double posterior = self._local_posterior(worker, user, topic, 
+                                                      document, term, 
+                                                      sample_user)
+        
+        for step in range(self.mh_steps):
+            topic = self._mh_step(worker, self.term_alias_weight, 
+                                  self.term_alias_prob, self.term_alias_idx, 
+                                  term, user, topic, document, term, 
+                                  sample_user, &posterior)
+            topic = self._mh_step(worker, self.document_alias_weight,
+                                  self.document_alias_prob, 
+                                  self.document_alias_idx, document, user, 
+                                  topic, document, term, sample_user, 
+                                  &posterior)
+            if sample_user == 1:
+                topic = self._mh_step(worker, self.user_alias_weight, 
+                                      self.user_alias_prob, 
+                                      self.user_alias_idx, user, user, topic,
+                                      document, term, sample_user, &posterior)
+        
+        return topic
+    
+    cdef int _mh_step(self, Py_ssize_t worker, double[:, ::1] alias_weight,
+                      double[:, ::1] alias_prob, int[:, ::1] alias_idx, 
+                      int row, int user, int topic, int document, int term,
+                      int sample_user, double *posterior) nogil:
+        '''
+        One Metropolis-Hastings step. A topic is proposed from the alias table
+        `row` and accepted with probability:
+        
+        .. math::
+            min(1, p(t) q(s) / (p(s) q(t)))
+        
+        where `s` is the current topic, `t` the proposal, `p` the posterior and
+        `q` the (stale) proposal weights. `posterior` holds p(s) and is 
+        updated when the proposal is accepted.
+        '''
+        cdef unsigned long long *rng = &self.worker_rng[worker]
+        cdef int proposal = <int> (_rand_uniform(rng) * self.num_topics)
+        cdef double proposal_posterior
+        
+        if _rand_uniform(rng) >= alias_prob[row, proposal]:
+            proposal = alias_idx[row, proposal]
+        
+        if proposal == topic:
+            return topic
+        
+        proposal_posterior = self._local_posterior(worker, user, proposal, 
+                                                   document, term, sample_user)
+        if _rand_uniform(rng) * posterior[0] * alias_weight[row, proposal] < \
+                proposal_posterior * alias_weight[row, topic]:
+            posterior[0] = proposal_posterior
+            return proposal
+        
+        return topic
+    
+    cdef double _get_likelihood(self):
+        '''
+        Computes likelihood. This is the sum over annotations of
+        log(p(z | u)) + log(p(d | z)) + log(p(w | z)), computed from the count
+        matrices (see `_count_log_likelihood`).
+        '''
+        cdef double log_likelihood = 0
+        
+        with nogil:
+            log_likelihood += _count_log_likelihood(self.user_topic_cnt, 
+                                                    self.user_cnt, 
+                                                    self.num_topics,
+                                                    self.gamma)
+            log_likelihood += _count_log_likelihood(self.topic_document_cnt,
+                                                    self.topic_cnt,
+                                                    self.num_documents,
+                                                    self.alpha)
+            log_likelihood += _count_log_likelihood(self.topic_term_cnt,
+                                                    self.topic_cnt,
+                                                    self.num_terms, 
+                                                    self.beta)
         return log_likelihood
 
     cdef void _accumulate(self):
         '''Accumulates probability matrices'''
         
-        cdef int user = 0 
-        cdef int document = 0
-        cdef int term = 0
-        cdef int topic = 0
-
-        cdef double p_topic_gv_user
-        cdef double p_document_gv_topic
-        cdef double p_term_gv_topic
- 
-        for topic from 0 <= topic < self.num_topics:
-            for user from 0 <= user < self.num_users:
-                p_topic_gv_user = self._est_prob_topic_given_user(user, topic)
-                self.user_topic_prb[user, topic] += p_topic_gv_user
-            
-            for document from 0 <= document < self.num_documents:
-                p_document_gv_topic = self._est_prob_document_given_topic(topic,
-                        document)
-                self.topic_document_prb[topic, document] += p_document_gv_topic
-            
-            for term from 0 <= term < self.num_terms:
-                p_term_gv_topic = self._est_prob_term_given_topic(topic, term)
-                self.topic_term_prb[topic, term] += p_term_gv_topic
-
+        with nogil:
+            _accumulate_prior(self.user_topic_prb, self.user_topic_cnt, 
+                              self.user_cnt, self.num_topics, self.gamma)
+            _accumulate_prior(self.topic_document_prb, self.topic_document_cnt,
+                              self.topic_cnt, self.num_documents, self.alpha)
+            _accumulate_prior(self.topic_term_prb, self.topic_term_cnt,
+                              self.topic_cnt, self.num_terms, self.beta)
         return
 
     cdef void _average_probs(self, int num_runs):
         '''Averages out probability matrices'''
         
-        cdef int user = 0
-        cdef int document = 0
-        cdef int term = 0
-        cdef int topic = 0
-        
-        for topic from 0 <= topic < self.num_topics:
-            for user from 0 <= user < self.num_users:
-                self.user_topic_prb[user, topic] /= num_runs
-            
-            for document from 0 <= document < self.num_documents:
-                self.topic_document_prb[topic, document] /= num_runs
-            
-            for term from 0 <= term < self.num_terms:
-                self.topic_term_prb[topic, term] /= num_runs
-        
+        np.asarray(self.user_topic_prb)[:] /= num_runs
+        np.asarray(self.topic_document_prb)[:] /= num_runs
+        np.asarray(self.topic_term_prb)[:] /= num_runs
         return
         
     cpdef int _gibbs_update(self, int user, int old_topic, 
@@ -463,8 +1231,7 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
         is based on the posterior.
         '''
         
-        cdef np.ndarray[dtype=np.double_t, ndim=1] probs = \
-                np.ndarray(self.num_topics, dtype='d') 
+        cdef double[::1] probs = self.topic_probs
         
         #The probs array will have values proportional to the probabilities.
         cdef int topic
@@ -583,6 +1350,21 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
     def get_iter(self):
         return self.curr_iter
 
+    def get_burn_in(self):
+        '''
+        Number of burn in iterations. When the burn in is adaptive and has not
+        ended this is -1.
+        '''
+        return self.burn_in_end
+
+    def convergence_trace(self):
+        '''
+        Returns the convergence tests performed as a list of tuples
+        (iteration, phase, statistic, decision). Phase is 'burn_in' or 
+        'sampling', and decision indicates if the phase has ended.
+        '''
+        return list(self.trace)
+
     def _get_topic_counts(self):
         return np.asarray(self.topic_cnt)
 
@@ -714,6 +1496,39 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
 
         return vpi_tu
 
+    cpdef np.ndarray[np.double_t, ndim=2] prob_items_given_user_tags(self,
+            int user, np.ndarray[np.int_t, ndim=1] tags, 
+            np.ndarray[np.int_t, ndim=1] gamma_items):
+        '''
+        Computes P(I|t, u) for every tag in `tags`, i.e., returns a matrix
+        where each row is the probability of each item given the user and the
+        tag. Row `j` is equal to `prob_items_given_user_tag(user, tags[j], 
+        gamma_items)`.
+        
+        The user part, p(z | u) p(i | z), is computed once for all tags and 
+        the sum over topics becomes a single matrix product:
+        
+        .. math::
+            p(I|T, u) \propto \Theta_{T}^T (\Psi_{u} \Phi_{I})
+        
+        Arguments
+        ---------
+        user: int
+            User id
+        tags: int array
+            Tag ids
+        gamma_items:
+            Items to consider. 
+        '''
+        user_topic = np.asarray(self.user_topic_prb)[user]
+        topic_items = np.asarray(self.topic_document_prb)[:, gamma_items]
+        topic_tags = np.asarray(self.topic_term_prb)[:, tags]
+        
+        cdef np.ndarray[np.double_t, ndim=2] vpi_tu = \
+                topic_tags.T.dot(user_topic[:, np.newaxis] * topic_items)
+        vpi_tu /= vpi_tu.sum(axis=1)[:, np.newaxis]
+        return vpi_tu
+
     cpdef np.ndarray[np.double_t, ndim=1] prob_items_given_tag(self, 
             int tag, np.ndarray[np.int_t, ndim=1] gamma_items):
         '''
@@ -802,7 +1617,9 @@ cdef class LDAEstimator(base.ProbabilityEstimator):
         return vp_i
 
     def chain_likelihood(self):
-        return np.asarray(self.log_likelihoods_train)
+        '''Log likelihood of each iteration performed'''
+        num_done = min(self.curr_iter + 1, self.num_iterations)
+        return np.asarray(self.log_likelihoods_train)[:num_done]
     
     cpdef double log_likelihood(self):
         return self.final_log_likelihood
@@ -8,7 +8,12 @@ cimport numpy as np
 
 cdef class PrecomputedEstimator(base.ProbabilityEstimator):
     
+    cdef object store
+    cdef bint lazy
     cdef list users_fpaths
+    cdef dict user_to_fpath
+    cdef object file_cache
+    cdef object array_cache
     cdef dict user_to_piu
     cdef dict user_to_pitu
     cdef dict user_to_tags
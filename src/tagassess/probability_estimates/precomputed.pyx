@@ -1,24 +1,64 @@
 # -*- coding: utf8
 '''Probability based on pre-computed values'''
 
+from tagassess.common import LRUCache
+from tagassess.probability_estimates.precomputed_store import is_store
+from tagassess.probability_estimates.precomputed_store import ProbabilityStore
+
 cimport base
 
 import glob
 import os
 import tables
 
+def _user_id(user_fpath):
+    '''Id of the user from the name of its file (user-<id>.h5)'''
+    return int(user_fpath.split('-')[-1].split('.')[0])
+
 cdef class PrecomputedEstimator(base.ProbabilityEstimator):
+    '''
+    Returns probabilities computed previously (see scripts/GridSearch.py).
+    The folder is either a consolidated store (see `precomputed_store`),
+    which is memory mapped, or has one `user-<id>.h5` file per user.
     
-    def __init__(self, probabilities_folder):
-        user_files = os.path.join(probabilities_folder, 'user-*.h5')
-        self.users_fpaths = glob.glob(user_files)
+    User files are all read when the estimator is created, unless `lazy` is
+    set. In this case arrays are only read when requested and are kept in a
+    LRU cache of at most `max_cached_bytes`, along with at most
+    `max_open_files` open files (see `cache_stats`).
+    '''
+    
+    def __init__(self, probabilities_folder, lazy=False, max_open_files=32,
+                 max_cached_bytes=256 * 1024 * 1024):
+        self.store = None
+        self.lazy = lazy
+        self.users_fpaths = []
+        self.user_to_fpath = {}
         self.user_to_piu = {}
         self.user_to_pitu = {}
         self.user_to_tags = {}
         self.user_to_gamma = {}
+        self.file_cache = None
+        self.array_cache = None
+        
+        if is_store(probabilities_folder):
+            self.store = ProbabilityStore(probabilities_folder)
+            return
+        
+        user_files = os.path.join(probabilities_folder, 'user-*.h5')
+        self.users_fpaths = glob.glob(user_files)
+        
+        if lazy:
+            for user_fpath in self.users_fpaths:
+                self.user_to_fpath[_user_id(user_fpath)] = user_fpath
+            
+            self.file_cache = LRUCache(max_open_files, self.__open_user_file,
+                    on_evict=lambda user, h5file: h5file.close())
+            self.array_cache = LRUCache(max_cached_bytes, self.__read_node,
+                    size_func=lambda array: array.nbytes)
+            return
         
         for user_fpath in self.users_fpaths:
-            user_id = int(user_fpath.split('-')[-1].split('.')[0])
+            user_id = _user_id(user_fpath)
             
             h5file = tables.openFile(user_fpath, mode='r')
             
@@ -38,13 +78,31 @@ cdef class PrecomputedEstimator(base.ProbabilityEstimator):
                     self.user_to_tags[user_id].add(tag_id)
                         
             h5file.close()
-            
+    
+    def __open_user_file(self, user):
+        '''Opens the file of the user, used by the file cache'''
+        return tables.openFile(self.user_to_fpath[user], mode='r')
+    
+    def __read_node(self, key):
+        '''Reads an array of the user, used by the array cache'''
+        user, name = key
+        h5file = self.file_cache[user]
+        return h5file.getNode(h5file.root, name).read()
+    
     cpdef np.ndarray[np.float_t, ndim=1] prob_items_given_user(self, 
             int user, np.ndarray[np.int_t, ndim=1] gamma_items):
+        if self.store is not None:
+            return self.store.piu(user)
+        if self.lazy:
+            return self.array_cache[user, 'piu']
         return self.user_to_piu[user]
     
     cpdef np.ndarray[np.float_t, ndim=1] prob_items_given_user_tag(self,
             int user, int tag, np.ndarray[np.int_t, ndim=1] gamma_items):
+        if self.store is not None:
+            return self.store.pitu(user, tag)
+        if self.lazy:
+            return self.array_cache[user, 'pitu_tag_%d' % tag]
         return self.user_to_pitu[user, tag]
     
     cpdef np.ndarray[np.float_t, ndim=1] prob_items_given_tag(self,
@@ -56,10 +114,48 @@ cdef class PrecomputedEstimator(base.ProbabilityEstimator):
         return None
     
     def get_valid_users(self):
+        if self.store is not None:
+            return self.store.get_users()
+        if self.lazy:
+            return self.user_to_fpath.keys()
         return self.user_to_tags.keys()
     
     def tags_for_user(self, user):
+        if self.store is not None:
+            return set(self.store.tags(user))
+        if self.lazy:
+            if user not in self.user_to_tags:
+                h5file = self.file_cache[user]
+                self.user_to_tags[user] = set(
+                        int(node.name.split('_')[-1]) 
+                        for node in h5file.iterNodes(h5file.root)
+                        if 'pitu' in node.name)
+            return self.user_to_tags[user]
         return self.user_to_tags[user]
     
     def gamma_for_user(self, user):
+        if self.store is not None:
+            return self.store.gamma_items(user)
+        if self.lazy:
+            return self.array_cache[user, 'gamma']
         return self.user_to_gamma[user]
+    
+    def cache_stats(self):
+        '''
+        Returns the hits and misses of the file and array caches used in 
+        lazy mode, `None` otherwise.
+        '''
+        if not self.lazy or self.store is not None:
+            return None
+        
+        return {'file_hits':self.file_cache.hits,
+                'file_misses':self.file_cache.misses,
+                'array_hits':self.array_cache.hits,
+                'array_misses':self.array_cache.misses,
+                'cached_bytes':self.array_cache.size}
+    
+    def close(self):
+        '''Closes files kept open in lazy mode'''
+        if self.file_cache is not None:
+            self.array_cache.clear()
+            self.file_cache.clear()
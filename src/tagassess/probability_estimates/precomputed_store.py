@@ -0,0 +1,237 @@
+# -*- coding: utf8
+'''
+Consolidated storage of pre-computed probabilities. A store is a folder with
+a `manifest.json` file and:
+
+    * `probs.f8`: every probability vector, contiguous little endian doubles
+    * `gamma.i8`: the gamma items of every user, little endian int64
+    * `users.npy`: one record per user (user, num_items, gamma and p(i|u)
+      offsets)
+    * `pitu.npy`: one record per (user, tag), sorted, with the offset of
+      p(i|t,u)
+
+Every vector of an user has one value for each of the user gamma items.
+Readers map the data files, so opening a store only reads the (small) index
+files and vectors are only read from disk when used.
+'''
+from __future__ import division, print_function
+
+import json
+import os
+import numpy as np
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+PROBS_DTYPE = np.dtype('<f8')
+GAMMA_DTYPE = np.dtype('<i8')
+
+USERS_DTYPE = np.dtype([('user', '<i8'), ('num_items', '<i8'),
+                        ('gamma_offset', '<i8'), ('piu_offset', '<i8')])
+PITU_DTYPE = np.dtype([('key', '<i8'), ('offset', '<i8')])
+
+def is_store(fpath):
+    '''Indicates if the folder is a probability store'''
+    return os.path.exists(os.path.join(fpath, MANIFEST))
+
+def _pack(users, tags):
+    '''Packs user and tag ids in a single int64 key (user << 32 | tag)'''
+    return (np.asarray(users, dtype=np.int64) << 32) | \
+            (np.asarray(tags, dtype=np.int64) & 0xFFFFFFFF)
+
+def _map(fpath, dtype, size):
+    '''
+    Copy on write memory map of the file. Arrays can be used where writable
+    buffers are required but are never written back to disk.
+    '''
+    if size == 0: #np.memmap does not map empty files
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(fpath, dtype=dtype, mode='c', shape=(size,))
+
+class ProbabilityStoreWriter(object):
+    '''
+    Writes a probability store. Vectors are appended to the data files as
+    users are added, the index files and the manifest are written on `close`.
+
+    Arguments
+    ---------
+    fpath: str
+        Folder of the store, created if it does not exist
+    '''
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        if not os.path.exists(fpath):
+            os.makedirs(fpath)
+
+        #The data files of an old store are truncated below, it must not
+        #look complete until the new manifest is written
+        manifest_fpath = os.path.join(fpath, MANIFEST)
+        if os.path.exists(manifest_fpath):
+            os.remove(manifest_fpath)
+
+        self.probs_file = open(os.path.join(fpath, 'probs.f8'), 'wb')
+        self.gamma_file = open(os.path.join(fpath, 'gamma.i8'), 'wb')
+        self.probs_size = 0
+        self.gamma_size = 0
+
+        self.users = []
+        self.pitu_keys = []
+        self.pitu_offsets = []
+
+    def __write_probs(self, probs, num_items):
+        '''Appends a vector to the probs file, returns its offset'''
+        probs = np.asarray(probs, dtype=PROBS_DTYPE)
+        if probs.shape != (num_items,):
+            raise ValueError('Expected %d probabilities, got %s' %
+                             (num_items, probs.shape))
+
+        offset = self.probs_size
+        self.probs_file.write(probs.tobytes())
+        self.probs_size += num_items
+        return offset
+
+    def add_user(self, user, gamma_items, piu, pitu):
+        '''
+        Adds the probabilities of one user.
+
+        Arguments
+        ---------
+        user: int
+            The user id
+        gamma_items: int array
+            Items for which probabilities were computed
+        piu: float array
+            p(i|u) for each gamma item
+        pitu: dict of tag to float array
+            p(i|t,u) for each tag and gamma item
+        '''
+        gamma_items = np.asarray(gamma_items, dtype=GAMMA_DTYPE)
+        num_items = gamma_items.shape[0]
+
+        gamma_offset = self.gamma_size
+        self.gamma_file.write(gamma_items.tobytes())
+        self.gamma_size += num_items
+
+        piu_offset = self.__write_probs(piu, num_items)
+        self.users.append((user, num_items, gamma_offset, piu_offset))
+
+        for tag in sorted(pitu):
+            self.pitu_keys.append(int(_pack(user, tag)))
+            self.pitu_offsets.append(self.__write_probs(pitu[tag],
+                                                        num_items))
+
+    def close(self):
+        '''Writes the index files and the manifest'''
+        if self.probs_file is None:
+            return
+
+        self.probs_file.close()
+        self.gamma_file.close()
+        self.probs_file = None
+        self.gamma_file = None
+
+        users = np.array(self.users, dtype=USERS_DTYPE)
+        users.sort(order='user')
+        if np.any(users['user'][1:] == users['user'][:-1]):
+            raise ValueError('Users added more than once')
+        np.save(os.path.join(self.fpath, 'users.npy'), users)
+
+        pitu = np.zeros(len(self.pitu_keys), dtype=PITU_DTYPE)
+        pitu['key'] = self.pitu_keys
+        pitu['offset'] = self.pitu_offsets
+        pitu.sort(order='key')
+        np.save(os.path.join(self.fpath, 'pitu.npy'), pitu)
+
+        #Written last, a store without a manifest is incomplete
+        manifest = {'version':VERSION,
+                    'num_users':int(users.shape[0]),
+                    'num_pitu':int(pitu.shape[0]),
+                    'probs_size':self.probs_size,
+                    'gamma_size':self.gamma_size}
+        with open(os.path.join(self.fpath, MANIFEST), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        '''
+        Closes the store. On errors (including interruptions) the data files
+        are closed but no manifest is written, so the incomplete store is not
+        read. Errors are never suppressed.
+        '''
+        if value is None:
+            self.close()
+        else:
+            self.probs_file.close()
+            self.gamma_file.close()
+            self.probs_file = None
+            self.gamma_file = None
+        return False
+
+class ProbabilityStore(object):
+    '''
+    Reads a probability store written by `ProbabilityStoreWriter`. Vectors
+    returned are views of the mapped data files.
+
+    Arguments
+    ---------
+    fpath: str
+        Folder of the store
+    '''
+
+    def __init__(self, fpath):
+        if not is_store(fpath):
+            raise IOError('%s is not a probability store' % fpath)
+
+        with open(os.path.join(fpath, MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        self.fpath = fpath
+        self.user_index = np.load(os.path.join(fpath, 'users.npy'))
+        self.pitu_index = np.load(os.path.join(fpath, 'pitu.npy'))
+        self.probs = _map(os.path.join(fpath, 'probs.f8'), PROBS_DTYPE,
+                          manifest['probs_size'])
+        self.gamma = _map(os.path.join(fpath, 'gamma.i8'), GAMMA_DTYPE,
+                          manifest['gamma_size'])
+
+    def __user(self, user):
+        '''Returns the record of the user, raises KeyError if not found'''
+        pos = np.searchsorted(self.user_index['user'], user)
+        if pos == self.user_index.shape[0] or self.user_index['user'][pos] != user:
+            raise KeyError(user)
+        return self.user_index[pos]
+
+    def get_users(self):
+        '''Returns the users in the store'''
+        return self.user_index['user'].tolist()
+
+    def gamma_items(self, user):
+        '''Returns the gamma items of the user'''
+        record = self.__user(user)
+        start = record['gamma_offset']
+        return self.gamma[start:start + record['num_items']]
+
+    def piu(self, user):
+        '''Returns p(i|u) for the gamma items of the user'''
+        record = self.__user(user)
+        start = record['piu_offset']
+        return self.probs[start:start + record['num_items']]
+
+    def pitu(self, user, tag):
+        '''Returns p(i|t,u) for the gamma items of the user'''
+        record = self.__user(user)
+        key = _pack(user, tag)
+        pos = np.searchsorted(self.pitu_index['key'], key)
+        if pos == self.pitu_index.shape[0] or self.pitu_index['key'][pos] != key:
+            raise KeyError((user, tag))
+
+        start = self.pitu_index['offset'][pos]
+        return self.probs[start:start + record['num_items']]
+
+    def tags(self, user):
+        '''Returns the tags with p(i|t,u) values for the user'''
+        start, end = np.searchsorted(self.pitu_index['key'],
+                                     [_pack(user, 0), _pack(user + 1, 0)])
+        return (self.pitu_index['key'][start:end] & 0xFFFFFFFF).tolist()
@@ -23,13 +23,57 @@ cdef class SmoothEstimator(base.ProbabilityEstimator):
     cdef int[::1] tag_col_freq
     cdef int[::1] item_local_sums
     
+    #Item x tag frequencies as a CSR matrix. The memoryviews point to the
+    #indptr, indices and data arrays of the scipy matrix.
+    cdef object item_tag_csr
+    cdef int[::1] item_tag_indptr
+    cdef int[::1] item_tag_indices
+    cdef int[::1] item_tag_counts
+    
+    #Log space model used by the batched methods. log p(t|i) is decomposed
+    #into a background (tag and item vectors) plus a sparse correction which
+    #is only non-zero where the tag annotated the item.
+    cdef double[::1] log_bg_tag
+    cdef double[::1] log_bg_item
+    cdef object log_delta_csr
+    
     #Auxiliary dictionaries
-    cdef dict item_tag_freq
     cdef dict user_tags 
     cdef double user_profile_fract_size
+    
+    #User x tag counts (scipy CSR matrix) and ids of users with annotations,
+    #kept so that profiles can be rebuilt by `set_params`
+    cdef object user_tag_csr
+    cdef object existing_users
  
+    cdef int _item_tag_freq(self, int item, int tag)
+    
     cpdef double prob_item(self, int item)
 
     cpdef double prob_tag_given_item(self, int item, int tag)
     
-    cpdef double prob_user_given_item(self, int item, int user) 
\ No newline at end of file
+    cpdef double prob_user_given_item(self, int item, int user)
+
+    cpdef double log_prob_item(self, int item)
+
+    cpdef double log_prob_tag_given_item(self, int item, int tag)
+    
+    cpdef double log_prob_user_given_item(self, int item, int user)
+    
+    cpdef np.ndarray[np.double_t, ndim=1] log_prob_items_given_user(self, 
+            int user, np.ndarray[np.int_t, ndim=1] gamma_items)
+
+    cpdef np.ndarray[np.double_t, ndim=1] log_prob_items_given_user_tag(self,
+            int user, int tag, np.ndarray[np.int_t, ndim=1] gamma_items)
+
+    cpdef np.ndarray[np.double_t, ndim=2] log_prob_items_given_user_tags(self,
+            int user, np.ndarray[np.int_t, ndim=1] tags, 
+            np.ndarray[np.int_t, ndim=1] gamma_items)
+
+    cpdef np.ndarray[np.double_t, ndim=2] prob_items_given_users(self,
+            np.ndarray[np.int_t, ndim=1] users, 
+            np.ndarray[np.int_t, ndim=1] gamma_items)
+
+    cpdef np.ndarray[np.double_t, ndim=2] log_prob_items_given_users(self,
+            np.ndarray[np.int_t, ndim=1] users, 
+            np.ndarray[np.int_t, ndim=1] gamma_items)
\ No newline at end of file
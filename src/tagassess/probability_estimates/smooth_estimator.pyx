@@ -7,7 +7,7 @@
 
 from __future__ import division, print_function
 
-from collections import defaultdict
+from scipy import sparse
 
 from tagassess.probability_estimates.smooth cimport bayes
 from tagassess.probability_estimates.smooth cimport jelinek_mercer
@@ -19,9 +19,43 @@ cimport base
 cimport numpy as np
 np.import_array()
 
+#Log and exp from C99
+cdef extern from "math.h":
+    double exp(double)
+    double log(double)
+
 cdef int JM = 1
 cdef int BAYES = 2
 
+cdef double NAN = float('nan')
+cdef double NEG_INF = float('-inf')
+
+cdef void log_normalize(np.ndarray[np.double_t, ndim=1] log_probs):
+    '''
+    Rescales, in place, an array of log probabilities so that the 
+    probabilities sum to one. Uses the log-sum-exp trick to avoid underflow.
+    If every value is -inf (every probability is zero) the result is NaN.
+    '''
+    cdef Py_ssize_t n = log_probs.shape[0]
+    cdef Py_ssize_t i
+    cdef double max_log = NEG_INF
+    for i in range(n):
+        if log_probs[i] > max_log:
+            max_log = log_probs[i]
+    
+    if max_log == NEG_INF:
+        for i in range(n):
+            log_probs[i] = NAN
+        return
+    
+    cdef double sum_exp = 0
+    for i in range(n):
+        sum_exp += exp(log_probs[i] - max_log)
+    
+    cdef double log_sum = max_log + log(sum_exp)
+    for i in range(n):
+        log_probs[i] -= log_sum
+
 cdef class SmoothEstimator(base.ProbabilityEstimator):
     '''
     Implementation of a similar approach as proposed in:
@@ -51,10 +85,33 @@ cdef class SmoothEstimator(base.ProbabilityEstimator):
         self.smooth_func_id = smooths[smooth_method]
         self.lambda_ = lambda_
         
-        self.item_tag_freq = {}
         self.user_tags = {}
         self.user_profile_fract_size = user_profile_fract_size
         self.__populate(annotation_it)
+        self.__build_user_profiles()
+        self.__build_log_model()
+    
+    def set_params(self, lambda_=None, user_profile_fract_size=None):
+        '''
+        Changes the smoothing parameter and/or the fraction of tags in user
+        profiles. Counts are kept, only the models depending on the changed
+        parameters are rebuilt, so this is the same as creating a new 
+        estimator with the same annotations but much cheaper.
+        
+        Arguments
+        ---------
+        lambda_ (optional): double
+            The new smoothing parameter
+        user_profile_fract_size (optional): double
+            The new fraction of tags in user profiles
+        '''
+        if user_profile_fract_size is not None:
+            self.user_profile_fract_size = user_profile_fract_size
+            self.__build_user_profiles()
+        
+        if lambda_ is not None:
+            self.lambda_ = lambda_
+            self.__build_log_model()
         
     def __populate(self, annotation_it):
         '''
@@ -65,60 +122,85 @@ cdef class SmoothEstimator(base.ProbabilityEstimator):
         annotation_it: iterable
             An iterable with annotations
         '''
-        tag_col_dict = defaultdict(int)
-        item_col_dict = defaultdict(int)
-        item_tag_dict = defaultdict(lambda: defaultdict(int))
-        user_tags_dict = defaultdict(lambda: defaultdict(int))
-        
-        max_tag = 0
-        max_item = 0
-        
-        #For this class we need user and item indexes
-        self.n_annotations = 0
+        users = []
+        items = []
+        tags = []
         for annotation in annotation_it:
-            self.n_annotations += 1
-            
-            #Initial updates
-            tag = annotation['tag']
-            item = annotation['item']
-            user = annotation['user']
-            
-            tag_col_dict[tag] += 1
-            item_col_dict[item] += 1
-            item_tag_dict[item][tag] += 1
-            user_tags_dict[user][tag] += 1
-            
-            #Tag, item and user id space being defined            
-            if tag > max_tag:
-                max_tag = tag
-                
-            if item > max_item:
-                max_item = item
+            users.append(annotation['user'])
+            items.append(annotation['item'])
+            tags.append(annotation['tag'])
+        
+        cdef np.ndarray[np.int_t, ndim=1] users_arr = \
+                np.asarray(users, dtype=np.int)
+        cdef np.ndarray[np.int_t, ndim=1] items_arr = \
+                np.asarray(items, dtype=np.int)
+        cdef np.ndarray[np.int_t, ndim=1] tags_arr = \
+                np.asarray(tags, dtype=np.int)
+        
+        #Tag, item and user id space being defined
+        self.n_annotations = items_arr.shape[0]
+        self.n_tags = 1
+        self.n_items = 1
+        if self.n_annotations > 0:
+            self.n_tags = max(tags_arr.max(), 0) + 1
+            self.n_items = max(items_arr.max(), 0) + 1
         
         #Initializing arrays
-        self.n_tags = max_tag + 1
-        self.n_items = max_item + 1
-        self.n_users = len(user_tags_dict)
-        
-        self.tag_col_freq = np.zeros(self.n_tags, dtype='i')
-        for tag in tag_col_dict:
-            self.tag_col_freq[tag] = tag_col_dict[tag]
-        
-        self.item_col_mle = np.zeros(self.n_items, dtype='d')
-        self.item_local_sums = np.zeros(self.n_items, dtype='i')
-        
-        for item in item_col_dict:
-            self.item_col_mle[item] = item_col_dict[item] / self.n_annotations
-            
-            sum_local = sum(item_tag_dict[item].values())
-            self.item_local_sums[item] = sum_local
+        self.tag_col_freq = np.bincount(tags_arr, 
+                minlength=self.n_tags).astype('i')
+        self.item_local_sums = np.bincount(items_arr, 
+                minlength=self.n_items).astype('i')
+        
+        if self.n_annotations > 0:
+            self.item_col_mle = \
+                    np.asarray(self.item_local_sums, dtype='d') / \
+                    self.n_annotations
+        else:
+            self.item_col_mle = np.zeros(self.n_items, dtype='d')
+        
+        #Item x tag counts. Converting from coo sums duplicate entries.
+        ones = np.ones(self.n_annotations, dtype='i')
+        item_tag = sparse.coo_matrix((ones, (items_arr, tags_arr)),
+                shape=(self.n_items, self.n_tags)).tocsr()
+        item_tag.sum_duplicates()
+        item_tag.sort_indices()
+        
+        self.item_tag_csr = item_tag
+        self.item_tag_indptr = item_tag.indptr.astype('i')
+        self.item_tag_indices = item_tag.indices.astype('i')
+        self.item_tag_counts = item_tag.data.astype('i')
+        
+        #User x tag counts, used to build user profiles
+        if self.n_annotations == 0:
+            self.n_users = 0
+            self.user_tag_csr = None
+            self.existing_users = np.zeros(0, dtype=np.int)
+            return
+        
+        n_user_ids = users_arr.max() + 1
+        user_tag = sparse.coo_matrix((ones, (users_arr, tags_arr)),
+                shape=(n_user_ids, self.n_tags)).tocsr()
+        user_tag.sum_duplicates()
+        
+        self.user_tag_csr = user_tag
+        self.existing_users = np.unique(users_arr)
+        self.n_users = self.existing_users.shape[0]
+        
+    def __build_user_profiles(self):
+        '''
+        Selects the tags in the profile of each user, the most used 
+        `user_profile_fract_size` fraction of the user tags.
+        '''
+        self.user_tags = {}
+        if self.user_tag_csr is None:
+            return
+        
+        user_tag = self.user_tag_csr
+        for user in self.existing_users:
+            start = user_tag.indptr[user]
+            end = user_tag.indptr[user + 1]
+            tags = zip(user_tag.data[start:end], user_tag.indices[start:end])
             
-            for tag in item_tag_dict[item]:
-                self.item_tag_freq[item, tag] = item_tag_dict[item][tag]
-        
-        #User profile
-        for user in user_tags_dict:
-            tags = [(freq, tag) for tag, freq in user_tags_dict[user].items()]
             profile_size = np.ceil(self.user_profile_fract_size * len(tags))
             if profile_size >= len(tags):
                 aux = tags
@@ -129,6 +211,98 @@ cdef class SmoothEstimator(base.ProbabilityEstimator):
             self.user_tags[user] = np.array([tag[1] for tag in aux], 
                     dtype=np.int)
     
+    def __build_log_model(self):
+        '''
+        Pre-computes the log space model used by `prob_items_given_users`.
+        
+        For both smoothing methods, p(t|i) for a tag which never annotated the
+        item (the background) factors into a tag and an item term:
+        
+        .. math::
+            \log p_{bg}(t|i) = a_t + b_i
+        
+        where, for JM, :math:`a_t = \log(\lambda N_t / N)` and :math:`b_i = 0`;
+        for Bayes, :math:`b_i = -\log(N_i + \lambda)`. Where the tag did 
+        annotate the item a correction :math:`\log p(t|i) - a_t - b_i` is 
+        stored in a sparse matrix with the same structure as the counts.
+        '''
+        cdef double lambda_ = self.lambda_
+        cdef double n_annotations = max(self.n_annotations, 1)
+        
+        tag_freq = np.asarray(self.tag_col_freq, dtype='d')
+        local_sums = np.asarray(self.item_local_sums, dtype='d')
+        
+        indptr = np.asarray(self.item_tag_indptr)
+        indices = np.asarray(self.item_tag_indices)
+        counts = np.asarray(self.item_tag_counts, dtype='d')
+        rows = np.repeat(np.arange(self.n_items), np.diff(indptr))
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_bg_tag = np.log(lambda_ * tag_freq / n_annotations)
+            
+            col_mle = tag_freq[indices] / n_annotations
+            sum_local = local_sums[rows]
+            if self.smooth_func_id == BAYES:
+                log_bg_item = -np.log(local_sums + lambda_)
+                local = (counts + lambda_ * col_mle) / (sum_local + lambda_)
+            else:
+                log_bg_item = np.zeros(self.n_items, dtype='d')
+                local = ((1 - lambda_) * counts) / sum_local + \
+                        lambda_ * col_mle
+            
+            log_delta = np.log(local) - log_bg_tag[indices] - log_bg_item[rows]
+        
+        self.log_bg_tag = log_bg_tag
+        self.log_bg_item = log_bg_item
+        self.log_delta_csr = sparse.csr_matrix((log_delta, indices, indptr),
+                shape=(self.n_items, self.n_tags))
+        
+    def __user_profiles(self, np.ndarray[np.int_t, ndim=1] users):
+        '''
+        Creates a sparse users x tags matrix with the profile of each user.
+        Returns the matrix and the number of tags in each profile. Unknown
+        users have empty profiles.
+        '''
+        cdef Py_ssize_t n_users = users.shape[0]
+        cdef np.ndarray[np.int_t, ndim=1] sizes = np.zeros(n_users, 
+                                                           dtype=np.int)
+        profiles = []
+        
+        cdef Py_ssize_t user_idx
+        cdef int user
+        for user_idx in range(n_users):
+            user = users[user_idx]
+            if user >= 0 and user < self.n_users and user in self.user_tags:
+                profiles.append(self.user_tags[user])
+                sizes[user_idx] = self.user_tags[user].shape[0]
+        
+        indptr = np.zeros(n_users + 1, dtype=np.int)
+        indptr[1:] = np.cumsum(sizes)
+        if len(profiles) > 0:
+            indices = np.concatenate(profiles)
+        else:
+            indices = np.zeros(0, dtype=np.int)
+        
+        data = np.ones(indices.shape[0], dtype='d')
+        return sparse.csr_matrix((data, indices, indptr), 
+                                 shape=(n_users, self.n_tags)), sizes
+    
+    cdef int _item_tag_freq(self, int item, int tag):
+        '''Binary search for the count of the tag on the item CSR row'''
+        
+        cdef int low = self.item_tag_indptr[item]
+        cdef int high = self.item_tag_indptr[item + 1] - 1
+        cdef int mid
+        while low <= high:
+            mid = (low + high) // 2
+            if self.item_tag_indices[mid] < tag:
+                low = mid + 1
+            elif self.item_tag_indices[mid] > tag:
+                high = mid - 1
+            else:
+                return self.item_tag_counts[mid]
+        return 0
+    
     cpdef double prob_item(self, int item):
         '''Probability of seeing a given item. $P(i)$'''
         
@@ -146,12 +320,7 @@ cdef class SmoothEstimator(base.ProbabilityEstimator):
         if tag < 0 or tag >= self.n_tags:
             return 0.0
                 
-        cdef object key = (item, tag)
-        cdef int local_freq = 0
-
-        if key in self.item_tag_freq:
-            local_freq = <int> self.item_tag_freq[key]
-            
+        cdef int local_freq = self._item_tag_freq(item, tag)
         cdef int sum_local = self.item_local_sums[item]
         cdef double prob
         
@@ -195,6 +364,132 @@ cdef class SmoothEstimator(base.ProbabilityEstimator):
             
         return return_val
     
+    cpdef double log_prob_item(self, int item):
+        '''Log probability of seeing a given item. $\log P(i)$'''
+        
+        cdef double prob = self.prob_item(item)
+        if prob == 0:
+            return NEG_INF
+        return log(prob)
+    
+    cpdef double log_prob_tag_given_item(self, int item, int tag):
+        '''Log probability of seeing a tag for an item. $\log P(t|i)$'''
+        
+        cdef double prob = self.prob_tag_given_item(item, tag)
+        if prob == 0:
+            return NEG_INF
+        return log(prob)
+    
+    cpdef double log_prob_user_given_item(self, int item, int user):
+        '''
+        Log probability of seeing an user given an item. $\log P(u|i)$. 
+        This is the sum of $\log P(t|i)$ over the user profile, thus it does 
+        not underflow for users with large profiles.
+        '''
+        
+        if item < 0 or item >= self.n_items:
+            return NEG_INF
+
+        if user < 0 or user >= self.n_users:
+            return NEG_INF
+        
+        cdef np.ndarray[np.int_t, ndim=1] utags = \
+                self.user_tags[user]
+        
+        if (utags.shape[0] == 0): #user has no tags
+            return NEG_INF
+        
+        cdef double return_val = 0.0
+        cdef Py_ssize_t tag_idx
+        for tag_idx in range(utags.shape[0]):
+            return_val += self.log_prob_tag_given_item(item, utags[tag_idx])
+            
+        return return_val
+    
+    cpdef np.ndarray[np.double_t, ndim=2] prob_items_given_users(self,
+            np.ndarray[np.int_t, ndim=1] users, 
+            np.ndarray[np.int_t, ndim=1] gamma_items):
+        '''
+        Computes P(I|u) for every user in `users`, i.e., returns a matrix 
+        where each row is the probability of each item given the user. 
+        Row `j` is equal to `prob_items_given_user(users[j], gamma_items)`.
+        
+        See `log_prob_items_given_users` for details.
+        
+        Arguments
+        ---------
+        users: int array
+            User ids
+        gamma_items:
+            Items to consider. 
+        '''
+        return np.exp(self.log_prob_items_given_users(users, gamma_items))
+    
+    cpdef np.ndarray[np.double_t, ndim=2] log_prob_items_given_users(self,
+            np.ndarray[np.int_t, ndim=1] users, 
+            np.ndarray[np.int_t, ndim=1] gamma_items):
+        '''
+        Computes log P(I|u) for every user in `users`, i.e., returns a matrix 
+        where each row is the log probability of each item given the user. 
+        Row `j` is equal to `log_prob_items_given_user(users[j], gamma_items)`.
+        
+        Rows are computed at once in log space with sparse matrix products:
+        
+        .. math::
+            \log p(u|i)p(i) & = & \sum_{t \in u} (a_t + b_i) + 
+                                  \sum_{t \in u} \delta_{t,i} + \log p(i)
+        
+        where :math:`a_t + b_i` is the background log probability of the tag
+        and :math:`\delta_{t,i}` is non-zero only when t annotated i. Rows are
+        then rescaled (in log space) to sum to one with the log-sum-exp trick, 
+        so large user profiles do not underflow.
+        
+        Arguments
+        ---------
+        users: int array
+            User ids
+        gamma_items:
+            Items to consider. 
+        '''
+        cdef Py_ssize_t n_users = users.shape[0]
+        cdef Py_ssize_t n_items = gamma_items.shape[0]
+        cdef np.ndarray[np.double_t, ndim=2] vp_iu
+        
+        cdef Py_ssize_t user_idx
+        if n_users == 0 or n_items == 0:
+            return np.zeros((n_users, n_items), dtype='d')
+        
+        if self.lambda_ == 0: #No background model, use the per item method
+            vp_iu = np.ndarray((n_users, n_items), dtype='d')
+            for user_idx in range(n_users):
+                vp_iu[user_idx] = self.log_prob_items_given_user(
+                        users[user_idx], gamma_items)
+            return vp_iu
+        
+        valid_items = (gamma_items >= 0) & (gamma_items < self.n_items)
+        items = np.where(valid_items, gamma_items, 0)
+        
+        profiles, sizes = self.__user_profiles(users)
+        log_bg_tag = np.asarray(self.log_bg_tag)
+        log_bg_item = np.asarray(self.log_bg_item)[items]
+        log_delta = self.log_delta_csr[items]
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vp_iu = profiles.dot(log_delta.T).toarray()
+            vp_iu += profiles.dot(log_bg_tag)[:, np.newaxis]
+            vp_iu += sizes[:, np.newaxis] * log_bg_item[np.newaxis, :]
+            vp_iu += np.log(np.asarray(self.item_col_mle)[items])
+            
+            vp_iu[:, ~valid_items] = -np.inf
+            vp_iu[sizes == 0] = np.nan #p(u|i) = 0 for every item, 0 / 0 
+
+            #Log-sum-exp normalization
+            max_log = vp_iu.max(axis=1)[:, np.newaxis]
+            sum_exp = np.exp(vp_iu - max_log).sum(axis=1)[:, np.newaxis]
+            vp_iu -= max_log + np.log(sum_exp)
+        
+        return vp_iu
+    
     cpdef np.ndarray[np.double_t, ndim=1] prob_items_given_user(self, int user, 
             np.ndarray[np.int_t, ndim=1] gamma_items):
         '''
@@ -212,7 +507,8 @@ cdef class SmoothEstimator(base.ProbabilityEstimator):
                    & \propto & p(u|i)p(i)
         
         p(u|i) considers users as a query composed of her past tags.
-        Thus, p(u) is the product p(t|i) for every tag used by the user.
+        Thus, p(u) is the product p(t|i) for every tag used by the user. 
+        The product is computed in log space, see `log_prob_items_given_user`.
           
         Arguments
         ---------
@@ -221,21 +517,43 @@ cdef class SmoothEstimator(base.ProbabilityEstimator):
         gamma_items:
             Items to consider. 
         '''
+        return np.exp(self.log_prob_items_given_user(user, gamma_items))
+    
+    cpdef np.ndarray[np.double_t, ndim=1] log_prob_items_given_user(self, 
+            int user, np.ndarray[np.int_t, ndim=1] gamma_items):
+        '''
+        Computes log P(I|u), i.e., returns an array with the log probability 
+        of each item given the user. 
+        
+        The vector is rescaled so that the probabilities sum to one over 
+        gamma_items. Since the normalization is done with the log-sum-exp
+        trick, this method does not underflow for users with large profiles 
+        as the product of p(t|i) would. The vector is computed as a single
+        row of `log_prob_items_given_users`.
+        
+        Arguments
+        ---------
+        user: int
+            User id
+        gamma_items:
+            Items to consider. 
+        '''
+        if self.lambda_ != 0:
+            return self.log_prob_items_given_users(
+                    np.array([user], dtype=np.int), gamma_items)[0]
+        
+        #No background model, compute p(u|i)p(i) item by item
         cdef Py_ssize_t n_items = gamma_items.shape[0]
         cdef np.ndarray[np.double_t, ndim=1] vp_iu = np.ndarray(n_items, 
                                                                 dtype='d')
-        cdef double sum_probs = 0
         
         cdef Py_ssize_t item_idx
         for item_idx from 0 <= item_idx < n_items:
             vp_iu[item_idx] = \
-                    self.prob_user_given_item(gamma_items[item_idx], user) * \
-                    self.prob_item(gamma_items[item_idx])
-            sum_probs += vp_iu[item_idx]
-            
-        for item_idx from 0 <= item_idx < n_items:
-            vp_iu[item_idx] = vp_iu[item_idx] / sum_probs
-
+                self.log_prob_user_given_item(gamma_items[item_idx], user) + \
+                self.log_prob_item(gamma_items[item_idx])
+        
+        log_normalize(vp_iu)
         return vp_iu
 
     cpdef np.ndarray[np.double_t, ndim=1] prob_items_given_user_tag(self,
@@ -255,6 +573,31 @@ cdef class SmoothEstimator(base.ProbabilityEstimator):
                      & =       & p(u|i)p(t|i)p(i) / p(t,u) \\
                      & \propto & p(u|i)p(t|i)p(i)
         
+        The product is computed in log space, see 
+        `log_prob_items_given_user_tag`.
+        
+        Arguments
+        ---------
+        user: int
+            User id
+        tag: int
+            Tag id
+        gamma_items:
+            Items to consider. 
+        '''
+        return np.exp(self.log_prob_items_given_user_tag(user, tag, 
+                                                         gamma_items))
+    
+    cpdef np.ndarray[np.double_t, ndim=1] log_prob_items_given_user_tag(self,
+            int user, int tag, np.ndarray[np.int_t, ndim=1] gamma_items):
+        '''
+        Computes log P(I|u,t), i.e., returns an array with the log probability
+        of each item given the user and the tag.
+        
+        The vector is rescaled so that the probabilities sum to one over 
+        gamma_items. Normalization is done in log space, see 
+        `log_prob_items_given_user`.
+        
         Arguments
         ---------
         user: int
@@ -265,22 +608,104 @@ cdef class SmoothEstimator(base.ProbabilityEstimator):
             Items to consider. 
         '''
         cdef Py_ssize_t n_items = gamma_items.shape[0]
-        cdef np.ndarray[np.double_t, ndim=1] vp_itu = np.zeros(n_items, 
-                                                               dtype='d')
-        cdef double sum_probs = 0
+        cdef np.ndarray[np.double_t, ndim=1] vp_itu = np.ndarray(n_items, 
+                                                                 dtype='d')
         
         cdef Py_ssize_t item_idx
         for item_idx from 0 <= item_idx < n_items:
             vp_itu[item_idx] = \
-                    self.prob_user_given_item(gamma_items[item_idx], user) * \
-                    self.prob_tag_given_item(gamma_items[item_idx], tag) * \
-                    self.prob_item(gamma_items[item_idx])
+                self.log_prob_user_given_item(gamma_items[item_idx], user) + \
+                self.log_prob_tag_given_item(gamma_items[item_idx], tag) + \
+                self.log_prob_item(gamma_items[item_idx])
+        
+        log_normalize(vp_itu)
+        return vp_itu
+    
+    cpdef np.ndarray[np.double_t, ndim=2] prob_items_given_user_tags(self,
+            int user, np.ndarray[np.int_t, ndim=1] tags, 
+            np.ndarray[np.int_t, ndim=1] gamma_items):
+        '''
+        Computes P(I|u,t) for every tag in `tags`, i.e., returns a matrix
+        where each row is the probability of each item given the user and the
+        tag. Row `j` is equal to `prob_items_given_user_tag(user, tags[j], 
+        gamma_items)`.
+        
+        See `log_prob_items_given_user_tags` for details.
+        
+        Arguments
+        ---------
+        user: int
+            User id
+        tags: int array
+            Tag ids
+        gamma_items:
+            Items to consider. 
+        '''
+        return np.exp(self.log_prob_items_given_user_tags(user, tags, 
+                                                          gamma_items))
+    
+    cpdef np.ndarray[np.double_t, ndim=2] log_prob_items_given_user_tags(self,
+            int user, np.ndarray[np.int_t, ndim=1] tags, 
+            np.ndarray[np.int_t, ndim=1] gamma_items):
+        '''
+        Computes log P(I|u,t) for every tag in `tags`, i.e., returns a matrix
+        where each row is the log probability of each item given the user and
+        the tag. Row `j` is equal to `log_prob_items_given_user_tag(user, 
+        tags[j], gamma_items)`.
+        
+        The user part, :math:`\log p(u|i)p(i)`, is computed once for all tags
+        (see `log_prob_items_given_users`). The tags x items matrix of 
+        :math:`\log p(t|i)` comes from the log space model. Rows are then
+        rescaled with the log-sum-exp trick.
+        
+        Arguments
+        ---------
+        user: int
+            User id
+        tags: int array
+            Tag ids
+        gamma_items:
+            Items to consider. 
+        '''
+        cdef Py_ssize_t n_tags = tags.shape[0]
+        cdef Py_ssize_t n_items = gamma_items.shape[0]
+        cdef np.ndarray[np.double_t, ndim=2] vp_itu
+        
+        cdef Py_ssize_t tag_idx
+        cdef Py_ssize_t item_idx
+        if n_tags == 0 or n_items == 0:
+            return np.zeros((n_tags, n_items), dtype='d')
+        
+        log_piu = self.log_prob_items_given_users(np.array([user], 
+                dtype=np.int), gamma_items)[0]
+        
+        if self.lambda_ == 0: #No background model, use the per item method
+            vp_itu = np.ndarray((n_tags, n_items), dtype='d')
+            for tag_idx in range(n_tags):
+                for item_idx in range(n_items):
+                    vp_itu[tag_idx, item_idx] = self.log_prob_tag_given_item(
+                            gamma_items[item_idx], tags[tag_idx])
+        else:
+            valid_items = (gamma_items >= 0) & (gamma_items < self.n_items)
+            valid_tags = (tags >= 0) & (tags < self.n_tags)
+            items = np.where(valid_items, gamma_items, 0)
+            tags_ = np.where(valid_tags, tags, 0)
             
-            sum_probs += vp_itu[item_idx]
-
-        for item_idx from 0 <= item_idx < n_items:
-            vp_itu[item_idx] = vp_itu[item_idx] / sum_probs
-
+            log_delta = self.log_delta_csr[items][:, tags_]
+            vp_itu = log_delta.T.toarray()
+            vp_itu += np.asarray(self.log_bg_tag)[tags_][:, np.newaxis]
+            vp_itu += np.asarray(self.log_bg_item)[items][np.newaxis, :]
+            vp_itu[:, ~valid_items] = -np.inf
+            vp_itu[~valid_tags] = -np.inf
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vp_itu += log_piu[np.newaxis, :]
+            
+            #Log-sum-exp normalization
+            max_log = vp_itu.max(axis=1)[:, np.newaxis]
+            sum_exp = np.exp(vp_itu - max_log).sum(axis=1)[:, np.newaxis]
+            vp_itu -= max_log + np.log(sum_exp)
+        
         return vp_itu
     
     cpdef np.ndarray[np.double_t, ndim=1] prob_items_given_tag(self, 
@@ -9,6 +9,9 @@ from __future__ import division, print_function
 
 from math import isnan
 
+import os
+import tempfile
+
 from tagassess import data_parser
 from tagassess import test
 
@@ -276,5 +279,242 @@ class TestLDAEstimator(unittest.TestCase):
         self.assertTrue((estimator._get_topic_document_prb()).any())
         self.assertTrue((estimator._get_topic_term_prb()).any())
 
+    def test_prob_items_given_user_tags(self):
+        annots = self.create_annots(test.DELICIOUS_FILE)
+        estimator = LDAEstimator(annots, 10, .5, .5, .5, 10, 5, 1, 1)
+        
+        gamma = np.arange(5)
+        tags = np.arange(4)
+        probs = estimator.prob_items_given_user_tags(0, tags, gamma)
+        self.assertEqual((4, 5), probs.shape)
+        for tag in tags:
+            self.assertTrue(np.allclose(probs[tag], 
+                    estimator.prob_items_given_user_tag(0, tag, gamma)))
+
+    def test_parallel_gibbs_sample(self):
+        annots = self.create_annots(test.DELICIOUS_FILE)
+        
+        #Last three parameters -> sample_every=1, seed=1, num_workers=4
+        estimator_a = LDAEstimator(annots, 10, .5, .5, .5, 5, 2, 1, 1, 4)
+        estimator_b = LDAEstimator(annots, 10, .5, .5, .5, 5, 2, 1, 1, 4)
+        
+        #Counts must be consistent after merging workers
+        user_cnt = estimator_a._get_user_counts()
+        topic_cnt = estimator_a._get_topic_counts()
+        document_cnt = estimator_a._get_document_counts()
+        ut = estimator_a._get_user_topic_counts()
+        td = estimator_a._get_topic_document_counts()
+        tt = estimator_a._get_topic_term_counts()
+        
+        self.assertEqual(len(annots), topic_cnt.sum())
+        self.assertTrue((ut >= 0).all())
+        self.assertTrue((td >= 0).all())
+        self.assertTrue((tt >= 0).all())
+        self.assertTrue((ut.sum(axis=1) == user_cnt).all())
+        self.assertTrue((td.sum(axis=0) == document_cnt).all())
+        self.assertTrue((td.sum(axis=1) == topic_cnt).all())
+        self.assertTrue((tt.sum(axis=1) == topic_cnt).all())
+        
+        #Same seed, same chain
+        self.assertFalse((estimator_a._get_user_topic_prb() - 
+                          estimator_b._get_user_topic_prb()).any())
+        self.assertFalse((estimator_a._get_topic_term_prb() - 
+                          estimator_b._get_topic_term_prb()).any())
+        
+        gamma = np.arange(5)
+        probs = estimator_a.prob_items_given_user_tag(0, 0, gamma)
+        self.assertAlmostEqual(1, probs.sum())
+        self.assertTrue((probs > 0).all())
+
+    def test_parallel_gibbs_sample_empty_shards(self):
+        #Shards are split at users, with more workers than users some shards
+        #are empty
+        annots = [{'user':user, 'item':item, 'tag':tag, 'date':0}
+                  for user, item, tag in [(0, 0, 0), (0, 1, 1), (0, 2, 1),
+                                          (1, 1, 0), (1, 2, 2)]]
+        estimator = LDAEstimator(annots, 3, .5, .5, .5, 5, 2, 1, 1, 8)
+        
+        topic_cnt = estimator._get_topic_counts()
+        ut = estimator._get_user_topic_counts()
+        td = estimator._get_topic_document_counts()
+        tt = estimator._get_topic_term_counts()
+        
+        self.assertEqual(len(annots), topic_cnt.sum())
+        self.assertTrue((ut.sum(axis=1) == estimator._get_user_counts()).all())
+        self.assertTrue((td.sum(axis=1) == topic_cnt).all())
+        self.assertTrue((tt.sum(axis=1) == topic_cnt).all())
+        self.assertTrue((tt >= 0).all())
+
+    def test_alias_gibbs_sample(self):
+        annots = self.create_annots(test.DELICIOUS_FILE)
+        
+        #seed=1, num_workers=1, alias sampler
+        estimator_a = LDAEstimator(annots, 10, .5, .5, .5, 10, 5, 1, 1, 1,
+                                   'alias')
+        estimator_b = LDAEstimator(annots, 10, .5, .5, .5, 10, 5, 1, 1, 1, 
+                                   'alias')
+        
+        user_cnt = estimator_a._get_user_counts()
+        topic_cnt = estimator_a._get_topic_counts()
+        ut = estimator_a._get_user_topic_counts()
+        td = estimator_a._get_topic_document_counts()
+        tt = estimator_a._get_topic_term_counts()
+        
+        self.assertEqual(len(annots), topic_cnt.sum())
+        self.assertTrue((ut >= 0).all())
+        self.assertTrue((td >= 0).all())
+        self.assertTrue((tt >= 0).all())
+        self.assertTrue((ut.sum(axis=1) == user_cnt).all())
+        self.assertTrue((td.sum(axis=1) == topic_cnt).all())
+        self.assertTrue((tt.sum(axis=1) == topic_cnt).all())
+        
+        #Same seed, same chain
+        self.assertFalse((estimator_a._get_topic_term_prb() - 
+                          estimator_b._get_topic_term_prb()).any())
+        
+        #The chain must move away from the random initialization
+        chain = estimator_a.chain_likelihood()
+        self.assertTrue(chain[-1] > chain[0])
+        
+        #Also with workers
+        estimator_c = LDAEstimator(annots, 10, .5, .5, .5, 10, 5, 1, 1, 2, 
+                                   'alias')
+        self.assertEqual(len(annots), estimator_c._get_topic_counts().sum())
+        chain = estimator_c.chain_likelihood()
+        self.assertTrue(chain[-1] > chain[0])
+
+    def test_checkpoint_resume(self):
+        annots = self.create_annots(test.DELICIOUS_FILE)
+        ckpt = tempfile.mktemp('lda.npz')
+        try:
+            #Uninterrupted 10 iterations
+            full = LDAEstimator(annots, 10, .5, .5, .5, 10, 3, 1, 1)
+            
+            #5 iterations, checkpoint, then resume up to 10
+            LDAEstimator(annots, 10, .5, .5, .5, 5, 3, 1, 1, 
+                         checkpoint_fpath=ckpt, checkpoint_every=2)
+            self.assertTrue(os.path.exists(ckpt))
+            resumed = LDAEstimator(annots, 10, .5, .5, .5, 10, 3, 1, 1,
+                                   checkpoint_fpath=ckpt)
+            
+            self.assertEqual(9, resumed.get_iter())
+            self.assertTrue((full.chain_likelihood() == 
+                             resumed.chain_likelihood()).all())
+            self.assertEqual(full.log_likelihood(), resumed.log_likelihood())
+            self.assertTrue((full._get_topic_term_counts() ==
+                             resumed._get_topic_term_counts()).all())
+            self.assertTrue((full._get_user_topic_prb() ==
+                             resumed._get_user_topic_prb()).all())
+            self.assertTrue((full._get_topic_document_prb() ==
+                             resumed._get_topic_document_prb()).all())
+            
+            #Checkpoints do not match other annotations
+            self.assertRaises(ValueError, LDAEstimator, annots[:-1], 10, .5, 
+                              .5, .5, 10, 3, 1, 1, checkpoint_fpath=ckpt)
+        finally:
+            if os.path.exists(ckpt):
+                os.remove(ckpt)
+
+    def test_convergence(self):
+        annots = self.create_annots(test.DELICIOUS_FILE)
+        
+        #Fixed schedule
+        estimator = LDAEstimator(annots, 10, .5, .5, .5, 10, 5, 1, 1)
+        self.assertEqual(5, estimator.get_burn_in())
+        self.assertEqual([], estimator.convergence_trace())
+        self.assertEqual(10, len(estimator.chain_likelihood()))
+        
+        #Adaptive, loose tolerance so that it stops early
+        estimator = LDAEstimator(annots, 10, .5, .5, .5, 300, 200, 1, 1, 
+                                 convergence_tol=.05, convergence_window=5)
+        trace = estimator.convergence_trace()
+        burn_in = estimator.get_burn_in()
+        num_done = estimator.get_iter() + 1
+        
+        self.assertTrue(0 < burn_in < 200)
+        self.assertTrue(burn_in < num_done < 300)
+        self.assertEqual(num_done, len(estimator.chain_likelihood()))
+        
+        burn_in_trace = [x for x in trace if x[1] == 'burn_in']
+        sampling_trace = [x for x in trace if x[1] == 'sampling']
+        self.assertEqual(burn_in - 1, burn_in_trace[-1][0])
+        self.assertTrue(burn_in_trace[-1][3])
+        self.assertFalse(any(x[3] for x in burn_in_trace[:-1]))
+        self.assertEqual(num_done - 1, sampling_trace[-1][0])
+        self.assertTrue(sampling_trace[-1][2] < .05)
+        self.assertTrue(sampling_trace[-1][3])
+        
+        gamma = np.arange(5)
+        probs = estimator.prob_items_given_user(0, gamma)
+        self.assertAlmostEqual(1, probs.sum())
+
+    def test_convergence_with_thinning(self):
+        annots = self.create_annots(test.DELICIOUS_FILE)
+
+        #No burn in, samples at even iterations, tested every 2 samples. The
+        #tolerance is too tight to stop, thinned iterations must not be
+        #compared with the snapshot just taken.
+        estimator = LDAEstimator(annots, 10, .5, .5, .5, 30, 0, 1, 1,
+                                 convergence_tol=1e-12, convergence_window=2,
+                                 accumulate_every=2)
+        trace = estimator.convergence_trace()
+
+        self.assertEqual(30, estimator.get_iter() + 1)
+        self.assertEqual(list(range(6, 30, 4)), [x[0] for x in trace])
+        self.assertTrue(all(x[1] == 'sampling' for x in trace))
+        self.assertTrue(all(x[2] > 0 for x in trace))
+        self.assertFalse(any(x[3] for x in trace))
+
+    def test_convergence_before_likelihood(self):
+        annots = self.create_annots(test.DELICIOUS_FILE)
+
+        #Sampling stops long before the first scheduled likelihood
+        estimator = LDAEstimator(annots, 10, .5, .5, .5, 1000, 5, 1, 1,
+                                 convergence_tol=.5, convergence_window=2,
+                                 likelihood_every=200)
+        last = estimator.get_iter()
+        chain = estimator.chain_likelihood()
+
+        self.assertTrue(last < 199)
+        self.assertFalse(isnan(estimator.log_likelihood()))
+        self.assertAlmostEqual(chain[last], estimator.log_likelihood())
+        self.assertEqual([last], [i for i in range(last + 1)
+                                  if not isnan(chain[i])])
+
+    def test_likelihood_and_accumulate_schedule(self):
+        annots = self.create_annots(test.DELICIOUS_FILE)
+        
+        #Likelihood from counts is the same as summing over annotations
+        estimator = LDAEstimator(annots, 10, .5, .5, .5, 10, 5, 1, 1)
+        user_topic = estimator._get_user_topic_counts()
+        topic_document = estimator._get_topic_document_counts()
+        topic_term = estimator._get_topic_term_counts()
+        topic = estimator._get_topic_counts()
+        user = estimator._get_user_counts()
+        
+        expected = 0
+        for (u, d, t), z in estimator._get_topic_assignments().items():
+            expected += np.log(prior(user_topic[u, z], user[u], 10, .5))
+            expected += np.log(prior(topic_document[z, d], topic[z],
+                                     topic_document.shape[1], .5))
+            expected += np.log(prior(topic_term[z, t], topic[z],
+                                     topic_term.shape[1], .5))
+        self.assertAlmostEqual(expected, estimator.chain_likelihood()[-1], 5)
+        
+        #Likelihood every 3 iterations, and always at the last one
+        estimator = LDAEstimator(annots, 10, .5, .5, .5, 10, 5, 1, 1,
+                                 likelihood_every=3, accumulate_every=2)
+        chain = estimator.chain_likelihood()
+        computed = [i for i in range(10) if not isnan(chain[i])]
+        self.assertEqual([2, 5, 8, 9], computed)
+        self.assertAlmostEqual((chain[5] + chain[8] + chain[9]) / 3, 
+                               estimator.log_likelihood())
+        
+        #Thinned samples are still probabilities
+        gamma = np.arange(5)
+        probs = estimator.prob_items_given_user(0, gamma)
+        self.assertAlmostEqual(1, probs.sum())
+        self.assertAlmostEqual(1, estimator._get_user_topic_prb()[0].sum())
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf8
+#pylint: disable-msg=C0103
+#pylint: disable-msg=C0111
+from __future__ import division, print_function
+
+from tagassess.probability_estimates.precomputed_store import is_store
+from tagassess.probability_estimates.precomputed_store import ProbabilityStore
+from tagassess.probability_estimates.precomputed_store import \
+        ProbabilityStoreWriter
+
+import numpy as np
+import shutil
+import tempfile
+import unittest
+
+class TestProbabilityStore(unittest.TestCase):
+    
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+    
+    def test_write_read(self):
+        rng = np.random.RandomState(0)
+        expected = {}
+        with ProbabilityStoreWriter(self.folder) as writer:
+            for user in [7, 2, 30, 0]:
+                gamma = np.sort(rng.choice(100, 20 + user, replace=False))
+                piu = rng.rand(gamma.shape[0])
+                pitu = dict((tag, rng.rand(gamma.shape[0])) 
+                            for tag in rng.choice(50, 5, replace=False))
+                if user == 0:
+                    pitu = {}
+                
+                expected[user] = gamma, piu, pitu
+                writer.add_user(user, gamma, piu, pitu)
+        
+        self.assertTrue(is_store(self.folder))
+        store = ProbabilityStore(self.folder)
+        self.assertEqual([0, 2, 7, 30], store.get_users())
+        
+        for user, (gamma, piu, pitu) in expected.items():
+            self.assertTrue((gamma == store.gamma_items(user)).all())
+            self.assertTrue((piu == store.piu(user)).all())
+            self.assertEqual(sorted(pitu), store.tags(user))
+            for tag in pitu:
+                self.assertTrue((pitu[tag] == store.pitu(user, tag)).all())
+            self.assertRaises(KeyError, store.pitu, user, 51)
+        
+        self.assertRaises(KeyError, store.piu, 1)
+        self.assertRaises(KeyError, store.gamma_items, 31)
+    
+    def test_invalid(self):
+        with ProbabilityStoreWriter(self.folder) as writer:
+            self.assertRaises(ValueError, writer.add_user, 0, [1, 2], [.5], {})
+        
+        writer = ProbabilityStoreWriter(self.folder)
+        writer.add_user(0, [1, 2], [.5, .5], {})
+        writer.add_user(0, [1, 2], [.5, .5], {})
+        self.assertRaises(ValueError, writer.close)
+    
+    def test_error_leaves_no_store(self):
+        try:
+            with ProbabilityStoreWriter(self.folder) as writer:
+                writer.add_user(0, [1, 2], [.5, .5], {})
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertFalse(is_store(self.folder))
+        self.assertRaises(IOError, ProbabilityStore, self.folder)
+
+    def test_rewrite_invalidates_old_store(self):
+        with ProbabilityStoreWriter(self.folder) as writer:
+            writer.add_user(0, [1, 2], [.5, .5], {})
+        self.assertTrue(is_store(self.folder))
+
+        #An interrupted rewrite must not leave the old manifest behind
+        writer = ProbabilityStoreWriter(self.folder)
+        self.assertFalse(is_store(self.folder))
+        writer.add_user(1, [3], [1.], {})
+        writer.close()
+        self.assertTrue(is_store(self.folder))
+        self.assertEqual([1], ProbabilityStore(self.folder).get_users())
+
+    def test_interrupt_is_not_suppressed(self):
+        try:
+            with ProbabilityStoreWriter(self.folder) as writer:
+                writer.add_user(0, [1, 2], [.5, .5], {})
+                raise KeyboardInterrupt()
+        except KeyboardInterrupt:
+            pass
+        else:
+            self.fail('KeyboardInterrupt was suppressed')
+        self.assertFalse(is_store(self.folder))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -148,6 +148,22 @@ class TestSmoothEstimator(unittest.TestCase):
                         sum(p.prob_items_given_user_tag(user, tag, 
                                                             gamma_items)))             
 
+    def test_prob_items_given_user_tags(self):
+        self.__init_test(test.SMALL_DEL_FILE)
+        
+        gamma_items = np.array([0, 1, 2, 3, 4])
+        tags = np.array([0, 1, 2, 3, 4, 5])
+        for smooth_func, lambda_ in [('Bayes', 0.3), ('JM', 0.3), 
+                                     ('Bayes', 0)]:
+            p = SmoothEstimator(smooth_func, lambda_, self.annots, 1)
+            for user in [0, 1, 2]:
+                pitus = p.prob_items_given_user_tags(user, tags, gamma_items)
+                self.assertEqual((6, 5), pitus.shape)
+                for tag_idx, tag in enumerate(tags):
+                    assert_array_almost_equal(pitus[tag_idx],
+                            p.prob_items_given_user_tag(user, tag, 
+                                                        gamma_items))
+
     def test_prob_item_given_tag(self):
         self.__init_test(test.SMALL_DEL_FILE)
         
@@ -199,5 +215,121 @@ class TestSmoothEstimator(unittest.TestCase):
         self.assertEqual(gamma_pi[0], pi_1 / (pi_1 + pi_2))
         self.assertEqual(gamma_pi[1], pi_2 / (pi_1 + pi_2))
 
+    def test_prob_items_given_users(self):
+        self.__init_test(test.SMALL_DEL_FILE)
+        
+        gamma_items = np.array([0, 1, 2, 3, 4])
+        users = np.array([0, 1, 2])
+        for smooth_func, lambda_ in [('Bayes', 0.3), ('JM', 0.5), ('JM', 0)]:
+            p = SmoothEstimator(smooth_func, lambda_, self.annots, 1)
+            
+            piu_matrix = p.prob_items_given_users(users, gamma_items)
+            self.assertEqual((3, 5), piu_matrix.shape)
+            for user in users:
+                assert_array_almost_equal(piu_matrix[user],
+                        self.__expected_piu(p, lambda_, user, gamma_items))
+            
+            some_items = np.array([4, 2])
+            piu_matrix = p.prob_items_given_users(users[::-1], some_items)
+            for i, user in enumerate(users[::-1]):
+                assert_array_almost_equal(piu_matrix[i],
+                        self.__expected_piu(p, lambda_, user, some_items))
+
+    def __expected_piu(self, p, lambda_, user, gamma_items):
+        #With a background model p(I|u) is a single row of the batched
+        #computation, so it is computed here item by item as p(u|i)p(i)
+        if lambda_ == 0:
+            return p.prob_items_given_user(user, gamma_items)
+        
+        pius = np.array([p.prob_user_given_item(item, user) * 
+                         p.prob_item(item) for item in gamma_items])
+        return pius / pius.sum()
+
+    def test_prob_items_given_users_profsize(self):
+        self.__init_test(test.SMALL_DEL_FILE)
+        
+        gamma_items = np.array([0, 1, 2, 3, 4])
+        p = SmoothEstimator('Bayes', 0.3, self.annots, .5)
+        piu_matrix = p.prob_items_given_users(np.array([0, 1, 2]), gamma_items)
+        for user in [0, 1, 2]:
+            assert_array_almost_equal(piu_matrix[user],
+                    self.__expected_piu(p, 0.3, user, gamma_items))
+            self.assertAlmostEqual(1, piu_matrix[user].sum())
+
+    def test_set_params(self):
+        self.__init_test(test.SMALL_DEL_FILE)
+        
+        gamma_items = np.array([0, 1, 2, 3, 4])
+        users = np.array([0, 1, 2])
+        tags = np.array([0, 1, 2, 3, 4, 5])
+        for smooth_func in ['Bayes', 'JM']:
+            p = SmoothEstimator(smooth_func, 0.3, self.annots, 1)
+            for lambda_, fract in [(0.5, .5), (0.5, 1), (0.1, .25)]:
+                p.set_params(lambda_=lambda_, user_profile_fract_size=fract)
+                new = SmoothEstimator(smooth_func, lambda_, self.annots, fract)
+                
+                assert_array_almost_equal(
+                        new.prob_items_given_users(users, gamma_items),
+                        p.prob_items_given_users(users, gamma_items))
+                for user in users:
+                    assert_array_almost_equal(
+                            new.prob_items_given_user_tags(user, tags, 
+                                                           gamma_items),
+                            p.prob_items_given_user_tags(user, tags, 
+                                                         gamma_items))
+            
+            p.set_params(user_profile_fract_size=1)
+            new = SmoothEstimator(smooth_func, 0.1, self.annots, 1)
+            assert_array_almost_equal(
+                    new.prob_items_given_users(users, gamma_items),
+                    p.prob_items_given_users(users, gamma_items))
+
+    def test_log_probs(self):
+        self.__init_test(test.SMALL_DEL_FILE)
+        
+        gamma_items = np.array([0, 1, 2, 3, 4])
+        for smooth_func, lambda_ in [('Bayes', 0.3), ('JM', 0.5)]:
+            p = SmoothEstimator(smooth_func, lambda_, self.annots, 1)
+            for item in gamma_items:
+                self.assertAlmostEqual(np.log(p.prob_item(item)), 
+                                       p.log_prob_item(item))
+                for user in [0, 1, 2]:
+                    self.assertAlmostEqual(
+                            np.log(p.prob_user_given_item(item, user)),
+                            p.log_prob_user_given_item(item, user))
+            
+            for user in [0, 1, 2]:
+                assert_array_almost_equal(
+                        np.log(p.prob_items_given_user(user, gamma_items)),
+                        p.log_prob_items_given_user(user, gamma_items))
+                for tag in [0, 1, 2, 3, 4, 5]:
+                    assert_array_almost_equal(
+                        np.log(p.prob_items_given_user_tag(user, tag, 
+                                                           gamma_items)),
+                        p.log_prob_items_given_user_tag(user, tag, 
+                                                        gamma_items))
+    
+    def test_heavy_user_no_underflow(self):
+        #User 0 has a huge profile, the product of p(t|i) underflows
+        for tag in xrange(2000):
+            self.annots.append(data_parser.to_json(0, tag % 5, tag, 0))
+        self.annots.append(data_parser.to_json(1, 0, 0, 0))
+        
+        p = SmoothEstimator('Bayes', 0.3, self.annots, 1)
+        gamma_items = np.array([0, 1, 2, 3, 4])
+        
+        self.assertEqual(0, p.prob_user_given_item(0, 0))
+        self.assertTrue(np.isfinite(p.log_prob_user_given_item(0, 0)))
+        
+        for probs in [p.prob_items_given_user(0, gamma_items),
+                      p.prob_items_given_user_tag(0, 1, gamma_items),
+                      p.prob_items_given_users(np.array([0, 1]), 
+                                               gamma_items)[0]]:
+            self.assertFalse(np.isnan(probs).any())
+            self.assertAlmostEqual(1, probs.sum())
+        
+        assert_array_almost_equal(p.prob_items_given_user(0, gamma_items),
+                p.prob_items_given_users(np.array([0]), gamma_items)[0])
+
 if __name__ == "__main__":
     unittest.main()
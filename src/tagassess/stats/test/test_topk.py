@@ -3,6 +3,9 @@
 from __future__ import division, print_function
 
 from tagassess.stats import topk
+
+import itertools
+import numpy as np
 import unittest
 
 class TestAll(unittest.TestCase):
@@ -145,4 +148,50 @@ class TestAll(unittest.TestCase):
                 topk.kendall_tau_distance(list_wkpaths, range(20, 30)))
         
         self.assertEquals(1, 
-                topk.kendall_tau_distance(list_markov_c, range(20, 30)))        
\ No newline at end of file
+                topk.kendall_tau_distance(list_markov_c, range(20, 30)))
+
+    def test_discordant_pairs(self):
+        '''Compares with counting every pair in the intersection'''
+        
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            l1 = rng.permutation(100)[:60]
+            l2 = rng.permutation(100)[:60]
+            
+            pos1 = dict((e, i) for i, e in enumerate(l1))
+            pos2 = dict((e, i) for i, e in enumerate(l2))
+            intersect = set(l1).intersection(l2)
+            discordant = sum(1 for i, j in itertools.combinations(intersect, 2)
+                             if (pos1[i] > pos1[j]) != (pos2[i] > pos2[j]))
+            
+            diff1 = sum(pos1[e] + 1 for e in l1 if e not in intersect)
+            diff2 = sum(pos2[e] + 1 for e in l2 if e not in intersect)
+            z = len(intersect)
+            expected = ((60 - z) * (3 * 60 - z) + discordant - diff1 - diff2) \
+                    / (2 * 60 * 60 - 60)
+            
+            self.assertAlmostEqual(expected, 
+                                   topk.kendall_tau_distance(l1, l2, p=1))
+            self.assertAlmostEqual(expected, 
+                    topk.kendall_tau_distance(list(l1), list(l2), p=1))
+    
+    def test_batch(self):
+        '''Batched distances are the same as computing one by one'''
+        
+        rng = np.random.RandomState(0)
+        rankings1 = [rng.permutation(30)[:rng.randint(1, 20)] 
+                     for _ in range(50)]
+        rankings2 = [rng.permutation(30)[:rng.randint(1, 20)] 
+                     for _ in range(50)]
+        
+        for p in [0, .5, 1]:
+            distances = topk.kendall_tau_distances(rankings1, rankings2, p=p)
+            self.assertEqual(50, distances.shape[0])
+            for i in range(50):
+                self.assertAlmostEqual(distances[i], 
+                        topk.kendall_tau_distance(rankings1[i], rankings2[i],
+                                                  p=p))
+        
+        self.assertEqual(0, topk.kendall_tau_distances([], []).shape[0])
+        self.assertRaises(Exception, topk.kendall_tau_distances, 
+                          [[1, 2]], [[1, 2]], 3)
@@ -11,7 +11,97 @@ References
 
 from __future__ import division, print_function
 
-import itertools
+import numpy as np
+
+def _count_inversions(values, groups, num_groups):
+    '''
+    Counts, for each group, the number of pairs i < j in the group where
+    values[i] > values[j]. Elements of a group must be contiguous and values
+    must be distinct in the group and in [0, len(values)).
+    
+    This is a bottom up merge sort. At each level, the number of elements in
+    the left block which are greater than an element of the right block is 
+    found with a binary search, all blocks at once. Keys are offset by block
+    (and by group) so a single sorted array holds every block.
+    
+    Arguments
+    ---------
+    values: int array
+        The values of each element
+    groups: int array
+        The group of each element
+    num_groups: int
+        The number of groups
+    '''
+    num_elements = values.shape[0]
+    inversions = np.zeros(num_groups, dtype=np.int64)
+    if num_elements < 2:
+        return inversions
+    
+    span = num_elements
+    block_span = span * num_groups
+    keys = groups.astype(np.int64) * span + values
+    
+    positions = np.arange(num_elements)
+    width = 1
+    while width < num_elements:
+        block = positions // (2 * width)
+        is_right = (positions // width) % 2 == 1
+        
+        offset_keys = keys + block * block_span
+        left = offset_keys[~is_right]
+        right = offset_keys[is_right]
+        
+        #Left elements greater than the right one, up to the end of its block
+        end = np.searchsorted(left, (block[is_right] + 1) * block_span)
+        start = np.searchsorted(left, right, side='right')
+        inversions += np.bincount(keys[is_right] // span, 
+                                  weights=end - start, 
+                                  minlength=num_groups).astype(np.int64)
+        
+        keys = np.sort(offset_keys) - block * block_span
+        width *= 2
+    
+    return inversions
+
+def _top_k_stats(data1, data2, k):
+    '''
+    Returns the size of the intersection of the top `k` elements of both 
+    rankings, the sums of positions (starting at 1) of the elements which are
+    only in the first or only in the second list and, for the elements of the
+    intersection sorted by the position in the first list, their rank (from 0)
+    in the second list.
+    '''
+    top1 = np.asarray(data1)[:k]
+    top2 = np.asarray(data2)[:k]
+    
+    #Positions of the elements of the intersection in each list
+    order2 = np.argsort(top2, kind='mergesort')
+    sorted2 = top2[order2]
+    pos = np.searchsorted(sorted2, top1)
+    if sorted2.shape[0] > 0:
+        found = sorted2[np.minimum(pos, sorted2.shape[0] - 1)] == top1
+    else:
+        found = np.zeros(top1.shape[0], dtype=bool)
+    
+    idx1 = np.flatnonzero(found)
+    idx2 = order2[pos[found]]
+    
+    z = idx1.shape[0]
+    sum_all = k * (k + 1) // 2
+    sum1 = sum_all - int(idx1.sum()) - z
+    sum2 = sum_all - int(idx2.sum()) - z
+    
+    ranks2 = np.argsort(np.argsort(idx2))
+    return z, sum1, sum2, ranks2[np.argsort(idx1)]
+
+def _distance(k, z, intersect_penalty, sum1, sum2, p):
+    '''The normalized distance from the statistics of two top-k lists'''
+    unnorm = (k - z) * ((2 + p) * k - p * z + 1 - p) + \
+             (intersect_penalty - sum1 - sum2)
+    
+    norm_factor = (k * k) * (p + 1) - k * p
+    return unnorm / norm_factor
 
 def kendall_tau_distance(data1, data2, k=-1, p=0):
     '''
@@ -22,11 +112,14 @@ def kendall_tau_distance(data1, data2, k=-1, p=0):
     The normalization is done considering the worse case when the
     intersection between the two ranks is empty.
     
+    The pairs in the intersection with a different order are counted with 
+    a merge sort (see `_count_inversions`), so the cost is O(k log k).
+    
     Arguments
     ----------
-    data1: list (or any ordered iterable)
+    data1: list or array (or any ordered iterable)
         The first ranking
-    data2: list (or any ordered iterable)
+    data2: list or array (or any ordered iterable)
         The second ranking
     k: int (default = -1s)
         The top elements to consider from each ranking. When -1 it will be set
@@ -41,42 +134,74 @@ def kendall_tau_distance(data1, data2, k=-1, p=0):
        SIAM J. Discrete Mathematics 17, 1 (2003). PP/ 134-160
     '''
     
+    data1 = list(data1) if not hasattr(data1, '__len__') else data1
+    data2 = list(data2) if not hasattr(data2, '__len__') else data2
+    
     if k > len(data1) or k > len(data2):
         raise Exception('k is greater than the length of given lists')
     
     if k == -1:
         k = min(len(data1), len(data2))
     
-    #Populates dictionaries with: element -> position
-    positions1 = dict(itertools.izip(data1, xrange(1, k + 1)))
-    positions2 = dict(itertools.izip(data2, xrange(1, k + 1)))
+    z, sum1, sum2, ranks2 = _top_k_stats(data1, data2, k)
+    intersect_penalty = int(_count_inversions(ranks2, 
+                                              np.zeros(z, dtype=np.int64),
+                                              1)[0])
     
-    #As set
-    set1 = set(positions1.keys())
-    set2 = set(positions2.keys())
+    return _distance(k, z, intersect_penalty, sum1, sum2, p)
+
+def kendall_tau_distances(rankings1, rankings2, k=-1, p=0):
+    '''
+    Calculates the Kendall-Tau distance between each pair of rankings
+    (rankings1[i], rankings2[i]). Returns an array with one distance per 
+    pair, each equal to `kendall_tau_distance(rankings1[i], rankings2[i], 
+    k, p)`.
+    
+    The discordant pairs of every ranking pair are counted together in a 
+    single merge sort.
     
-    intersect = set1.intersection(set2)
-    diff1 = set1.difference(set2)
-    diff2 = set2.difference(set1)
+    Arguments
+    ----------
+    rankings1: sequence of lists or arrays
+        The first ranking of each pair
+    rankings2: sequence of lists or arrays
+        The second ranking of each pair
+    k: int (default = -1s)
+        The top elements to consider from each ranking. When -1 it will be set
+        to the size of the smaller list of each pair
+    p: double [0, 1] (defaults to 0)
+        The penalty factor
     
-    #Both elements in the intersection
-    intersect_penalty = 0
-    for i, j in itertools.combinations(intersect, 2):
-        geq1 = positions1[i] >= positions1[j]
-        geq2 = positions2[i] >= positions2[j]
+    See also
+    --------
+    kendall_tau_distance
+    '''
+    if len(rankings1) != len(rankings2):
+        raise Exception('The number of rankings differ')
     
-        #The xor captures the different order.
-        if geq1 ^ geq2:
-            intersect_penalty += 1
+    num_pairs = len(rankings1)
+    stats = []
+    all_ranks = []
+    for data1, data2 in zip(rankings1, rankings2):
+        if k > len(data1) or k > len(data2):
+            raise Exception('k is greater than the length of given lists')
+        
+        pair_k = k
+        if k == -1:
+            pair_k = min(len(data1), len(data2))
+        
+        z, sum1, sum2, ranks2 = _top_k_stats(data1, data2, pair_k)
+        stats.append((pair_k, z, sum1, sum2))
+        all_ranks.append(ranks2)
     
-    #Sum of ranks in distinct elements
-    sum1 = sum(positions1[i] for i in diff1)
-    sum2 = sum(positions2[i] for i in diff2)
+    if num_pairs == 0:
+        return np.zeros(0, dtype='d')
     
-    z = len(intersect)
-    unnorm = (k - z) * ((2 + p) * k - p * z + 1 - p) + \
-             (intersect_penalty - sum1 - sum2)
+    sizes = [ranks.shape[0] for ranks in all_ranks]
+    groups = np.repeat(np.arange(num_pairs), sizes)
+    values = np.concatenate(all_ranks).astype(np.int64)
+    penalties = _count_inversions(values, groups, num_pairs)
     
-    #Computes Kendall-Tau
-    norm_factor = (k * k) * (p + 1) - k * p
-    return unnorm / norm_factor
\ No newline at end of file
+    return np.array([_distance(pair_k, z, int(penalty), sum1, sum2, p)
+                     for (pair_k, z, sum1, sum2), penalty 
+                     in zip(stats, penalties)], dtype='d')
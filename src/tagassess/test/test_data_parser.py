@@ -9,6 +9,8 @@ from tagassess import data_parser
 from tagassess import test
 
 import StringIO
+import multiprocessing
+import numpy as np
 import time
 import unittest
 
@@ -117,6 +119,63 @@ class TestParseFuncs(unittest.TestCase):
         self.assertEqual('partial-order-reduction', tag)
         self.assertEqual('2009-03-16 18:00:04', convert_time(date))
 
+class TestDecodeTime(unittest.TestCase):
+    
+    def test_decode_time(self):
+        for time_string in ['2003-01-01 01:00:00', '2011-02-17 11:10:20',
+                            '2012-02-29 23:59:59', '1999-12-31 00:00:00']:
+            expected = time.mktime(time.strptime(time_string, 
+                                                 '%Y-%m-%d %H:%M:%S'))
+            self.assertEqual(expected, data_parser.decode_time(time_string))
+        
+        fmt = '%Y-%m-%dT%H:%M:%SZ'
+        expected = time.mktime(time.strptime('2004-12-09T18:37:12Z', fmt))
+        self.assertEqual(expected, 
+                         data_parser.decode_time('2004-12-09T18:37:12Z', fmt))
+        
+        #Only the layout of the format given is decoded
+        self.assertEqual(None, data_parser.decode_time('2004-12-09T18:37:12Z'))
+        self.assertEqual(None, 
+                         data_parser.decode_time('2011-02-17 10:00:00', fmt))
+        self.assertEqual(None, 
+                         data_parser.decode_time('2011-02-17 10:00:00', 
+                                                 '%Y-%d-%m %H:%M:%S'))
+        
+        self.assertEqual(None, data_parser.decode_time('2011-02-29 10:00:00'))
+        self.assertEqual(None, data_parser.decode_time('2011-2-17 10:00:00'))
+        self.assertEqual(None, data_parser.decode_time('2011-02-17 1a:00:00'))
+        self.assertEqual(None, data_parser.decode_time('2011-02-17T10:00:00'))
+        self.assertEqual(None, data_parser.decode_time('tinker'))
+    
+    def test_decode_times(self):
+        time_strings = ['2003-01-01 01:00:00', '2011-02-17 11:10:20',
+                        '2003-01-01 01:59:00', '2011-2-17 11:10:20']
+        expected = [time.mktime(time.strptime(t, '%Y-%m-%d %H:%M:%S'))
+                    for t in time_strings]
+        
+        self.assertEqual(expected, 
+                         list(data_parser.decode_times(time_strings)))
+        self.assertEqual(expected, 
+                list(data_parser.decode_times(np.array(time_strings))))
+        self.assertEqual(0, data_parser.decode_times([]).shape[0])
+        self.assertRaises(ValueError, data_parser.decode_times, ['tinker'])
+        
+        #Timestamps in the other fixed layout are not in `fmt`
+        self.assertRaises(ValueError, data_parser.decode_times, 
+                          ['2004-12-09T18:37:12Z'])
+        
+        fmt = '%Y-%m-%dT%H:%M:%SZ'
+        time_strings = ['2004-12-09T18:37:12Z', '2004-12-09T18:40:00Z']
+        expected = [time.mktime(time.strptime(t, fmt)) for t in time_strings]
+        self.assertEqual(expected, 
+                         list(data_parser.decode_times(time_strings, fmt)))
+        
+        #Day and month swapped, must go through strptime
+        fmt = '%Y-%d-%m %H:%M:%S'
+        self.assertEqual([time.mktime(time.strptime('2011-17-02 10:00:00', 
+                                                    fmt))],
+                list(data_parser.decode_times(['2011-17-02 10:00:00'], fmt)))
+
 class TestIParse(unittest.TestCase):
 
     def test_iparse(self):
@@ -160,5 +219,61 @@ class TestIParse(unittest.TestCase):
             annots = [a for a in p.iparse(f, data_parser.bibsonomy_parser)]
             self.assertEquals(10000, len(annots))
 
+    def test_parallel(self):
+        for fpath, parse_func in [(test.BIBSONOMY_FILE, 
+                                   data_parser.bibsonomy_parser),
+                                  (test.DELICIOUS_FILE,
+                                   data_parser.delicious_flickr_parser),
+                                  (test.CITEULIKE_FILE,
+                                   data_parser.citeulike_parser)]:
+            serial = data_parser.Parser()
+            with open(fpath) as f:
+                expected = [a for a in serial.iparse(f, parse_func)]
+            
+            parallel = data_parser.Parser()
+            annots = [a for a in parallel.iparse_parallel(fpath, parse_func, 
+                                                          3, chunk_bytes=5000)]
+            
+            self.assertEqual(expected, annots)
+            self.assertEqual(dict(serial.user_ids), dict(parallel.user_ids))
+            self.assertEqual(dict(serial.item_ids), dict(parallel.item_ids))
+            self.assertEqual(dict(serial.tag_ids), dict(parallel.tag_ids))
+
+    def test_columns(self):
+        serial = data_parser.Parser()
+        with open(test.BIBSONOMY_FILE) as f:
+            expected = [a for a in serial.iparse(f, 
+                                                 data_parser.bibsonomy_parser)]
+        
+        columns = data_parser.Parser()
+        annots = []
+        for users, items, tags, dates in \
+                columns.iparse_columns(test.BIBSONOMY_FILE, 
+                                       data_parser.bibsonomy_parser,
+                                       chunk_bytes=5000):
+            for i in range(len(users)):
+                annots.append(data_parser.to_json(users[i], items[i], tags[i],
+                                                  dates[i]))
+        
+        self.assertEqual(expected, annots)
+        self.assertEqual(dict(serial.tag_ids), dict(columns.tag_ids))
+
+    def test_imap_window(self):
+        submitted = []
+        def tasks():
+            for i in range(20):
+                submitted.append(i)
+                yield -i
+        
+        pool = multiprocessing.Pool(2)
+        try:
+            results = data_parser._imap_window(pool, abs, tasks(), 4)
+            for i, result in enumerate(results):
+                self.assertEqual(i, result)
+                self.assertTrue(len(submitted) <= i + 5)
+            self.assertEqual(19, i)
+        finally:
+            pool.terminate()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
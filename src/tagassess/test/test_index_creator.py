@@ -8,6 +8,19 @@ from tagassess import test
 from tagassess.index_creator import create_double_occurrence_index
 from tagassess.index_creator import create_occurrence_index
 from tagassess.index_creator import create_metrics_index
+from tagassess.index_creator import create_csr_double_occurrence_index
+from tagassess.index_creator import create_csr_occurrence_index
+from tagassess.index_creator import create_csr_metrics_index
+from tagassess.index_creator import IndexCache
+from tagassess.index_creator import OccurrenceIndex
+from tagassess.dao.mmap.annotations import AnnotReader
+from tagassess.dao.mmap.annotations import AnnotWriter
+
+import numpy as np
+import os
+import pickle
+import shutil
+import tempfile
 
 import random
 import time
@@ -156,5 +169,151 @@ class TestIndexCreation(unittest.TestCase):
         self.assertEqual(inv[2], set([1, 2]))
         self.assertEqual(inv[3], set([2]))
         
+class TestCSRIndexCreation(unittest.TestCase):
+    
+    def setUp(self):
+        p = data_parser.Parser()
+        with open(test.DELICIOUS_FILE) as f:
+            self.annots = [a for a in 
+                           p.iparse(f, data_parser.delicious_flickr_parser)]
+        
+        columns = [np.array([a[field] for a in self.annots]) 
+                   for field in ('user', 'item', 'tag', 'date')]
+        #Uneven chunks
+        self.chunks = [tuple(c[:1000] for c in columns),
+                       tuple(c[1000:1001] for c in columns),
+                       tuple(c[1001:] for c in columns)]
+    
+    def assert_same(self, expected, index):
+        self.assertEqual(sorted(expected.keys()), list(index))
+        for key in expected:
+            self.assertTrue(key in index)
+            self.assertEqual(expected[key], set(index[key]))
+            self.assertEqual(sorted(expected[key]), list(index[key]))
+        
+        self.assertFalse(-1 in index)
+        self.assertEqual(0, len(index[-1]))
+    
+    def test_occurrence_index(self):
+        for from_, dest in [('user', 'item'), ('tag', 'item'), 
+                            ('item', 'tag'), ('item', 'user')]:
+            expected = create_occurrence_index(self.annots, from_, dest)
+            index = create_csr_occurrence_index(self.chunks, from_, dest)
+            self.assert_same(expected, index)
+    
+    def test_double_occurrence_index(self):
+        expected = create_double_occurrence_index(self.annots, 'user', 'tag')
+        index = create_csr_double_occurrence_index(self.chunks, 'user', 'tag')
+        self.assert_same(expected[0], index[0])
+        self.assert_same(expected[1], index[1])
+    
+    def test_metrics_index(self):
+        pair_freq, from_freq, dest_freq = \
+                create_metrics_index(self.annots, 'item', 'tag')
+        index, csr_from_freq, csr_dest_freq = \
+                create_csr_metrics_index(self.chunks, 'item', 'tag')
+        
+        for item in pair_freq:
+            self.assertEqual(from_freq[item], csr_from_freq[item])
+            for tag in pair_freq[item]:
+                self.assertEqual(pair_freq[item][tag], index.count(item, tag))
+                self.assertTrue(index.contains(item, tag))
+            self.assertEqual(sorted(pair_freq[item].values()),
+                             sorted(index.get_counts(item)))
+        
+        for tag in dest_freq:
+            self.assertEqual(dest_freq[tag], csr_dest_freq[tag])
+        
+        self.assertEqual(0, index.count(-1, 0))
+        self.assertEqual(0, index.count(0, -1))
+        self.assertFalse(index.contains(0, -1))
+    
+    def test_empty(self):
+        index = create_csr_occurrence_index([], 'user', 'item')
+        self.assertEqual(0, len(index))
+        self.assertEqual(0, len(index[0]))
+        self.assertEqual(0, index.count(0, 0))
+    
+    def test_save_load_pickle(self):
+        expected = create_occurrence_index(self.annots, 'tag', 'item')
+        index = create_csr_occurrence_index(self.chunks, 'tag', 'item')
+        
+        folder = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(folder, 'tag_item')
+            index.save(fpath)
+            self.assert_same(expected, OccurrenceIndex.load(fpath))
+            self.assert_same(expected, OccurrenceIndex.load(fpath, False))
+        finally:
+            shutil.rmtree(folder)
+        
+        self.assert_same(expected, pickle.loads(pickle.dumps(index)))
+
+class TestIndexCache(unittest.TestCase):
+    
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db_fpath = os.path.join(self.folder, 'db')
+        self.cache_folder = os.path.join(self.folder, 'cache')
+        os.mkdir(self.cache_folder)
+        
+        p = data_parser.Parser()
+        with open(test.DELICIOUS_FILE) as f:
+            self.chunks = list(p.iparse_columns(f.name, 
+                    data_parser.delicious_flickr_parser, chunk_bytes=50000))
+        
+        with AnnotWriter(self.db_fpath) as writer:
+            writer.create_table('deli')
+            writer.append_chunks(self.chunks[:-1])
+        
+        self.filter_fpath = os.path.join(self.folder, 'filter.dat')
+        with open(self.filter_fpath, 'w') as filter_file:
+            filter_file.write('0 - 1 2\n')
+    
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+    
+    def get_index(self, filter_fpath):
+        with AnnotReader(self.db_fpath) as reader:
+            reader.change_table('deli')
+            cache = IndexCache(self.cache_folder, self.db_fpath, 'deli',
+                               filter_fpath)
+            index = cache.occurrence_index('tag', 'item', reader.iter_chunks)
+            expected = create_csr_occurrence_index(reader.iter_chunks(), 
+                                                   'tag', 'item')
+            
+            self.assertEqual(list(expected), list(index))
+            for tag in expected:
+                self.assertEqual(list(expected[tag]), list(index[tag]))
+            return cache.hits, cache.misses
+    
+    def test_cache(self):
+        self.assertEqual((0, 1), self.get_index(self.filter_fpath))
+        self.assertEqual((1, 0), self.get_index(self.filter_fpath))
+        
+        #Other filter, other key
+        self.assertEqual((0, 1), self.get_index(None))
+        self.assertEqual((1, 0), self.get_index(None))
+        
+        with open(self.filter_fpath, 'w') as filter_file:
+            filter_file.write('0 - 1\n')
+        self.assertEqual((0, 1), self.get_index(self.filter_fpath))
+        
+        #Database changes invalidate the cache
+        with AnnotWriter(self.db_fpath) as writer:
+            writer.change_table('deli')
+            writer.append_chunks(self.chunks[-1:])
+        self.assertEqual((0, 1), self.get_index(self.filter_fpath))
+        self.assertEqual((1, 0), self.get_index(self.filter_fpath))
+    
+    def test_no_cache(self):
+        with AnnotReader(self.db_fpath) as reader:
+            reader.change_table('deli')
+            cache = IndexCache(None, self.db_fpath, 'deli')
+            cache.occurrence_index('tag', 'item', reader.iter_chunks)
+            cache.occurrence_index('tag', 'item', reader.iter_chunks)
+            self.assertEqual((0, 2), (cache.hits, cache.misses))
+        self.assertEqual([], os.listdir(self.cache_folder))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -77,6 +77,34 @@ class TestValueCaculator(unittest.TestCase):
         rho = vc.calc_rho(0, np.array([0.0]), np.array([0]))
         self.assertEqual(rho, 1 - dktau([0], [0], k=1, p=1))
         
+    def test_rho_random_relevance(self):
+        self.__init_test(test.DELICIOUS_FILE)
+    
+        smooth_func = 'Bayes'
+        lambda_ = 0.1
+        _, vc = self.build_value_calculator(self.annots, smooth_func, lambda_)
+        
+        num_items = max(annot['item'] for annot in self.annots) + 1
+        items_with_tag = {}
+        for annot in self.annots:
+            items_with_tag.setdefault(annot['tag'], set()).add(annot['item'])
+        
+        rng = np.random.RandomState(0)
+        for tag in list(items_with_tag.keys())[:20]:
+            gamma_items = rng.permutation(num_items + 10)[:50]
+            relevance = rng.rand(gamma_items.shape[0])
+            
+            ranked = gamma_items[relevance.argsort()[::-1]]
+            with_tag = [i for i in ranked if i in items_with_tag[tag]]
+            k = len(with_tag)
+            if k == 0:
+                expected = 0
+            else:
+                expected = 1 - dktau(ranked, with_tag, k=k, p=1)
+            
+            self.assertEqual(expected, 
+                             vc.calc_rho(tag, relevance, gamma_items))
+        
     def test_naive(self):
         self.__init_test(test.SMALL_DEL_FILE)
         smooth_func = 'Bayes'
@@ -8,8 +8,7 @@
 from __future__ import division, print_function
 
 from tagassess.index_creator import create_occurrence_index
-from tagassess.stats.topk import kendall_tau_distance as dktau
-
+from tagassess.index_creator import OccurrenceIndex
 
 from cpython cimport bool
 from tagassess cimport entropy
@@ -29,15 +28,37 @@ cdef class ValueCalculator(object):
     cdef ProbabilityEstimator est
     cdef int num_items
     
+    #Items of each tag as arrays, and a buffer (zeroed between calls) used 
+    #to mark the items of a tag when computing rho
+    cdef dict tag_items
+    cdef unsigned char[::1] item_mask
+    
     def __init__(self, ProbabilityEstimator estimator, object annotation_it):
+        '''
+        Arguments
+        ---------
+        estimator : ProbabilityEstimator
+            Estimator of the probabilities used by value functions
+        annotation_it : iterable or OccurrenceIndex
+            The annotations, or an already built tag to item index (see
+            `tagassess.index_creator.IndexCache`)
+        '''
         self.est = estimator
         self.items_with_tag = {}
+        self.tag_items = {}
         self.num_items = 0
         
-        index = create_occurrence_index(annotation_it, 'tag', 'item').items()
+        if isinstance(annotation_it, OccurrenceIndex):
+            index = annotation_it.items()
+        else:
+            index = create_occurrence_index(annotation_it, 'tag', 
+                                            'item').items()
         for k, v in index:
             self.num_items = max(self.num_items, max(v))
             self.items_with_tag[k] = v
+            self.tag_items[k] = np.fromiter(v, dtype=np.int, count=len(v))
+        
+        self.item_mask = np.zeros(self.num_items + 1, dtype=np.uint8)
 
     cpdef calc_rho(self, int tag, 
             np.ndarray[np.float_t, ndim=1] item_relevance,
@@ -48,9 +69,15 @@ cdef class ValueCalculator(object):
         sorted by p(i|u) and the items retrieved by the tag also sorted by 
         p(i|u).
         
-        TODO: Although this method is inside a cythonized module,
-        the it is not optimized. It is basically a drop in of pure python
-        with some types added.
+        The ranking of the items retrieved by the tag is a subsequence of the
+        ranking of all items, so no pair in the intersection of the top k is
+        discordant. The distance (with p=1) then depends only on which of the
+        top k items have the tag, and is computed in a single pass after 
+        sorting. The result is the same as:
+        
+            1 - kendall_tau_distance(ranked, ranked_with_tag, k, p=1)
+        
+        where k is the number of gamma items with the tag.
         
         Arguments
         ---------
@@ -68,23 +95,48 @@ cdef class ValueCalculator(object):
         
         cdef np.ndarray[np.int_t, ndim=1] top_valued_items = \
                 gamma_items[item_relevance.argsort()[::-1]]
+        cdef np.ndarray[np.int_t, ndim=1] items = self.tag_items[tag]
         
-        #Populates I^t with top valued items
-        cdef list top_valued_items_with_tag = []
-        
+        cdef unsigned char[::1] mask = self.item_mask
+        cdef Py_ssize_t mask_size = mask.shape[0]
+        cdef Py_ssize_t n = top_valued_items.shape[0]
         cdef Py_ssize_t i = 0
-        cdef int item_id
-        for i in range(top_valued_items.shape[0]):
-            item_id = top_valued_items[i] #Top valued items is already sorted
-            if item_id in self.items_with_tag[tag]:
-                top_valued_items_with_tag.append(item_id)
+        cdef long item_id
+        
+        for i in range(items.shape[0]):
+            mask[items[i]] = 1
+        
+        #k = |I^t|, number of gamma items with the tag
+        cdef long long k = 0
+        for i in range(n):
+            item_id = top_valued_items[i]
+            if item_id >= 0 and item_id < mask_size and mask[item_id]:
+                k += 1
+        
+        #z = |top k of gamma with the tag|, sum1 = sum of ranks of the top k 
+        #without the tag
+        cdef long long z = 0
+        cdef long long sum1 = 0
+        for i in range(k):
+            item_id = top_valued_items[i]
+            if item_id >= 0 and item_id < mask_size and mask[item_id]:
+                z += 1
+            else:
+                sum1 += i + 1
+        
+        for i in range(items.shape[0]):
+            mask[items[i]] = 0
         
-        cdef Py_ssize_t k = len(top_valued_items_with_tag)
         if k == 0:
             return 0
-        else:
-            return 1 - dktau(top_valued_items, top_valued_items_with_tag, k,
-                             p=1)
+        
+        #Items with the tag outside of the top k have ranks z + 1 .. k in I^t
+        cdef long long sum2 = (k * (k + 1) - z * (z + 1)) // 2
+        
+        #Same as tagassess.stats.topk with p = 1
+        cdef long long unnorm = (k - z) * (3 * k - z) - sum1 - sum2
+        cdef long long norm_factor = 2 * k * k - k
+        return 1 - (<double> unnorm) / norm_factor
 
     def tag_value_naive(self, int user, 
             np.ndarray[np.int_t, ndim=1] tags,
@@ -151,7 +203,11 @@ cdef class ValueCalculator(object):
         else:
             return_val = np.ndarray(shape=(tags.shape[0], 3), dtype='d')
        
-        cdef np.ndarray[np.float_t, ndim=1] vp_iu
+        cdef np.ndarray[np.float_t, ndim=1] vp_iu = \
+                self.est.prob_items_given_user(user, gamma_items)
+        cdef np.ndarray[np.float_t, ndim=2] vp_itus = \
+                self.est.prob_items_given_user_tags(user, tags, gamma_items)
+        
         cdef np.ndarray[np.float_t, ndim=1] vp_itu
         cdef double tag_val
         cdef double rho 
@@ -160,8 +216,7 @@ cdef class ValueCalculator(object):
         cdef int tag
         for i in range(tags.shape[0]):
             tag = tags[i]
-            vp_iu = self.est.prob_items_given_user(user, gamma_items)
-            vp_itu = self.est.prob_items_given_user_tag(user, tag, gamma_items)
+            vp_itu = vp_itus[i]
             rho = self.calc_rho(tag, vp_iu, gamma_items)
             dkl = entropy.kullback_leiber_divergence(vp_itu, vp_iu)
             tag_val = rho * dkl